@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import prometheus_client.parser
+import requests
+
+import fake_connector
+
+AUDIT_KEY_ID = 6
+APPLICATION_KEY_ID = 3
+AUDIT_KEY_PIN = 'audit-password'
+APPLICATION_KEY_PIN = 'application-password'
+KEY_LABEL = 'vault-hsm-key'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_file(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def create_config(path, server, count, args):
+    audit_pin_path = os.path.join(path, 'audit')
+    app_pin_path = os.path.join(path, 'application')
+    write_file(audit_pin_path, AUDIT_KEY_PIN)
+    write_file(app_pin_path, APPLICATION_KEY_PIN)
+    connectors = [dict(name='hsm-%d' % i, url=server.url(i),
+                       audit_key_id=AUDIT_KEY_ID,
+                       audit_key_pin_path=audit_pin_path,
+                       application_key_id=APPLICATION_KEY_ID,
+                       application_key_pin_path=app_pin_path,
+                       encryption_key_label=KEY_LABEL,
+                       probe_interval=args.interval)
+                  for i in range(count)]
+    config = dict(metrics_port=free_port(), connectors=connectors,
+                  probe_workers=args.workers,
+                  collection_mode=args.collection_mode,
+                  transport=args.transport)
+    config_path = os.path.join(path, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    return config
+
+
+def cpu_seconds(pid):
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def memory_kib(pid):
+    memory = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                memory[key] = int(value.split()[0])
+    return memory
+
+
+def scrape(port):
+    response = requests.get('http://127.0.0.1:%d' % port, timeout=30)
+    probes = errors = total_sum = total_count = 0
+    for family in prometheus_client.parser.text_string_to_metric_families(
+            response.text):
+        for sample in family.samples:
+            if sample.name == 'yubihsm_test_connections_total':
+                probes += sample.value
+            elif sample.name == 'yubihsm_test_errors_total':
+                errors += sample.value
+            elif sample.labels.get('phase') == 'total':
+                if sample.name == 'yubihsm_probe_phase_duration_seconds_sum':
+                    total_sum += sample.value
+                elif sample.name == 'yubihsm_probe_phase_duration_seconds_count':
+                    total_count += sample.value
+    return dict(probes=probes, errors=errors, total_sum=total_sum,
+                total_count=total_count)
+
+
+def wait_for_exporter(process, port, timeout=30):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if process.poll() is not None:
+            raise RuntimeError('Exporter exited with %d' % process.returncode)
+        try:
+            return scrape(port)
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError('Exporter did not start within %d seconds' % timeout)
+
+
+def run(count, args):
+    devices = fake_connector.create_devices(
+            count, {AUDIT_KEY_ID: AUDIT_KEY_PIN,
+                    APPLICATION_KEY_ID: APPLICATION_KEY_PIN}, KEY_LABEL)
+    for device in devices.values():
+        device.latency = args.latency
+        device.error_rate = args.error_rate
+    for index in range(args.hanging):
+        devices[index].hang = True
+    server = fake_connector.FakeConnector(devices).start()
+    temp_dir = tempfile.TemporaryDirectory()
+    process = None
+    try:
+        config = create_config(temp_dir.name, server, count, args)
+        env = dict(os.environ,
+                   YUBIHSM_EXPORTER_CONFIG=os.path.join(temp_dir.name,
+                                                        'config.json'))
+        process = subprocess.Popen(
+                [sys.executable, os.path.join(os.path.dirname(__file__), 'main.py')],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+        port = config['metrics_port']
+        wait_for_exporter(process, port)
+        time.sleep(args.warmup)
+        before = scrape(port)
+        cpu_before = cpu_seconds(process.pid)
+        start = time.monotonic()
+        time.sleep(args.duration)
+        after = scrape(port)
+        elapsed = time.monotonic() - start
+        cpu = cpu_seconds(process.pid) - cpu_before
+        memory = memory_kib(process.pid)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        server.stop()
+        temp_dir.cleanup()
+    probes = after['probes'] - before['probes']
+    probe_count = after['total_count'] - before['total_count']
+    return dict(
+            connectors=count,
+            probes=int(probes),
+            errors=int(after['errors'] - before['errors']),
+            cycle_seconds=elapsed * count / probes if probes else None,
+            probe_seconds=((after['total_sum'] - before['total_sum']) / probe_count
+                           if probe_count else None),
+            cpu_percent=100 * cpu / elapsed,
+            cpu_seconds_per_probe=cpu / probes if probes else None,
+            rss_kib=memory['VmRSS'],
+            peak_rss_kib=memory['VmHWM'])
+
+
+def format_value(value, fmt):
+    return '-' if value is None else fmt % value
+
+
+def print_table(results):
+    columns = (('connectors', 'connectors', '%d'), ('probes', 'probes', '%d'),
+               ('errors', 'errors', '%d'), ('cycle [s]', 'cycle_seconds', '%.2f'),
+               ('probe [s]', 'probe_seconds', '%.3f'),
+               ('cpu [%]', 'cpu_percent', '%.1f'),
+               ('cpu/probe [ms]', 'cpu_seconds_per_probe', '%.2f'),
+               ('rss [MiB]', 'rss_kib', '%.1f'),
+               ('peak rss [MiB]', 'peak_rss_kib', '%.1f'))
+    print(' '.join('%14s' % title for title, _, _ in columns))
+    for result in results:
+        values = dict(result)
+        if values['cpu_seconds_per_probe'] is not None:
+            values['cpu_seconds_per_probe'] *= 1000
+        values['rss_kib'] /= 1024
+        values['peak_rss_kib'] /= 1024
+        print(' '.join('%14s' % format_value(values[key], fmt)
+                       for _, key, fmt in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the exporter against fake YubiHSM connectors')
+    parser.add_argument('--connectors', default='1,10,50,100',
+                        help='comma separated list of connector counts')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='measurement window per run in seconds')
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--interval', type=float, default=5,
+                        help='probe_interval of every connector')
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--collection-mode', default='background',
+                        choices=('background', 'scrape'))
+    parser.add_argument('--transport', default='requests',
+                        choices=('requests', 'asyncio'))
+    parser.add_argument('--latency', type=float, default=0,
+                        help='added latency per connector request in seconds')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='share of connector requests answered with HTTP 503')
+    parser.add_argument('--hanging', type=int, default=0,
+                        help='number of connectors that never answer')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    results = []
+    for count in (int(c) for c in args.connectors.split(',')):
+        logging.info('Benchmark %d connectors for %.0f seconds', count,
+                     args.duration)
+        results.append(run(count, args))
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
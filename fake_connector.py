@@ -0,0 +1,487 @@
+#!/usr/bin/python3
+
+import argparse
+import hashlib
+import http.server
+import logging
+import os
+import random
+import re
+import struct
+import threading
+import time
+
+import yubihsm.core
+import yubihsm.defs
+import yubihsm.objects
+import yubihsm.utils
+from cryptography.hazmat.primitives import constant_time, hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa, utils
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+COMMAND = yubihsm.defs.COMMAND
+ERROR = yubihsm.defs.ERROR
+OBJECT = yubihsm.defs.OBJECT
+ALGORITHM = yubihsm.defs.ALGORITHM
+ORIGIN = yubihsm.defs.ORIGIN
+LIST_FILTER = yubihsm.defs.LIST_FILTER
+LOG_ENTRY_FORMAT = yubihsm.core.LogEntry.FORMAT
+LABEL_LENGTH = yubihsm.objects.LABEL_LENGTH
+
+DEFAULT_VERSION = (2, 2, 0)
+DEFAULT_LOG_SIZE = 62
+MAX_SESSIONS = 16
+SESSION_TIMEOUT = 30
+TOTAL_RECORDS = 256
+TOTAL_PAGES = 1024
+PAGE_SIZE = 126
+ALL_CAPABILITIES = 0x7fffffffffffffff
+ALL_DOMAINS = 0xffff
+HANG_TIMEOUT = 3600
+DEVICE_PATH = re.compile(r'^/(?:(\d+)/)?connector/api$')
+STATUS_PATH = re.compile(r'^/(?:(\d+)/)?connector/status$')
+
+
+class FakeError(Exception):
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+class FakeObject:
+
+    def __init__(self, id, type, algorithm, label, key=None, sequence=0,
+                 origin=ORIGIN.IMPORTED):
+        self.id = id
+        self.type = type
+        self.algorithm = algorithm
+        self.label = label
+        self.key = key
+        self.sequence = sequence
+        self.origin = origin
+
+    @property
+    def size(self):
+        if self.type == OBJECT.ASYMMETRIC_KEY:
+            return self.key.key_size // 8
+        return 32
+
+    def info(self):
+        return struct.pack(yubihsm.objects.ObjectInfo.FORMAT,
+                           ALL_CAPABILITIES, self.id, self.size, ALL_DOMAINS,
+                           self.type, self.algorithm, self.sequence,
+                           self.origin, self.label.encode(), ALL_CAPABILITIES)
+
+
+class FakeSession:
+
+    def __init__(self, key_id, key_enc, key_mac, key_rmac, context):
+        self.key_id = key_id
+        self.key_enc = key_enc
+        self.key_mac = key_mac
+        self.key_rmac = key_rmac
+        self.context = context
+        self.authenticated = False
+        self.mac_chain = b'\0' * 16
+        self.counter = 1
+        self.last_used = time.monotonic()
+
+
+class FakeYubiHsm:
+
+    def __init__(self, serial=1234567, auth_keys=None, key_label='vault-hsm-key',
+                 rsa_key=None, log_size=DEFAULT_LOG_SIZE, version=DEFAULT_VERSION):
+        self.__lock = threading.Lock()
+        self.__serial = serial
+        self.__version = version
+        self.__log_size = log_size
+        self.__objects = {}
+        for key_id, password in (auth_keys or {1: 'password'}).items():
+            self.add_object(FakeObject(
+                    key_id, OBJECT.AUTHENTICATION_KEY,
+                    ALGORITHM.AES128_YUBICO_AUTHENTICATION,
+                    'auth-key-%d' % key_id,
+                    yubihsm.utils.password_to_key(password)))
+        if key_label is not None:
+            self.add_object(FakeObject(
+                    0x100, OBJECT.ASYMMETRIC_KEY, ALGORITHM.RSA_2048, key_label,
+                    rsa_key or rsa.generate_private_key(65537, 2048),
+                    origin=ORIGIN.GENERATED))
+        self.__sessions = {}
+        self.__log = []
+        self.__log_number = 0
+        self.__last_digest = os.urandom(16)
+        self.__log_entry(0, 0, 0, 0, 0, 0xff)
+        self.latency = 0
+        self.error_rate = 0
+        self.hang = False
+
+    @property
+    def serial(self):
+        return self.__serial
+
+    @property
+    def log(self):
+        with self.__lock:
+            return list(self.__log)
+
+    @property
+    def sessions(self):
+        with self.__lock:
+            return len(self.__sessions)
+
+    def add_object(self, obj):
+        self.__objects[(obj.id, obj.type)] = obj
+
+    def remove_object(self, id, type):
+        with self.__lock:
+            del self.__objects[(id, type)]
+
+    def drop_sessions(self):
+        with self.__lock:
+            self.__sessions.clear()
+
+    def __log_entry(self, command, length, session_key, target_key, second_key,
+                    result):
+        self.__log_number = (self.__log_number + 1) & 0xffff
+        tick = int(time.monotonic() * 1000) & 0xffffffff
+        data = struct.pack(LOG_ENTRY_FORMAT, self.__log_number, command, length,
+                           session_key, target_key, second_key, result, tick,
+                           b'')[:-16]
+        self.__last_digest = hashlib.sha256(data + self.__last_digest).digest()[:16]
+        if len(self.__log) >= self.__log_size:
+            self.__log.pop(0)
+        self.__log.append(data + self.__last_digest)
+
+    def transceive(self, msg):
+        with self.__lock:
+            try:
+                if len(msg) < 3:
+                    raise FakeError(ERROR.WRONG_LENGTH)
+                command, length = struct.unpack('!BH', msg[:3])
+                data = msg[3:]
+                if len(data) != length:
+                    raise FakeError(ERROR.WRONG_LENGTH)
+                if command == COMMAND.CREATE_SESSION:
+                    response = self.__create_session(data)
+                elif command == COMMAND.AUTHENTICATE_SESSION:
+                    response = self.__authenticate_session(msg)
+                elif command == COMMAND.SESSION_MESSAGE:
+                    return self.__session_message(msg)
+                elif command == COMMAND.DEVICE_INFO:
+                    response = self.__device_info()
+                elif command == COMMAND.ECHO:
+                    response = data
+                else:
+                    raise FakeError(ERROR.INVALID_COMMAND)
+                return struct.pack('!BH', command | 0x80, len(response)) + response
+            except FakeError as e:
+                return struct.pack('!BHB', COMMAND.ERROR, 1, e.code)
+
+    def __expire_sessions(self):
+        now = time.monotonic()
+        for sid, session in list(self.__sessions.items()):
+            if now - session.last_used > SESSION_TIMEOUT:
+                del self.__sessions[sid]
+
+    def __device_info(self):
+        return struct.pack('!BBBIBB', *self.__version, self.__serial,
+                           self.__log_size, len(self.__log)) + bytes(
+                                   [ALGORITHM.RSA_2048,
+                                    ALGORITHM.AES128_YUBICO_AUTHENTICATION])
+
+    def __create_session(self, data):
+        if len(data) != 10:
+            raise FakeError(ERROR.WRONG_LENGTH)
+        key_id, host_challenge = struct.unpack('!H8s', data)
+        key = self.__objects.get((key_id, OBJECT.AUTHENTICATION_KEY))
+        if key is None:
+            raise FakeError(ERROR.OBJECT_NOT_FOUND)
+        self.__expire_sessions()
+        sid = next((i for i in range(MAX_SESSIONS) if i not in self.__sessions),
+                   None)
+        if sid is None:
+            raise FakeError(ERROR.SESSIONS_FULL)
+        card_challenge = os.urandom(8)
+        context = host_challenge + card_challenge
+        key_enc, key_mac = key.key
+        session = FakeSession(
+                key_id,
+                yubihsm.core._derive(key_enc, yubihsm.core.KEY_ENC, context),
+                yubihsm.core._derive(key_mac, yubihsm.core.KEY_MAC, context),
+                yubihsm.core._derive(key_mac, yubihsm.core.KEY_RMAC, context),
+                context)
+        self.__sessions[sid] = session
+        card_cryptogram = yubihsm.core._derive(
+                session.key_mac, yubihsm.core.CARD_CRYPTOGRAM, context, 0x40)
+        return struct.pack('!B', sid) + card_challenge + card_cryptogram
+
+    def __authenticate_session(self, msg):
+        if len(msg) != 3 + 17:
+            raise FakeError(ERROR.WRONG_LENGTH)
+        sid = msg[3]
+        session = self.__sessions.get(sid)
+        if session is None or session.authenticated:
+            raise FakeError(ERROR.INVALID_SESSION)
+        host_cryptogram = yubihsm.core._derive(
+                session.key_mac, yubihsm.core.HOST_CRYPTOGRAM, session.context,
+                0x40)
+        chain, mac = yubihsm.core._calculate_mac(
+                session.key_mac, session.mac_chain, msg[:-8])
+        if not (constant_time.bytes_eq(host_cryptogram, msg[4:12])
+                and constant_time.bytes_eq(mac, msg[-8:])):
+            del self.__sessions[sid]
+            self.__log_entry(COMMAND.AUTHENTICATE_SESSION, 17, session.key_id,
+                             0, 0, COMMAND.ERROR)
+            raise FakeError(ERROR.AUTHENTICATION_FAILED)
+        session.authenticated = True
+        session.mac_chain = chain
+        self.__log_entry(COMMAND.AUTHENTICATE_SESSION, 17, session.key_id,
+                         0, 0, COMMAND.AUTHENTICATE_SESSION | 0x80)
+        return b''
+
+    def __session_message(self, msg):
+        sid = msg[3] if len(msg) > 3 else None
+        self.__expire_sessions()
+        session = self.__sessions.get(sid)
+        if session is None or not session.authenticated:
+            raise FakeError(ERROR.INVALID_SESSION)
+        next_chain, mac = yubihsm.core._calculate_mac(
+                session.key_mac, session.mac_chain, msg[:-8])
+        if not constant_time.bytes_eq(mac, msg[-8:]):
+            del self.__sessions[sid]
+            raise FakeError(ERROR.AUTHENTICATION_FAILED)
+        cipher = Cipher(algorithms.AES(session.key_enc), modes.CBC(
+                yubihsm.core._calculate_iv(session.key_enc, session.counter)))
+        decryptor = cipher.decryptor()
+        inner = decryptor.update(msg[4:-8]) + decryptor.finalize()
+        command, length = struct.unpack('!BH', inner[:3])
+        try:
+            response = self.__secure_command(session, command, inner[3:3 + length])
+            result = command | 0x80
+            response = struct.pack('!BH', result, len(response)) + response
+        except FakeError as e:
+            result = COMMAND.ERROR
+            response = struct.pack('!BHB', COMMAND.ERROR, 1, e.code)
+        if command not in (COMMAND.GET_LOG_ENTRIES, COMMAND.SET_LOG_INDEX):
+            target_key = struct.unpack('!H', inner[3:5])[0] if length >= 2 else 0
+            self.__log_entry(command, length, session.key_id, target_key, 0,
+                             result)
+        response += b'\x80'
+        response = response.ljust(-(-len(response) // 16) * 16, b'\0')
+        encryptor = cipher.encryptor()
+        encrypted = encryptor.update(response) + encryptor.finalize()
+        raw = struct.pack('!BHB', COMMAND.SESSION_MESSAGE | 0x80,
+                          1 + len(encrypted) + 8, sid) + encrypted
+        raw += yubihsm.core._calculate_mac(session.key_rmac, next_chain, raw)[1]
+        session.mac_chain = next_chain
+        session.counter += 1
+        session.last_used = time.monotonic()
+        if command == COMMAND.CLOSE_SESSION and result != COMMAND.ERROR:
+            del self.__sessions[sid]
+        return raw
+
+    def __asymmetric_key(self, data):
+        if len(data) < 2:
+            raise FakeError(ERROR.WRONG_LENGTH)
+        key_id = struct.unpack('!H', data[:2])[0]
+        key = self.__objects.get((key_id, OBJECT.ASYMMETRIC_KEY))
+        if key is None:
+            raise FakeError(ERROR.OBJECT_NOT_FOUND)
+        return key, data[2:]
+
+    def __secure_command(self, session, command, data):
+        if command == COMMAND.DEVICE_INFO:
+            return self.__device_info()
+        if command == COMMAND.ECHO:
+            return data
+        if command == COMMAND.CLOSE_SESSION:
+            return b''
+        if command == COMMAND.LIST_OBJECTS:
+            return self.__list_objects(data)
+        if command == COMMAND.GET_OBJECT_INFO:
+            key_id, type = struct.unpack('!HB', data)
+            obj = self.__objects.get((key_id, type))
+            if obj is None:
+                raise FakeError(ERROR.OBJECT_NOT_FOUND)
+            return obj.info()
+        if command == COMMAND.GET_PUBLIC_KEY:
+            key, _ = self.__asymmetric_key(data)
+            n = key.key.public_key().public_numbers().n
+            return bytes([key.algorithm]) + n.to_bytes(key.size, 'big')
+        if command == COMMAND.DECRYPT_PKCS1:
+            key, ciphertext = self.__asymmetric_key(data)
+            try:
+                return key.key.decrypt(ciphertext, padding.PKCS1v15())
+            except ValueError:
+                raise FakeError(ERROR.INVALID_DATA)
+        if command == COMMAND.SIGN_PKCS1:
+            key, digest = self.__asymmetric_key(data)
+            if len(digest) != 32:
+                raise FakeError(ERROR.INVALID_DATA)
+            return key.key.sign(digest, padding.PKCS1v15(),
+                                utils.Prehashed(hashes.SHA256()))
+        if command == COMMAND.GET_LOG_ENTRIES:
+            return struct.pack('!HHB', 0, 0, len(self.__log)) + b''.join(self.__log)
+        if command == COMMAND.SET_LOG_INDEX:
+            index = struct.unpack('!H', data)[0]
+            while self.__log and ((index - struct.unpack('!H', self.__log[0][:2])[0])
+                                  & 0xffff) < 0x8000:
+                self.__log.pop(0)
+            return b''
+        if command == COMMAND.GET_STORAGE_INFO:
+            records = len(self.__objects)
+            return struct.pack('!HHHHH', TOTAL_RECORDS, TOTAL_RECORDS - records,
+                               TOTAL_PAGES, TOTAL_PAGES - 2 * records, PAGE_SIZE)
+        raise FakeError(ERROR.INVALID_COMMAND)
+
+    def __list_objects(self, data):
+        filters = {}
+        formats = {LIST_FILTER.ID: '!H', LIST_FILTER.TYPE: '!B',
+                   LIST_FILTER.DOMAINS: '!H', LIST_FILTER.CAPABILITIES: '!Q',
+                   LIST_FILTER.ALGORITHM: '!B',
+                   LIST_FILTER.LABEL: '!%ds' % LABEL_LENGTH}
+        while data:
+            if data[0] not in formats:
+                raise FakeError(ERROR.INVALID_DATA)
+            fmt = formats[data[0]]
+            size = struct.calcsize(fmt)
+            filters[data[0]] = struct.unpack(fmt, data[1:1 + size])[0]
+            data = data[1 + size:]
+        label = filters.get(LIST_FILTER.LABEL)
+        objects = [o for o in self.__objects.values()
+                   if filters.get(LIST_FILTER.ID, o.id) == o.id
+                   and filters.get(LIST_FILTER.TYPE, o.type) == o.type
+                   and filters.get(LIST_FILTER.ALGORITHM, o.algorithm) == o.algorithm
+                   and (label is None or label.rstrip(b'\0') == o.label.encode())]
+        return b''.join(struct.pack('!HBB', o.id, o.type, o.sequence)
+                        for o in objects)
+
+
+class FakeConnectorHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def __device(self, pattern):
+        match = pattern.match(self.path)
+        if not match:
+            return None
+        return self.server.devices.get(int(match.group(1) or 0))
+
+    def __reply(self, status, body=b'', content_type='application/octet-stream'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __inject_faults(self, device):
+        if device.hang:
+            self.server.released.wait(HANG_TIMEOUT)
+            self.close_connection = True
+            return True
+        if device.latency:
+            time.sleep(device.latency)
+        if device.error_rate and random.random() < device.error_rate:
+            self.__reply(503)
+            return True
+        return False
+
+    def do_GET(self):
+        device = self.__device(STATUS_PATH)
+        if device is None:
+            self.__reply(404)
+            return
+        if self.__inject_faults(device):
+            return
+        status = 'status=OK\nserial=%d\nversion=%s\npid=%d\naddress=%s\nport=%d\n' % (
+                device.serial, '3.0.0', os.getpid(), *self.server.server_address)
+        self.__reply(200, status.encode(), 'text/plain')
+
+    def do_POST(self):
+        device = self.__device(DEVICE_PATH)
+        msg = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if device is None:
+            self.__reply(404)
+            return
+        if self.__inject_faults(device):
+            return
+        self.__reply(200, device.transceive(msg))
+        if not self.server.keep_alive:
+            # Drop the connection without announcing it, like an idle timeout
+            self.close_connection = True
+
+
+class FakeConnector(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, devices, address=('127.0.0.1', 0)):
+        super().__init__(address, FakeConnectorHandler)
+        self.devices = devices
+        self.keep_alive = True
+        self.released = threading.Event()
+        self.__thread = None
+
+    def url(self, index=0):
+        host, port = self.server_address[:2]
+        if index == 0:
+            return 'http://%s:%d' % (host, port)
+        return 'http://%s:%d/%d/' % (host, port, index)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.released.set()
+        self.shutdown()
+        self.server_close()
+        if self.__thread:
+            self.__thread.join()
+
+
+def create_devices(count, auth_keys, key_label='vault-hsm-key'):
+    rsa_key = rsa.generate_private_key(65537, 2048)
+    return {i: FakeYubiHsm(serial=1000000 + i, auth_keys=auth_keys,
+                           key_label=key_label, rsa_key=rsa_key)
+            for i in range(count)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Serve fake YubiHSMs over the yubihsm-connector protocol')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--auth-key', action='append', default=[],
+                        metavar='ID:PASSWORD')
+    parser.add_argument('--key-label', default='vault-hsm-key')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    auth_keys = dict((int(k), p) for k, p in
+                     (a.split(':', 1) for a in args.auth_key)) or {1: 'password'}
+    server = FakeConnector(create_devices(args.devices, auth_keys, args.key_label),
+                           (args.host, args.port))
+    for device in server.devices.values():
+        device.latency = args.latency
+        device.error_rate = args.error_rate
+    for index in server.devices:
+        logging.info('Serve fake YubiHSM %d on %s', index, server.url(index))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
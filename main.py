@@ -1,17 +1,88 @@
 #!/usr/bin/python3
 
+import asyncio
+import contextlib
+import cProfile
+import fnmatch
 import logging
 import os
+import re
 import json
+import hashlib
+import inspect
+import ipaddress
+import gzip
+import itertools
 import time
 import signal
+import concurrent.futures
+import threading
+import random
+import queue
+import socket
+import struct
+import sys
+import tempfile
+import tracemalloc
+import pstats
+import urllib.parse
+import wsgiref.simple_server
+from collections import Counter, namedtuple
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 
+import requests
 import yubihsm
 import prometheus_client
 
 
 SLEEP_TIME_BETWEEN_PROBES = 5
+SCHEDULER_TICK = 1
+DEFAULT_PROBE_JITTER = 0.1
+DEFAULT_MAX_BACKOFF = 300
+DEFAULT_PROBE_WORKERS = 10
+DEFAULT_CONNECT_TIMEOUT = 3
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_PROBE_DEADLINE = 30
+COLLECTION_MODE_BACKGROUND = 'background'
+COLLECTION_MODE_SCRAPE = 'scrape'
+DEFAULT_SCRAPE_CACHE_TTL = 5
+DEFAULT_SCRAPE_DEADLINE = 8
+AUDIT_LOG_SINK_TYPES = ('file', 'stdout', 'syslog')
+SYSLOG_PRIORITY = 134  # facility local0, severity info
+BENCHMARK_DATA = b'yubihsm-exporter-benchmark'
+SHARD_INDEX_VARIABLE = 'YUBIHSM_EXPORTER_SHARD_INDEX'
+SHARD_COUNT_VARIABLE = 'YUBIHSM_EXPORTER_SHARD_COUNT'
+CONFIG_POLL_INTERVAL = 10
+TRANSPORT_REQUESTS = 'requests'
+TRANSPORT_ASYNCIO = 'asyncio'
+DEFAULT_KEEPALIVE_CONNECTIONS = 2
+PROFILE_VARIABLE = 'YUBIHSM_EXPORTER_PROFILE'
+PROFILE_DIR_VARIABLE = 'YUBIHSM_EXPORTER_PROFILE_DIR'
+PROFILE_KINDS = ('cpu', 'memory')
+# Drain the audit log again in the same probe, while it is that full
+AUDIT_LOG_DRAIN_THRESHOLD = 0.5
+AUDIT_LOG_DRAIN_ROUNDS = 3
+# Share of the predicted time to full, after which the log gets drained
+AUDIT_LOG_DRAIN_MARGIN = 0.5
+MIN_DRAIN_DELAY = 1
+FILL_RATE_SMOOTHING = 0.5
+FILL_RATE_MIN_INTERVAL = 1
+# Keys beyond this number per YubiHSM are counted as other in the key usage
+AUDIT_KEY_LABELS = 20
+DEFAULT_MODULE = 'default'
+PROBE_TARGET_SCHEMES = ('http', 'https', 'yhusb')
+# Time left for the response, when a probe follows the Prometheus timeout
+SCRAPE_TIMEOUT_OFFSET = 0.5
+OPENMETRICS_EOF = b'# EOF\n'
+
+CachedKey = namedtuple('CachedKey', ['serial', 'key', 'public_key'])
+CachedExposition = namedtuple('CachedExposition',
+                              ['generation', 'output', 'compressed'])
+StorageInfo = namedtuple('StorageInfo', ['total_records', 'free_records',
+                                         'total_pages', 'free_pages',
+                                         'page_size'])
 
 
 def expect_field(data, context, name, t):
@@ -22,6 +93,25 @@ def expect_field(data, context, name, t):
         return data[name]
 
 
+def expect_duration(data, context, name):
+    if name in data:
+        if expect_field(data, context, name, (int, float)) <= 0:
+            logging.error('Expected positive duration for %s in %s',
+                          name, context)
+            exit(1)
+
+
+def expect_known_fields(data, context, cls):
+    unknown = sorted(set(data) - set(inspect.signature(cls).parameters))
+    if unknown:
+        logging.error('Unknown fields %s in %s', ', '.join(unknown), context)
+        exit(1)
+
+
+def module_settings(module):
+    return {k: v for k, v in module.items() if k != 'targets'}
+
+
 class YubiHSMConfiguration:
 
     @property
@@ -52,9 +142,71 @@ class YubiHSMConfiguration:
     def encryption_key_label(self):
         return self.__encryption_key_label
 
+    @property
+    def connect_timeout(self):
+        return self.__connect_timeout
+
+    @property
+    def read_timeout(self):
+        return self.__read_timeout
+
+    @property
+    def probe_deadline(self):
+        return self.__probe_deadline
+
+    @property
+    def probe_interval(self):
+        return self.__probe_interval
+
+    @property
+    def probe_jitter(self):
+        return self.__probe_jitter
+
+    @property
+    def max_backoff(self):
+        return self.__max_backoff
+
+    @property
+    def benchmark_operations(self):
+        return self.__benchmark_operations
+
+    @property
+    def benchmark_sign(self):
+        return self.__benchmark_sign
+
+    @property
+    def random_test_secret(self):
+        return self.__random_test_secret
+
+    @property
+    def get_logs_every(self):
+        return self.__get_logs_every
+
+    @property
+    def crypto_test_every(self):
+        return self.__crypto_test_every
+
+    @property
+    def crypto_benchmark_every(self):
+        return self.__crypto_benchmark_every
+
+    @property
+    def inventory_every(self):
+        return self.__inventory_every
+
     def __init__(self, url, application_key_id=None, application_key_pin_path='',
                  audit_key_id=None, audit_key_pin_path='', name='',
-                 encryption_key_label=None):
+                 encryption_key_label=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 probe_deadline=DEFAULT_PROBE_DEADLINE,
+                 probe_interval=SLEEP_TIME_BETWEEN_PROBES,
+                 probe_jitter=DEFAULT_PROBE_JITTER,
+                 max_backoff=DEFAULT_MAX_BACKOFF,
+                 benchmark_operations=0, benchmark_sign=False,
+                 random_test_secret=False, get_logs_every=1,
+                 crypto_test_every=1, crypto_benchmark_every=1,
+                 inventory_every=0):
         self.__url = url
         self.__application_key_id = application_key_id
         self.__application_key_pin_path = application_key_pin_path
@@ -62,9 +214,23 @@ class YubiHSMConfiguration:
         self.__audit_key_pin_path = audit_key_pin_path
         self.__name = name
         self.__encryption_key_label = encryption_key_label
+        self.__connect_timeout = connect_timeout
+        self.__read_timeout = read_timeout
+        self.__probe_deadline = probe_deadline
+        self.__probe_interval = probe_interval
+        self.__probe_jitter = probe_jitter
+        self.__max_backoff = max_backoff
+        self.__benchmark_operations = benchmark_operations
+        self.__benchmark_sign = benchmark_sign
+        self.__random_test_secret = random_test_secret
+        self.__get_logs_every = get_logs_every
+        self.__crypto_test_every = crypto_test_every
+        self.__crypto_benchmark_every = crypto_benchmark_every
+        self.__inventory_every = inventory_every
 
     @staticmethod
     def load_config(data):
+        expect_known_fields(data, 'connectors', YubiHSMConfiguration)
         expect_field(data, 'connectors', 'url', str)
         if 'application_key_id' in data:
             expect_field(data, 'connectors', 'application_key_id', int)
@@ -73,14 +239,144 @@ class YubiHSMConfiguration:
         if 'audit_key_id' in data:
             expect_field(data, 'connectors', 'audit_key_id', int)
             expect_field(data, 'connectors', 'audit_key_pin_path', str)
+        for duration in ('connect_timeout', 'read_timeout', 'probe_deadline',
+                         'probe_interval', 'max_backoff'):
+            expect_duration(data, 'connectors', duration)
+        if 'probe_jitter' in data:
+            if not 0 <= expect_field(data, 'connectors', 'probe_jitter',
+                                     (int, float)) < 1:
+                logging.error('Expected probe_jitter between 0 and 1')
+                exit(1)
+        if 'benchmark_operations' in data:
+            if expect_field(data, 'connectors', 'benchmark_operations', int) < 0:
+                logging.error('Expected non-negative benchmark_operations')
+                exit(1)
+            if data['benchmark_operations']:
+                expect_field(data, 'connectors', 'application_key_id', int)
+        if 'benchmark_sign' in data:
+            expect_field(data, 'connectors', 'benchmark_sign', bool)
+        if 'random_test_secret' in data:
+            expect_field(data, 'connectors', 'random_test_secret', bool)
+        for every in ('get_logs_every', 'crypto_test_every',
+                      'crypto_benchmark_every'):
+            if every in data:
+                if expect_field(data, 'connectors', every, int) < 1:
+                    logging.error('Expected positive %s', every)
+                    exit(1)
+        if 'inventory_every' in data:
+            if expect_field(data, 'connectors', 'inventory_every', int) < 0:
+                logging.error('Expected non-negative inventory_every')
+                exit(1)
         return YubiHSMConfiguration(**data)
 
+    def __eq__(self, other):
+        return (isinstance(other, YubiHSMConfiguration)
+                and vars(self) == vars(other))
+
+    def __hash__(self):
+        return hash((self.__url, self.__name))
+
+
+class AuditLogSinkConfiguration:
+
+    @property
+    def type(self):
+        return self.__type
+
+    @property
+    def path(self):
+        return self.__path
+
+    @property
+    def max_bytes(self):
+        return self.__max_bytes
+
+    @property
+    def backup_count(self):
+        return self.__backup_count
+
+    @property
+    def address(self):
+        return self.__address
+
+    @property
+    def batch_size(self):
+        return self.__batch_size
+
+    @property
+    def flush_interval(self):
+        return self.__flush_interval
+
+    @property
+    def queue_size(self):
+        return self.__queue_size
+
+    def __init__(self, type, path=None, max_bytes=10 * 1024 * 1024,
+                 backup_count=5, address='localhost:514', batch_size=100,
+                 flush_interval=1, queue_size=10000):
+        self.__type = type
+        self.__path = path
+        self.__max_bytes = max_bytes
+        self.__backup_count = backup_count
+        self.__address = address
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__queue_size = queue_size
+
+    @staticmethod
+    def load_config(data):
+        expect_known_fields(data, 'audit_log_sink', AuditLogSinkConfiguration)
+        sink_type = expect_field(data, 'audit_log_sink', 'type', str)
+        if sink_type not in AUDIT_LOG_SINK_TYPES:
+            logging.error('Unknown audit log sink type %s', sink_type)
+            exit(1)
+        if sink_type == 'file':
+            expect_field(data, 'audit_log_sink', 'path', str)
+        if 'address' in data:
+            host, _, port = expect_field(data, 'audit_log_sink', 'address',
+                                         str).rpartition(':')
+            if not host or not port.isdigit() or not 0 < int(port) < 65536:
+                logging.error('Expected host:port as address in audit_log_sink')
+                exit(1)
+        for count in ('max_bytes', 'batch_size', 'queue_size'):
+            if count in data:
+                if expect_field(data, 'audit_log_sink', count, int) < 1:
+                    logging.error('Expected positive %s in audit_log_sink',
+                                  count)
+                    exit(1)
+        if 'backup_count' in data:
+            if expect_field(data, 'audit_log_sink', 'backup_count', int) < 0:
+                logging.error('Expected non-negative backup_count')
+                exit(1)
+        expect_duration(data, 'audit_log_sink', 'flush_interval')
+        return AuditLogSinkConfiguration(**data)
+
+    def __eq__(self, other):
+        return (isinstance(other, AuditLogSinkConfiguration)
+                and vars(self) == vars(other))
+
 
 class Configuration:
 
-    def __init__(self, connectors, metrics_port):
+    def __init__(self, connectors, metrics_port,
+                 probe_workers=DEFAULT_PROBE_WORKERS,
+                 histogram_buckets=prometheus_client.Histogram.DEFAULT_BUCKETS,
+                 collection_mode=COLLECTION_MODE_BACKGROUND,
+                 scrape_cache_ttl=DEFAULT_SCRAPE_CACHE_TTL,
+                 scrape_deadline=DEFAULT_SCRAPE_DEADLINE,
+                 audit_log_sink=None, audit_log_cursor_path=None,
+                 transport=TRANSPORT_REQUESTS, modules=None):
         self.__connectors = connectors
         self.__metrics_port = metrics_port
+        self.__probe_workers = probe_workers
+        self.__histogram_buckets = histogram_buckets
+        self.__collection_mode = collection_mode
+        self.__scrape_cache_ttl = scrape_cache_ttl
+        self.__scrape_deadline = scrape_deadline
+        self.__audit_log_sink = audit_log_sink
+        self.__audit_log_cursor_path = audit_log_cursor_path
+        self.__transport = transport
+        self.__modules = modules or {}
 
     @property
     def connectors(self):
@@ -90,13 +386,118 @@ class Configuration:
     def metrics_port(self):
         return self.__metrics_port
 
+    @property
+    def probe_workers(self):
+        return self.__probe_workers
+
+    @property
+    def histogram_buckets(self):
+        return self.__histogram_buckets
+
+    @property
+    def collection_mode(self):
+        return self.__collection_mode
+
+    @property
+    def scrape_cache_ttl(self):
+        return self.__scrape_cache_ttl
+
+    @property
+    def scrape_deadline(self):
+        return self.__scrape_deadline
+
+    @property
+    def audit_log_sink(self):
+        return self.__audit_log_sink
+
+    @property
+    def audit_log_cursor_path(self):
+        return self.__audit_log_cursor_path
+
+    @property
+    def transport(self):
+        return self.__transport
+
+    @property
+    def modules(self):
+        return self.__modules
+
     @staticmethod
     def load_config(data):
         connectors = expect_field(data, '""', 'connectors', list)
+        if 'probe_workers' in data:
+            if expect_field(data, '""', 'probe_workers', int) < 1:
+                logging.error('Expected at least one probe worker')
+                exit(1)
+        if 'histogram_buckets' in data:
+            buckets = expect_field(data, '""', 'histogram_buckets', list)
+            if (not buckets or
+                    not all(isinstance(b, (int, float)) for b in buckets) or
+                    sorted(buckets) != buckets):
+                logging.error('Expected sorted list of numbers as histogram_buckets')
+                exit(1)
+        if 'collection_mode' in data:
+            mode = expect_field(data, '""', 'collection_mode', str)
+            if mode not in (COLLECTION_MODE_BACKGROUND, COLLECTION_MODE_SCRAPE):
+                logging.error('Unknown collection_mode %s', mode)
+                exit(1)
+        if 'scrape_cache_ttl' in data:
+            if expect_field(data, '""', 'scrape_cache_ttl', (int, float)) < 0:
+                logging.error('Expected non-negative scrape_cache_ttl')
+                exit(1)
+        expect_duration(data, '""', 'scrape_deadline')
+        audit_log_sink = None
+        if 'audit_log_sink' in data:
+            audit_log_sink = AuditLogSinkConfiguration.load_config(
+                    expect_field(data, '""', 'audit_log_sink', dict))
+        if 'audit_log_cursor_path' in data:
+            expect_field(data, '""', 'audit_log_cursor_path', str)
+        if 'transport' in data:
+            transport = expect_field(data, '""', 'transport', str)
+            if transport not in (TRANSPORT_REQUESTS, TRANSPORT_ASYNCIO):
+                logging.error('Unknown transport %s', transport)
+                exit(1)
+        if 'modules' in data:
+            for name, module in expect_field(data, '""', 'modules', dict).items():
+                if not isinstance(module, dict) or 'url' in module:
+                    logging.error('Expected connector settings without url '
+                                  'as module %s', name)
+                    exit(1)
+                if 'targets' in module:
+                    targets = expect_field(module, 'modules', 'targets', list)
+                    if not all(isinstance(t, str) for t in targets):
+                        logging.error('Expected URLs as targets of module %s',
+                                      name)
+                        exit(1)
+                YubiHSMConfiguration.load_config(
+                        module_settings(module) | {'url': ''})
         return Configuration(
                 connectors=[YubiHSMConfiguration.load_config(c)
                             for c in connectors],
-                metrics_port=data.get('metrics_port', 8080))
+                metrics_port=data.get('metrics_port', 8080),
+                probe_workers=data.get('probe_workers', DEFAULT_PROBE_WORKERS),
+                histogram_buckets=data.get(
+                    'histogram_buckets',
+                    prometheus_client.Histogram.DEFAULT_BUCKETS),
+                collection_mode=data.get(
+                    'collection_mode', COLLECTION_MODE_BACKGROUND),
+                scrape_cache_ttl=data.get(
+                    'scrape_cache_ttl', DEFAULT_SCRAPE_CACHE_TTL),
+                scrape_deadline=data.get(
+                    'scrape_deadline', DEFAULT_SCRAPE_DEADLINE),
+                audit_log_sink=audit_log_sink,
+                audit_log_cursor_path=data.get('audit_log_cursor_path'),
+                transport=data.get('transport', TRANSPORT_REQUESTS),
+                modules=data.get('modules'))
+
+    def restart_required(self, other):
+        # Only the connectors and modules can be reloaded while running
+        settings = lambda c: (c.metrics_port, c.probe_workers,
+                              c.histogram_buckets, c.collection_mode,
+                              c.scrape_cache_ttl, c.scrape_deadline,
+                              c.audit_log_sink, c.audit_log_cursor_path,
+                              c.transport)
+        return settings(self) != settings(other)
 
 
 def load_configuration(path):
@@ -105,59 +506,685 @@ def load_configuration(path):
         return Configuration.load_config(data)
 
 
+class Shard:
+
+    def __init__(self, index=0, count=1):
+        self.__index = index
+        self.__count = count
+
+    @property
+    def index(self):
+        return self.__index
+
+    @property
+    def count(self):
+        return self.__count
+
+    @staticmethod
+    def __parse(name, value):
+        try:
+            return int(value)
+        except ValueError:
+            logging.error('Expected an integer for %s, got %s', name, value)
+            exit(1)
+
+    @staticmethod
+    def from_environment(environ=os.environ):
+        if not environ.get(SHARD_COUNT_VARIABLE):
+            return Shard()
+        count = Shard.__parse(SHARD_COUNT_VARIABLE,
+                              environ[SHARD_COUNT_VARIABLE])
+        if environ.get(SHARD_INDEX_VARIABLE):
+            index = Shard.__parse(SHARD_INDEX_VARIABLE,
+                                  environ[SHARD_INDEX_VARIABLE])
+        else:
+            # Pods of a StatefulSet are named <name>-<ordinal>
+            ordinal = re.search(r'-(\d+)$', environ.get('HOSTNAME', ''))
+            if not ordinal:
+                logging.error('Set %s or run with a host name ending in an '
+                              'ordinal', SHARD_INDEX_VARIABLE)
+                exit(1)
+            index = int(ordinal.group(1))
+        if count < 1 or not 0 <= index < count:
+            logging.error('Invalid shard %d of %d', index, count)
+            exit(1)
+        return Shard(index, count)
+
+    def owner(self, connector):
+        # Rendezvous hashing moves only the connectors of added or removed
+        # shards, when the shard count changes
+        key = ('%s\0%s' % (connector.url, connector.name)).encode('utf8')
+        return max(range(self.__count), key=lambda shard: hashlib.sha256(
+                b'%d\0%s' % (shard, key)).digest())
+
+    def owns(self, connector):
+        return self.__count == 1 or self.owner(connector) == self.__index
+
+    def select(self, connectors):
+        return [c for c in connectors if self.owns(c)]
+
+
 def version_to_string(version):
     return '%d.%d.%d' % version
 
 
+def command_name(command):
+    try:
+        return yubihsm.defs.COMMAND(command).name
+    except ValueError:
+        return 'UNKNOWN_0x%02x' % command
+
+
+def enum_label(enum, value):
+    try:
+        return enum(value).name.lower()
+    except ValueError:
+        return 'unknown_0x%02x' % value
+
+
+def get_storage_info(session):
+    data = session.send_secure_cmd(yubihsm.defs.COMMAND.GET_STORAGE_INFO)
+    try:
+        return StorageInfo(*struct.unpack('!HHHHH', data))
+    except struct.error:
+        raise yubihsm.exceptions.YubiHsmInvalidResponseError()
+
+
+def get_log_entries(session):
+    # Like AuthSession.get_log_entries(), but keeps a broken digest chain
+    data = session.send_secure_cmd(yubihsm.defs.COMMAND.GET_LOG_ENTRIES)
+    length = yubihsm.core.LogEntry.LENGTH
+    try:
+        n_boot, n_auth, count = struct.unpack('!HHB', data[:5])
+    except struct.error:
+        raise yubihsm.exceptions.YubiHsmInvalidResponseError()
+    if len(data) - 5 != count * length:
+        raise yubihsm.exceptions.YubiHsmInvalidResponseError('Incorrect length')
+    return yubihsm.core.LogData(
+            n_boot, n_auth, [yubihsm.core.LogEntry.parse(data[i:i + length])
+                             for i in range(5, len(data), length)])
+
+
+class PinFileError(yubihsm.exceptions.YubiHsmError):
+    pass
+
+
 def load_pin(path):
     try:
         with open(path) as file:
             return file.read().rstrip()
     except IOError as e:
-        logging.error('Failed to read file %s: %s', path, e)
-        exit(1)
+        # Only fails the tests using the key, not the whole exporter
+        raise PinFileError('Failed to read file %s: %s' % (path, e)) from e
+
+
+class ProbeTimeoutError(yubihsm.exceptions.YubiHsmConnectionError):
+    pass
+
+
+class Deadline:
+
+    def __init__(self, seconds=None):
+        self.__expiry = None
+        if seconds is not None:
+            self.reset(seconds)
+
+    def reset(self, seconds):
+        self.__expiry = time.monotonic() + seconds
+
+    def remaining(self):
+        if self.__expiry is None:
+            return None
+        return self.__expiry - time.monotonic()
+
+
+def request_timeouts(deadline, connect_timeout, read_timeout):
+    remaining = deadline.remaining() if deadline else None
+    if remaining is None:
+        return connect_timeout, read_timeout
+    if remaining <= 0:
+        raise ProbeTimeoutError('Probe deadline exceeded')
+    return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+
+class HttpConnectorBackend:
+
+    def __init__(self, url, connect_timeout, read_timeout, deadline=None):
+        self.__url = urllib.parse.urljoin(url, 'connector/api')
+        self.__connect_timeout = connect_timeout
+        self.__read_timeout = read_timeout
+        self.__deadline = deadline
+        self.__session = requests.Session()
+        self.__session.headers.update(
+                {'Content-Type': 'application/octet-stream'})
+
+    def transceive(self, msg):
+        timeouts = request_timeouts(self.__deadline, self.__connect_timeout,
+                                    self.__read_timeout)
+        try:
+            response = self.__session.post(
+                    url=self.__url, data=msg, timeout=timeouts)
+            response.raise_for_status()
+            return response.content
+        except requests.exceptions.ReadTimeout as e:
+            # The connector accepted the request, but the device is too slow
+            raise ProbeTimeoutError(e)
+        except requests.exceptions.RequestException as e:
+            raise yubihsm.exceptions.YubiHsmConnectionError(e)
+
+    def close(self):
+        self.__session.close()
+
+    def __repr__(self):
+        return 'HttpConnectorBackend("%s")' % self.__url
+
+
+class EventLoopThread:
+
+    def __init__(self):
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(
+                target=self.__loop.run_forever, name='yubihsm-event-loop',
+                daemon=True)
+        self.__thread.start()
+
+    @property
+    def loop(self):
+        return self.__loop
+
+    @property
+    def alive(self):
+        return self.__thread.is_alive()
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop)
+
+    def run(self, coroutine):
+        # Must not be called from the event loop itself
+        return self.submit(coroutine).result()
+
+    def close(self):
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+
+
+class AsyncConnectorTransport:
+
+    def __init__(self, event_loop, keepalive_connections=DEFAULT_KEEPALIVE_CONNECTIONS):
+        self.__event_loop = event_loop
+        self.__keepalive_connections = keepalive_connections
+        self.__idle = {}
+        self.__opened = 0
+
+    @property
+    def opened_connections(self):
+        return self.__opened
+
+    @property
+    def idle_connections(self):
+        return sum(len(c) for c in self.__idle.values())
+
+    def post(self, url, data, connect_timeout, read_timeout):
+        return self.__event_loop.run(
+                self.__post(url, data, connect_timeout, read_timeout))
+
+    async def __connect(self, address, connect_timeout):
+        idle = self.__idle.get(address)
+        if idle:
+            return idle.pop(), True
+        host, port, tls = address
+        try:
+            connection = await asyncio.wait_for(
+                    asyncio.open_connection(host, port, ssl=tls or None),
+                    connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise yubihsm.exceptions.YubiHsmConnectionError(
+                    'Failed to connect to %s:%d: %s' % (host, port, e))
+        self.__opened += 1
+        return connection, False
+
+    def __release(self, address, connection):
+        idle = self.__idle.setdefault(address, [])
+        if len(idle) < self.__keepalive_connections:
+            idle.append(connection)
+        else:
+            connection[1].close()
+
+    async def __post(self, url, data, connect_timeout, read_timeout):
+        parts = urllib.parse.urlsplit(url)
+        tls = parts.scheme == 'https'
+        address = (parts.hostname, parts.port or (443 if tls else 80), tls)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request = (('POST %s HTTP/1.1\r\nHost: %s\r\n'
+                    'Content-Type: application/octet-stream\r\n'
+                    'Content-Length: %d\r\n\r\n') % (
+                            path, parts.netloc, len(data))).encode('ascii') + data
+        while True:
+            connection, reused = await self.__connect(address, connect_timeout)
+            reader, writer = connection
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, keep_alive, body = await asyncio.wait_for(
+                        self.__read_response(reader), read_timeout)
+                break
+            except asyncio.TimeoutError:
+                writer.close()
+                # The connector accepted the request, but the device is too slow
+                raise ProbeTimeoutError('No response from %s within %s seconds'
+                                        % (url, read_timeout))
+            except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                writer.close()
+                if not reused:
+                    raise yubihsm.exceptions.YubiHsmConnectionError(
+                            'Request to %s failed: %s' % (url, e))
+                # The connector closed the idle connection, retry with a new one
+        if keep_alive:
+            self.__release(address, connection)
+        else:
+            writer.close()
+        if status >= 400:
+            raise yubihsm.exceptions.YubiHsmConnectionError(
+                    'Connector %s answered with HTTP %d' % (url, status))
+        return body
+
+    @staticmethod
+    async def __read_response(reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b'', None)
+        version, status = status_line.split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if not size:
+                    break
+                body += chunk[:-2]
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            return int(status), False, await reader.read()
+        keep_alive = (headers.get('connection', '').lower() != 'close' and
+                      version == b'HTTP/1.1')
+        return int(status), keep_alive, body
+
+    async def __close(self):
+        for idle in self.__idle.values():
+            for reader, writer in idle:
+                writer.close()
+        self.__idle.clear()
+
+    def close(self):
+        self.__event_loop.run(self.__close())
+
+
+class AsyncHttpConnectorBackend:
+
+    def __init__(self, url, connect_timeout, read_timeout, transport,
+                 deadline=None):
+        self.__url = urllib.parse.urljoin(url, 'connector/api')
+        self.__connect_timeout = connect_timeout
+        self.__read_timeout = read_timeout
+        self.__transport = transport
+        self.__deadline = deadline
+
+    def transceive(self, msg):
+        connect_timeout, read_timeout = request_timeouts(
+                self.__deadline, self.__connect_timeout, self.__read_timeout)
+        return self.__transport.post(self.__url, msg, connect_timeout,
+                                     read_timeout)
+
+    def close(self):
+        # The connections belong to the shared transport
+        pass
+
+    def __repr__(self):
+        return 'AsyncHttpConnectorBackend("%s")' % self.__url
+
+
+def connect_hsm(config, deadline, transport=None):
+    if urllib.parse.urlparse(config.url).scheme not in ('http', 'https'):
+        return yubihsm.YubiHsm.connect(config.url)
+    if transport:
+        return yubihsm.YubiHsm(AsyncHttpConnectorBackend(
+                config.url, config.connect_timeout, config.read_timeout,
+                transport, deadline))
+    return yubihsm.YubiHsm(HttpConnectorBackend(
+            config.url, config.connect_timeout, config.read_timeout,
+            deadline))
+
+
+class SessionPool:
+
+    def __init__(self, config, metrics, labels, credentials, transport=None):
+        self.__config = config
+        self.__transport = transport
+        self.__metrics = metrics
+        self.__labels = labels
+        self.__credentials = credentials
+        self.__deadline = Deadline()
+        self.__hsm = None
+        self.__sessions = {}
+
+    @property
+    def deadline(self):
+        return self.__deadline
+
+    @property
+    def hsm(self):
+        if self.__hsm is None:
+            self.__hsm = connect_hsm(self.__config, self.__deadline,
+                                     self.__transport)
+        return self.__hsm
+
+    def __update_open_sessions(self):
+        self.__metrics.open_sessions.labels(**self.__labels).set(
+                len(self.__sessions))
+
+    def __count_session(self, origin):
+        self.__metrics.sessions.labels(
+                **(self.__labels | {'origin': origin})).inc()
+
+    def __create(self, key_id, pin_path, phase):
+        with self.__metrics.phase_duration.labels(
+                **(self.__labels | {'phase': phase})).time():
+            self.__sessions[key_id] = self.hsm.create_session(
+                    key_id, *self.__credentials.get(key_id, pin_path))
+        self.__count_session('created')
+        self.__update_open_sessions()
+
+    def __discard(self, key_id):
+        del self.__sessions[key_id]
+        self.__update_open_sessions()
+
+    def __run(self, key_id, operation):
+        try:
+            return operation(self.__sessions[key_id])
+        except yubihsm.exceptions.YubiHsmError:
+            # The session's message counters might be out of sync now
+            self.__discard(key_id)
+            raise
+
+    def run(self, key_id, pin_path, phase, operation):
+        if key_id in self.__sessions:
+            self.__count_session('reused')
+            try:
+                return self.__run(key_id, operation)
+            except yubihsm.exceptions.YubiHsmDeviceError as e:
+                # Most likely the session expired on the device
+                logging.info('Re-authenticate key %d on %s after %s: %s',
+                             key_id, self.__config.url, type(e).__name__, e)
+        self.__create(key_id, pin_path, phase)
+        return self.__run(key_id, operation)
+
+    def reset(self):
+        self.__sessions.clear()
+        self.__update_open_sessions()
+        if self.__hsm is not None:
+            self.__hsm.close()
+            self.__hsm = None
+
+    def close(self):
+        self.__deadline.reset(self.__config.read_timeout)
+        for session in self.__sessions.values():
+            try:
+                session.close()
+            except yubihsm.exceptions.YubiHsmError as e:
+                logging.warning('Failed to close session on %s: %s',
+                                self.__config.url, e)
+        self.reset()
+
+
+class CredentialCache:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__credentials = {}
+
+    def get(self, key_id, pin_path):
+        try:
+            mtime = os.stat(pin_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self.__lock:
+            cached = self.__credentials.get((key_id, pin_path))
+            if mtime is not None and cached and cached[0] == mtime:
+                return cached[1]
+            logging.info('Derive keys for authentication key %d from %s',
+                         key_id, pin_path)
+            keys = yubihsm.utils.password_to_key(load_pin(pin_path))
+            self.__credentials[(key_id, pin_path)] = (mtime, keys)
+            return keys
 
 
 class TestSecret:
 
     DEFAULT_SECRET='🐸'
+    RANDOM_SECRET_BYTES=16
 
-    def __init__(self, secret=DEFAULT_SECRET):
-        self.__secret = secret.encode('utf8')
+    def __init__(self, secret=DEFAULT_SECRET, randomize=False):
+        self.__lock = threading.Lock()
+        self.__expected = secret.encode('utf8')
+        self.__secret = self.__expected
         self.__encrypted = False
+        self.__randomize = randomize
 
     @property
     def secret(self):
-        return self.__secret.decode('utf8') if not self.__encrypted else self.__secret.hex()
+        with self.__lock:
+            return self.__display(self.__secret)
+
+    @property
+    def expected(self):
+        with self.__lock:
+            return self.__display(self.__expected)
+
+    def __display(self, secret):
+        if self.__encrypted:
+            return secret.hex()
+        return secret.decode('utf8', errors='replace')
 
     def get(self):
-        return self.secret, self.__encrypted
+        with self.__lock:
+            return self.__display(self.__secret), self.__encrypted
 
     def process(self, encrypt, decrypt):
-        if self.__encrypted:
-            self.__secret = decrypt(self.__secret)
-        else:
-            self.__secret = encrypt(self.__secret)
-        self.__encrypted = not self.__encrypted
+        with self.__lock:
+            if self.__encrypted:
+                self.__secret = decrypt(self.__secret)
+            else:
+                if self.__randomize:
+                    # A fresh secret per cycle, so no ciphertext gets replayed
+                    self.__expected = os.urandom(
+                            self.RANDOM_SECRET_BYTES).hex().encode('utf8')
+                self.__secret = encrypt(self.__expected)
+            self.__encrypted = not self.__encrypted
+            return self.__encrypted or self.__secret == self.__expected
 
 
 class Metrics:
 
-    def __init__(self):
+    def __init__(self, buckets=prometheus_client.Histogram.DEFAULT_BUCKETS,
+                 registry=prometheus_client.REGISTRY, exporter_registry=None):
         labels=["url", "name"]
+        # The metrics of the exporter itself may change without any probe
+        exporter_registry = exporter_registry or registry
+        self.__changes = itertools.count()
+        self.__generation = next(self.__changes)
         self.__info = prometheus_client.Info(
-                'yubihsm_device', 'Information about YubiHSM2 device', labels)
+                'yubihsm_device', 'Information about YubiHSM2 device', labels,
+                registry=registry)
         self.__log_size = prometheus_client.Gauge(
-                'yubihsm_log_size', 'Number of log entry in YubiHSM', labels)
+                'yubihsm_log_size', 'Number of log entry in YubiHSM', labels,
+                registry=registry)
         self.__used_log_entries = prometheus_client.Gauge(
                 'yubihsm_used_log_entries', 'Number of used log entries in YubiHSM',
-                labels)
+                labels, registry=registry)
         self.__test_connections = prometheus_client.Counter(
                 'yubihsm_test_connections', 'Number test connections to YubiHSM',
-                labels)
+                labels, registry=registry)
         self.__test_errors = prometheus_client.Counter(
                 'yubihsm_test_errors', 'Number of failed YubiHSM test runs',
-                labels + ['error'])
+                labels + ['error'], registry=registry)
+        self.__phase_duration = prometheus_client.Histogram(
+                'yubihsm_probe_phase_duration_seconds',
+                'Duration of the phases of a YubiHSM probe',
+                labels + ['phase'], buckets=buckets, registry=registry)
+        self.__sessions = prometheus_client.Counter(
+                'yubihsm_sessions',
+                'Number of authenticated sessions used for YubiHSM tests',
+                labels + ['origin'], registry=registry)
+        self.__open_sessions = prometheus_client.Gauge(
+                'yubihsm_exporter_open_sessions',
+                'Number of authenticated sessions kept open by the exporter',
+                labels, registry=registry)
+        self.__audit_log_exported_entries = prometheus_client.Counter(
+                'yubihsm_audit_log_exported_entries',
+                'Number of audit log entries written to the audit log sink',
+                registry=registry)
+        self.__audit_log_dropped_entries = prometheus_client.Counter(
+                'yubihsm_audit_log_dropped_entries',
+                'Number of audit log entries lost due to a full queue or '
+                'a failing audit log sink', registry=registry)
+        self.__audit_log_written_bytes = prometheus_client.Counter(
+                'yubihsm_audit_log_written_bytes',
+                'Number of bytes written to the audit log sink',
+                registry=registry)
+        self.__audit_log_queue_depth = prometheus_client.Gauge(
+                'yubihsm_audit_log_queue_depth',
+                'Number of audit log entries waiting for the audit log sink',
+                registry=registry)
+        self.__audit_log_last_number = prometheus_client.Gauge(
+                'yubihsm_audit_log_last_number',
+                'Number of the last retrieved audit log entry', labels,
+                registry=registry)
+        self.__primary = prometheus_client.Gauge(
+                'yubihsm_device_primary',
+                'Whether the connector runs the authenticated tests of its '
+                'YubiHSM (1) or shares them with another connector (0)',
+                labels, registry=registry)
+        self.__audit_log_time_to_full = prometheus_client.Gauge(
+                'yubihsm_audit_log_time_to_full_seconds',
+                'Predicted time until the audit log of the YubiHSM is full',
+                labels, registry=registry)
+        self.__audit_log_chain_errors = prometheus_client.Counter(
+                'yubihsm_audit_log_chain_errors',
+                'Number of gaps and broken digests in the audit log chain',
+                labels + ['type'], registry=registry)
+        self.__audit_commands = prometheus_client.Counter(
+                'yubihsm_audit_commands',
+                'Number of commands in the audit log of the YubiHSM',
+                labels + ['command', 'result'], registry=registry)
+        self.__audit_key_usage = prometheus_client.Counter(
+                'yubihsm_audit_key_usage',
+                'Number of commands in the audit log of the YubiHSM by the '
+                'authentication key of the session or the target key',
+                labels + ['role', 'key'], registry=registry)
+        self.__crypto_operation_duration = prometheus_client.Histogram(
+                'yubihsm_crypto_operation_duration_seconds',
+                'Duration of single cryptographic operations in the benchmark',
+                labels + ['operation'], buckets=buckets, registry=registry)
+        self.__crypto_operations_per_second = prometheus_client.Gauge(
+                'yubihsm_crypto_operations_per_second',
+                'Throughput of cryptographic operations in the last benchmark',
+                labels + ['operation'], registry=registry)
+        self.__key_cache_lookups = prometheus_client.Counter(
+                'yubihsm_key_cache_lookups',
+                'Number of encryption key lookups answered from the cache (hit) '
+                'or by the YubiHSM (miss)', labels + ['result'],
+                registry=registry)
+        self.__shard = prometheus_client.Info(
+                'yubihsm_exporter_shard',
+                'Shard of the connectors probed by this exporter instance',
+                registry=registry)
+        self.__shard_connectors = prometheus_client.Gauge(
+                'yubihsm_exporter_shard_connectors',
+                'Number of connectors probed by this exporter instance',
+                registry=registry)
+        self.__up = prometheus_client.Gauge(
+                'yubihsm_up',
+                'Whether the last probe of the YubiHSM passed all tests',
+                labels, registry=registry)
+        self.__last_success = prometheus_client.Gauge(
+                'yubihsm_last_success_timestamp_seconds',
+                'Unix time of the last successful YubiHSM test',
+                labels + ['test'], registry=registry)
+        self.__objects = prometheus_client.Gauge(
+                'yubihsm_objects', 'Number of objects stored in the YubiHSM',
+                labels + ['type', 'algorithm'], registry=registry)
+        self.__storage_records = prometheus_client.Gauge(
+                'yubihsm_storage_records',
+                'Number of object records of the YubiHSM', labels,
+                registry=registry)
+        self.__storage_free_records = prometheus_client.Gauge(
+                'yubihsm_storage_free_records',
+                'Number of free object records of the YubiHSM', labels,
+                registry=registry)
+        self.__storage_pages = prometheus_client.Gauge(
+                'yubihsm_storage_pages',
+                'Number of storage pages of the YubiHSM', labels,
+                registry=registry)
+        self.__storage_free_pages = prometheus_client.Gauge(
+                'yubihsm_storage_free_pages',
+                'Number of free storage pages of the YubiHSM', labels,
+                registry=registry)
+        self.__probe_cpu_seconds = prometheus_client.Counter(
+                'yubihsm_probe_cpu_seconds',
+                'CPU time spent by the exporter in probes of the YubiHSM',
+                labels, registry=registry)
+        self.__sweep_duration = prometheus_client.Histogram(
+                'yubihsm_exporter_sweep_duration_seconds',
+                'Duration of probing all connectors on a scrape',
+                buckets=buckets, registry=exporter_registry)
+        self.__probe_start_lag = prometheus_client.Histogram(
+                'yubihsm_exporter_probe_start_lag_seconds',
+                'Delay between the scheduled and the actual start of probes',
+                buckets=buckets, registry=exporter_registry)
+        self.__probes_in_flight = prometheus_client.Gauge(
+                'yubihsm_exporter_probes_in_flight',
+                'Number of currently running probes',
+                registry=exporter_registry)
+        self.__exposition_render_duration = prometheus_client.Histogram(
+                'yubihsm_exporter_exposition_render_duration_seconds',
+                'Duration of rendering the metrics for the metrics endpoint',
+                buckets=buckets, registry=exporter_registry)
+        self.__exposition_requests = prometheus_client.Counter(
+                'yubihsm_exporter_exposition_requests',
+                'Number of requests to the metrics endpoint answered from the '
+                'cache (hit) or by rendering the metrics (miss)', ['cache'],
+                registry=exporter_registry)
+        self.__connector_metrics = [
+                m for m in vars(self).values()
+                if isinstance(m, prometheus_client.metrics.MetricWrapperBase)
+                and m._labelnames[:2] == tuple(labels)]
+
+    @property
+    def generation(self):
+        return self.__generation
+
+    def changed(self):
+        # next() on a count is atomic, so concurrent probes need no lock
+        self.__generation = next(self.__changes)
+
+    def remove(self, url, name):
+        for metric in self.__connector_metrics:
+            # There is no public API to list the label sets of a metric
+            for values in list(metric._metrics):
+                if values[:2] == (url, name):
+                    metric.remove(*values)
+        self.changed()
 
     @property
     def info(self):
@@ -179,95 +1206,1513 @@ class Metrics:
     def test_errors(self):
         return self.__test_errors
 
+    @property
+    def phase_duration(self):
+        return self.__phase_duration
+
+    @property
+    def sessions(self):
+        return self.__sessions
+
+    @property
+    def open_sessions(self):
+        return self.__open_sessions
+
+    @property
+    def audit_log_exported_entries(self):
+        return self.__audit_log_exported_entries
+
+    @property
+    def audit_log_dropped_entries(self):
+        return self.__audit_log_dropped_entries
+
+    @property
+    def audit_log_written_bytes(self):
+        return self.__audit_log_written_bytes
+
+    @property
+    def audit_log_queue_depth(self):
+        return self.__audit_log_queue_depth
+
+    @property
+    def audit_log_last_number(self):
+        return self.__audit_log_last_number
+
+    @property
+    def primary(self):
+        return self.__primary
+
+    @property
+    def audit_log_time_to_full(self):
+        return self.__audit_log_time_to_full
+
+    @property
+    def audit_log_chain_errors(self):
+        return self.__audit_log_chain_errors
+
+    @property
+    def audit_commands(self):
+        return self.__audit_commands
+
+    @property
+    def audit_key_usage(self):
+        return self.__audit_key_usage
+
+    @property
+    def crypto_operation_duration(self):
+        return self.__crypto_operation_duration
+
+    @property
+    def crypto_operations_per_second(self):
+        return self.__crypto_operations_per_second
+
+    @property
+    def key_cache_lookups(self):
+        return self.__key_cache_lookups
+
+    @property
+    def shard(self):
+        return self.__shard
+
+    @property
+    def shard_connectors(self):
+        return self.__shard_connectors
+
+    @property
+    def up(self):
+        return self.__up
+
+    @property
+    def last_success(self):
+        return self.__last_success
+
+    @property
+    def objects(self):
+        return self.__objects
+
+    @property
+    def storage_records(self):
+        return self.__storage_records
+
+    @property
+    def storage_free_records(self):
+        return self.__storage_free_records
+
+    @property
+    def storage_pages(self):
+        return self.__storage_pages
+
+    @property
+    def storage_free_pages(self):
+        return self.__storage_free_pages
+
+    @property
+    def probe_cpu_seconds(self):
+        return self.__probe_cpu_seconds
+
+    @property
+    def sweep_duration(self):
+        return self.__sweep_duration
+
+    @property
+    def probe_start_lag(self):
+        return self.__probe_start_lag
+
+    @property
+    def probes_in_flight(self):
+        return self.__probes_in_flight
+
+    @property
+    def exposition_render_duration(self):
+        return self.__exposition_render_duration
+
+    @property
+    def exposition_requests(self):
+        return self.__exposition_requests
+
+
+class JsonLinesFileSink:
+
+    def __init__(self, path, max_bytes, backup_count):
+        self.__path = path
+        self.__max_bytes = max_bytes
+        self.__backup_count = backup_count
+        self.__file = open(path, 'ab')
+
+    def __rotate(self):
+        self.__file.close()
+        if self.__backup_count:
+            for i in range(self.__backup_count - 1, 0, -1):
+                if os.path.exists('%s.%d' % (self.__path, i)):
+                    os.replace('%s.%d' % (self.__path, i),
+                               '%s.%d' % (self.__path, i + 1))
+            os.replace(self.__path, self.__path + '.1')
+            self.__file = open(self.__path, 'ab')
+        else:
+            self.__file = open(self.__path, 'wb')
+
+    def write(self, lines):
+        data = b''.join(lines)
+        if (self.__file.tell() > 0 and
+                self.__file.tell() + len(data) > self.__max_bytes):
+            self.__rotate()
+        self.__file.write(data)
+        self.__file.flush()
+
+    def close(self):
+        self.__file.close()
+
+
+class StreamSink:
+
+    def __init__(self, stream):
+        self.__stream = stream
+
+    def write(self, lines):
+        self.__stream.write(b''.join(lines))
+        self.__stream.flush()
+
+    def close(self):
+        pass
+
+
+class SyslogSink:
+
+    def __init__(self, address):
+        host, _, port = address.rpartition(':')
+        self.__address = (host, int(port))
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def write(self, lines):
+        for line in lines:
+            self.__socket.sendto(
+                    b'<%d>yubihsm-exporter: %s' % (SYSLOG_PRIORITY, line),
+                    self.__address)
+
+    def close(self):
+        self.__socket.close()
+
+
+class AuditLogWriter:
+
+    def __init__(self, sink, metrics, batch_size, flush_interval, queue_size):
+        self.__sink = sink
+        self.__metrics = metrics
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__metrics.audit_log_queue_depth.set_function(self.__queue.qsize)
+        self.__thread = threading.Thread(
+                target=self.__run, name='audit-log-writer', daemon=True)
+        self.__thread.start()
+
+    @staticmethod
+    def create(config, metrics):
+        if config.type == 'file':
+            sink = JsonLinesFileSink(config.path, config.max_bytes,
+                                     config.backup_count)
+        elif config.type == 'syslog':
+            sink = SyslogSink(config.address)
+        else:
+            sink = StreamSink(sys.stdout.buffer)
+        return AuditLogWriter(sink, metrics, config.batch_size,
+                              config.flush_interval, config.queue_size)
+
+    def submit(self, records):
+        for record in records:
+            try:
+                self.__queue.put_nowait(record)
+            except queue.Full:
+                self.__metrics.audit_log_dropped_entries.inc()
+
+    def __flush(self, batch):
+        lines = [(json.dumps(record) + '\n').encode('utf8') for record in batch]
+        try:
+            self.__sink.write(lines)
+        except OSError as e:
+            logging.error('Failed to write %d audit log entries: %s',
+                          len(batch), e)
+            self.__metrics.audit_log_dropped_entries.inc(len(batch))
+            return
+        self.__metrics.audit_log_exported_entries.inc(len(batch))
+        self.__metrics.audit_log_written_bytes.inc(sum(map(len, lines)))
+        self.__metrics.changed()
+
+    def __run(self):
+        batch = []
+        flush_time = time.monotonic() + self.__flush_interval
+        stop = False
+        while not stop:
+            try:
+                record = self.__queue.get(
+                        timeout=max(flush_time - time.monotonic(), 0))
+                if record is None:
+                    stop = True
+                else:
+                    batch.append(record)
+            except queue.Empty:
+                pass
+            if batch and (stop or len(batch) >= self.__batch_size or
+                          time.monotonic() >= flush_time):
+                self.__flush(batch)
+                batch = []
+            if time.monotonic() >= flush_time:
+                flush_time = time.monotonic() + self.__flush_interval
+
+    def close(self):
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__sink.close()
+
+
+class AuditLogCursors:
+
+    def __init__(self, path=None):
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__cursors = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as cursor_file:
+                    self.__cursors = {
+                            serial: (cursor['number'],
+                                     bytes.fromhex(cursor['digest']))
+                            for serial, cursor in json.load(cursor_file).items()}
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.warning('Ignore invalid audit log cursors in %s: %s',
+                                path, e)
+
+    def get(self, serial):
+        with self.__lock:
+            cursor = self.__cursors.get(str(serial))
+        if cursor is None:
+            return None
+        number, digest = cursor
+        return yubihsm.core.LogEntry(number, 0, 0, 0, 0, 0, 0, 0, digest)
+
+    def update(self, serial, entry):
+        with self.__lock:
+            self.__cursors[str(serial)] = (entry.number, entry.digest)
+            if self.__path:
+                self.__save()
+
+    def __save(self):
+        data = {serial: dict(number=number, digest=digest.hex())
+                for serial, (number, digest) in self.__cursors.items()}
+        try:
+            with open(self.__path + '.tmp', 'w') as cursor_file:
+                json.dump(data, cursor_file)
+            os.replace(self.__path + '.tmp', self.__path)
+        except OSError as e:
+            logging.error('Failed to save audit log cursors to %s: %s',
+                          self.__path, e)
+
+
+class DeviceState:
+
+    def __init__(self):
+        # Only one probe at a time keeps sessions on the device
+        self.__lock = threading.Lock()
+        self.__owner = None
+        self.__last_success = {}
+        self.__passed = None
+
+    @property
+    def lock(self):
+        return self.__lock
+
+    @property
+    def last_success(self):
+        return dict(self.__last_success)
+
+    @property
+    def passed(self):
+        return self.__passed
+
+    def claim(self, probe):
+        # Keep the sessions of the current probe, while it reaches the device
+        if (self.__owner is not None and self.__owner is not probe and
+                not self.__owner.consecutive_failures):
+            return False
+        if self.__owner is not probe:
+            logging.info('Run the tests of YubiHSM via %s', probe.config.url)
+        self.__owner = probe
+        return True
+
+    def release(self, probe):
+        if self.__owner is probe:
+            self.__owner = None
+
+    def record(self, last_success, passed):
+        self.__last_success = last_success
+        self.__passed = passed
+
+
+class DeviceRegistry:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__devices = {}
+
+    def claim(self, serial, probe):
+        with self.__lock:
+            device = self.__devices.setdefault(serial, DeviceState())
+            return device, device.claim(probe)
+
+    def release(self, probe):
+        with self.__lock:
+            for device in self.__devices.values():
+                device.release(probe)
+
+
+class AuditLogFillRate:
+
+    def __init__(self, smoothing=FILL_RATE_SMOOTHING):
+        self.__smoothing = smoothing
+        self.__rate = None
+        self.__used = None
+        self.__last_number = None
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    def __sample(self, rate):
+        if self.__rate is None:
+            self.__rate = rate
+        else:
+            self.__rate += self.__smoothing * (rate - self.__rate)
+
+    def used(self, now, used):
+        # Only growth without draining in between tells the fill rate
+        if self.__used and now > self.__used[0] and used >= self.__used[1]:
+            self.__sample((used - self.__used[1]) / (now - self.__used[0]))
+        self.__used = (now, used)
+
+    def retrieved(self, now, number):
+        self.__used = None
+        if self.__last_number:
+            interval = now - self.__last_number[0]
+            if interval < FILL_RATE_MIN_INTERVAL:
+                # Repeated drains in one probe are too close for a rate
+                return
+            # The entry numbers count on independent of draining
+            self.__sample(((number - self.__last_number[1]) & 0xFFFF) /
+                          interval)
+        self.__last_number = (now, number)
+
+    def time_to_full(self, free):
+        if not self.__rate:
+            return float('inf')
+        return max(free, 0) / self.__rate
+
 
 class YubiHSMProbe:
 
-    def __init__(self, config, test_secret, metrics):
+    def __init__(self, config, test_secret, metrics, credentials=None,
+                 audit_log=None, audit_log_cursors=None, transport=None,
+                 devices=None):
         self.__config = config
         self.__labels = dict(url=self.__config.url,
                              name=self.__config.name)
         self.__metrics = metrics
-        self.__previous_log_entry = None
+        self.__audit_log_cursors = audit_log_cursors or AuditLogCursors()
+        self.__devices = devices or DeviceRegistry()
+        self.__primary = False
+        self.__last_success = {}
+        self.__serial = None
+        self.__cached_key = None
         self.__test_secret = test_secret
+        self.__pool = SessionPool(config, metrics, self.__labels,
+                                  credentials or CredentialCache(), transport)
+        self.__consecutive_failures = 0
+        self.__cycles = 0
+        self.__object_algorithms = {}
+        self.__inventory = set()
+        self.__key_labels = {'session': set(), 'target': set()}
+        self.__fill_rate = AuditLogFillRate()
+        self.__log_size = None
+        self.__log_free = None
+        self.__audit_log = audit_log
+        # Tests that never passed show up with a timestamp of 0
+        for test in self.__tests():
+            self.__metrics.last_success.labels(
+                    **(self.__labels | {'test': test}))
+
+    @property
+    def config(self):
+        return self.__config
+
+    @property
+    def consecutive_failures(self):
+        return self.__consecutive_failures
+
+    @property
+    def drain_delay(self):
+        if not self.__config.audit_key_id or self.__log_free is None:
+            return None
+        time_to_full = self.__fill_rate.time_to_full(self.__log_free)
+        if time_to_full == float('inf'):
+            return None
+        return max(time_to_full * AUDIT_LOG_DRAIN_MARGIN, MIN_DRAIN_DELAY)
+
+    def __timed(self, phase):
+        return self.__metrics.phase_duration.labels(
+                **(self.__labels | {'phase': phase})).time()
+
+    def __tests(self):
+        tests = ['connection']
+        if self.__config.audit_key_id:
+            tests.append('get_logs')
+        if self.__config.application_key_id:
+            tests.append('crypto_test')
+            if self.__config.benchmark_operations:
+                tests.append('crypto_benchmark')
+        if self.__inventory_session() and self.__config.inventory_every:
+            tests.append('inventory')
+        return tests
+
+    def __due(self, every):
+        # The first cycle runs all tests, later ones only every n-th cycle
+        return (self.__cycles - 1) % every == 0
+
+    def __log_filling(self, info):
+        # Drain between the scheduled retrievals, before the log runs full
+        if info.log_used >= info.log_size * AUDIT_LOG_DRAIN_THRESHOLD:
+            return True
+        time_to_full = self.__fill_rate.time_to_full(self.__log_free)
+        return (time_to_full <
+                self.__config.probe_interval * self.__config.get_logs_every)
+
+    def __succeeded(self, test):
+        self.__last_success[test] = time.time()
+        self.__metrics.last_success.labels(
+                **(self.__labels | {'test': test})).set(self.__last_success[test])
+        return True
+
+    def __share(self, device):
+        # Another connector reaches the same YubiHSM and runs the tests
+        if self.__primary:
+            logging.info('Leave the tests of YubiHSM %s to another connector',
+                         self.__config.url)
+            self.__primary = False
+            self.__pool.close()
+        self.__metrics.primary.labels(**self.__labels).set(0)
+        for test, timestamp in device.last_success.items():
+            if test != 'connection':
+                self.__metrics.last_success.labels(
+                        **(self.__labels | {'test': test})).set(timestamp)
+        if device.passed is not None:
+            self.__metrics.up.labels(**self.__labels).set(device.passed)
 
-    def retrieve_logs(self, hsm):
+    def __run_tests(self, info):
+        passed = True
+        if (self.__config.audit_key_id and
+                (self.__due(self.__config.get_logs_every) or
+                 self.__log_filling(info))):
+            passed &= self.retrieve_logs()
+        if self.__config.application_key_id:
+            if self.__due(self.__config.crypto_test_every):
+                passed &= self.encryption_test()
+            if (self.__config.benchmark_operations and
+                    self.__due(self.__config.crypto_benchmark_every)):
+                passed &= self.crypto_benchmark()
+        if (self.__config.inventory_every and self.__inventory_session()
+                and self.__due(self.__config.inventory_every)):
+            # Only collects metrics, so it does not count for yubihsm_up
+            self.collect_inventory()
+        return passed
+
+    def retrieve_logs(self):
         try:
-            session = hsm.create_session_derived(
-                self.__config.audit_key_id,
-                load_pin(self.__config.audit_key_pin_path))
-            try:
-                logs = session.get_log_entries()
-                if logs.entries:
-                    for log in logs.entries:
-                        logging.info(
-                                'Log #%d from %s: %d with length %d on %d & %d => %d @%d, %d, Digest: %s', 
-                                log.number, self.__config.url, log.command,
-                                log.length, log.target_key, log.second_key,
-                                log.result, log.tick, log.session_key, log.digest.hex())
-                    try: # There might be multiple log fetchers in place
-                        session.set_log_index(logs.entries[-1].number)
-                    except yubihsm.exceptions.YubiHsmDeviceError as e:
-                        pass
-                logging.info('Retrieved logs successfully')
-            finally:
-                session.close()
+            self.__pool.run(self.__config.audit_key_id,
+                            self.__config.audit_key_pin_path,
+                            'audit_session', self.__fetch_logs)
+        except ProbeTimeoutError:
+            raise
         except yubihsm.exceptions.YubiHsmError as e:
             logging.error('Failed to retrieve logs from %s: %s, %s', 
                           self.__config.url, type(e).__name__, str(e))
             self.__metrics.test_errors.labels(**(self.__labels | {'error': 'get_logs'})).inc()
+            return False
+        return self.__succeeded('get_logs')
 
-    def encryption_test(self, hsm):
-        try:
-            session = hsm.create_session_derived(
-                self.__config.application_key_id,
-                load_pin(self.__config.application_key_pin_path))
+    def __fetch_logs(self, session):
+        # A busy YubiHSM fills the log again, while it gets drained
+        for _ in range(AUDIT_LOG_DRAIN_ROUNDS):
+            drained = self.__drain_logs(session)
+            if (not drained or self.__log_size is None or
+                    drained < self.__log_size * AUDIT_LOG_DRAIN_THRESHOLD):
+                break
+        logging.info('Retrieved logs successfully')
+
+    def __drain_logs(self, session):
+        verified = True
+        with self.__timed('get_log_entries'):
             try:
-                key = session.list_objects(label=self.__config.encryption_key_label)
-                if len(key) == 1:
-                    key = key[0]
-                    ef = lambda x: key.get_public_key().encrypt(x, padding.PKCS1v15())
-                    df = lambda x: key.decrypt_pkcs1v1_5(x)
-                    self.__test_secret.process(decrypt=df, encrypt=ef)
-                    secret, encrypted = self.__test_secret.get()
+                logs = session.get_log_entries()
+            except yubihsm.exceptions.YubiHsmInvalidResponseError:
+                # The entries after a broken digest still have to be drained
+                logs = get_log_entries(session)
+                verified = False
+        entries = self.__new_log_entries(logs.entries)
+        if not verified:
+            for previous, entry in zip(entries, entries[1:]):
+                self.__verify_log_entry(previous, entry)
+        if entries:
+            self.__count_log_entries(entries)
+            if self.__audit_log:
+                self.__audit_log.submit(
+                        [self.__audit_record(log) for log in entries])
+            else:
+                for log in entries:
                     logging.info(
-                            '%s data with key from %s => %s',
-                            'Encrypted' if encrypted else 'Decrypted', 
-                            self.__config.url, secret)
-                    if not encrypted and (secret != TestSecret.DEFAULT_SECRET):
-                        logging.error(
-                            'Decryption using %s returned wrong result %s, expected %s',
-                            self.__config.url, secret, TestSecret.DEFAULT_SECRET)
-                        raise yubihsm.exceptions.YubiHsmInvalidResponseError()
-                else:
-                    logging.error(
-                            'Got None or to much objects with label %s from %s',
-                            self.__config.encryption_key_label, self.__config.url)
-                    raise yubihsm.exceptions.YubiHsmInvalidResponseError()
-            finally:
-                session.close()
+                            'Log #%d from %s: %d with length %d on %d & %d => %d @%d, %d, Digest: %s', 
+                            log.number, self.__config.url, log.command,
+                            log.length, log.target_key, log.second_key,
+                            log.result, log.tick, log.session_key, log.digest.hex())
+            self.__audit_log_cursors.update(self.__serial, entries[-1])
+            self.__metrics.audit_log_last_number.labels(**self.__labels).set(
+                    entries[-1].number)
+        if not logs.entries:
+            return 0
+        self.__fill_rate.retrieved(time.monotonic(), logs.entries[-1].number)
+        try: # There might be multiple log fetchers in place
+            with self.__timed('set_log_index'):
+                session.set_log_index(logs.entries[-1].number)
+        except yubihsm.exceptions.YubiHsmDeviceError as e:
+            return 0
+        self.__log_free = self.__log_size
+        return len(logs.entries)
+
+    def __count_log_entries(self, entries):
+        commands = Counter(
+                (command_name(log.command),
+                 'success' if log.result == log.command | 0x80 else 'error')
+                for log in entries)
+        for (command, result), count in commands.items():
+            self.__metrics.audit_commands.labels(**(self.__labels | {
+                    'command': command, 'result': result})).inc(count)
+        for role, key_ids in (
+                ('session', [log.session_key for log in entries]),
+                ('target', [log.target_key for log in entries])):
+            labelled = self.__key_labels[role]
+            # Keys keep their label once given, the most used keys of the
+            # first entries get the limited labels
+            for key_id, count in Counter(k for k in key_ids if k).most_common():
+                if key_id not in labelled and len(labelled) < AUDIT_KEY_LABELS:
+                    labelled.add(key_id)
+                key = '0x%04x' % key_id if key_id in labelled else 'other'
+                self.__metrics.audit_key_usage.labels(**(self.__labels | {
+                        'role': role, 'key': key})).inc(count)
+
+    def __count_chain_error(self, error_type):
+        self.__metrics.audit_log_chain_errors.labels(
+                **(self.__labels | {'type': error_type})).inc()
+
+    def __new_log_entries(self, entries):
+        previous = self.__audit_log_cursors.get(self.__serial)
+        if previous is None:
+            return entries
+        # Log numbers wrap around at 16 bit
+        new_entries = [e for e in entries
+                       if 0 < (e.number - previous.number) & 0xFFFF < 0x8000]
+        if not new_entries:
+            if entries and previous.number not in (e.number for e in entries):
+                logging.warning('Audit log of %s restarted at #%d after #%d',
+                                self.__config.url, entries[0].number,
+                                previous.number)
+                self.__count_chain_error('gap')
+                return entries
+            return new_entries
+        self.__verify_log_entry(previous, new_entries[0])
+        return new_entries
+
+    def __verify_log_entry(self, previous, entry):
+        if (entry.number - previous.number) & 0xFFFF != 1:
+            logging.warning('Audit log of %s misses entries between #%d and #%d',
+                            self.__config.url, previous.number, entry.number)
+            self.__count_chain_error('gap')
+        elif not entry.validate(previous):
+            logging.error('Audit log digest chain of %s broken at #%d',
+                          self.__config.url, entry.number)
+            self.__count_chain_error('break')
+
+    def __audit_record(self, log):
+        return dict(self.__labels, time=time.time(), number=log.number,
+                    command=log.command, command_name=command_name(log.command),
+                    length=log.length, session_key=log.session_key,
+                    target_key=log.target_key, second_key=log.second_key,
+                    result=log.result, tick=log.tick, digest=log.digest.hex())
+
+    def encryption_test(self):
+        try:
+            self.__pool.run(self.__config.application_key_id,
+                            self.__config.application_key_pin_path,
+                            'application_session',
+                            self.__using_key(self.__process_secret))
+        except ProbeTimeoutError:
+            raise
         except yubihsm.exceptions.YubiHsmError as e:
             logging.error('Failed encryption test on %s: %s, %s', 
                           self.__config.url, type(e).__name__, str(e))
             self.__metrics.test_errors.labels(**(self.__labels | {'error': 'crypto_test'})).inc()
+            return False
+        return self.__succeeded('crypto_test')
+
+    def __count_key_lookup(self, result):
+        self.__metrics.key_cache_lookups.labels(
+                **(self.__labels | {'result': result})).inc()
+
+    def __find_key(self, session):
+        cached = self.__cached_key
+        if cached and cached.serial == self.__serial:
+            self.__count_key_lookup('hit')
+            return cached.key.with_session(session), cached.public_key
+        self.__count_key_lookup('miss')
+        with self.__timed('list_objects'):
+            keys = session.list_objects(label=self.__config.encryption_key_label)
+        if len(keys) != 1:
+            logging.error(
+                    'Got None or to much objects with label %s from %s',
+                    self.__config.encryption_key_label, self.__config.url)
+            raise yubihsm.exceptions.YubiHsmInvalidResponseError()
+        with self.__timed('get_public_key'):
+            public_key = keys[0].get_public_key()
+        self.__cached_key = CachedKey(self.__serial, keys[0], public_key)
+        return keys[0], public_key
+
+    def __using_key(self, operation):
+        def run(session):
+            try:
+                return operation(session, *self.__find_key(session))
+            except yubihsm.exceptions.YubiHsmDeviceError:
+                # The key might have been deleted or replaced meanwhile
+                self.__cached_key = None
+                raise
+        return run
+
+    def __process_secret(self, session, key, public_key):
+        def ef(x):
+            with self.__timed('encrypt'):
+                return public_key.encrypt(x, padding.PKCS1v15())
+        def df(x):
+            with self.__timed('decrypt'):
+                return key.decrypt_pkcs1v1_5(x)
+        correct = self.__test_secret.process(decrypt=df, encrypt=ef)
+        secret, encrypted = self.__test_secret.get()
+        logging.info(
+                '%s data with key from %s => %s',
+                'Encrypted' if encrypted else 'Decrypted', 
+                self.__config.url, secret)
+        if not correct:
+            logging.error(
+                'Decryption using %s returned wrong result %s, expected %s',
+                self.__config.url, secret, self.__test_secret.expected)
+            raise yubihsm.exceptions.YubiHsmInvalidResponseError()
+
+    def crypto_benchmark(self):
+        try:
+            self.__pool.run(self.__config.application_key_id,
+                            self.__config.application_key_pin_path,
+                            'application_session',
+                            self.__using_key(self.__run_benchmark))
+        except ProbeTimeoutError:
+            raise
+        except yubihsm.exceptions.YubiHsmError as e:
+            logging.error('Failed crypto benchmark on %s: %s, %s',
+                          self.__config.url, type(e).__name__, str(e))
+            self.__metrics.test_errors.labels(**(self.__labels | {'error': 'crypto_benchmark'})).inc()
+            return False
+        return self.__succeeded('crypto_benchmark')
+
+    def __run_benchmark(self, session, key, public_key):
+        ciphertext = public_key.encrypt(BENCHMARK_DATA, padding.PKCS1v15())
+        operations = [('decrypt', lambda: key.decrypt_pkcs1v1_5(ciphertext),
+                       lambda result: result == BENCHMARK_DATA)]
+        if self.__config.benchmark_sign:
+            def verify(signature):
+                try:
+                    public_key.verify(signature, BENCHMARK_DATA,
+                                      padding.PKCS1v15(), hashes.SHA256())
+                    return True
+                except InvalidSignature:
+                    return False
+            operations.append(
+                    ('sign', lambda: key.sign_pkcs1v1_5(BENCHMARK_DATA), verify))
+        for operation, function, check in operations:
+            labels = self.__labels | {'operation': operation}
+            duration = self.__metrics.crypto_operation_duration.labels(**labels)
+            start = time.perf_counter()
+            for i in range(self.__config.benchmark_operations):
+                with duration.time():
+                    result = function()
+            elapsed = time.perf_counter() - start
+            if not check(result):
+                logging.error('Benchmark operation %s on %s returned wrong result',
+                              operation, self.__config.url)
+                raise yubihsm.exceptions.YubiHsmInvalidResponseError()
+            self.__metrics.crypto_operations_per_second.labels(**labels).set(
+                    self.__config.benchmark_operations / elapsed)
+            logging.info('Benchmark of %s on %s: %d operations in %.3f seconds',
+                         operation, self.__config.url,
+                         self.__config.benchmark_operations, elapsed)
+
+    def __inventory_session(self):
+        # Any session can read the inventory, reuse one opened for the tests
+        if self.__config.audit_key_id:
+            return (self.__config.audit_key_id,
+                    self.__config.audit_key_pin_path, 'audit_session')
+        if self.__config.application_key_id:
+            return (self.__config.application_key_id,
+                    self.__config.application_key_pin_path,
+                    'application_session')
+        return None
+
+    def collect_inventory(self):
+        try:
+            self.__pool.run(*self.__inventory_session(),
+                            self.__fetch_inventory)
+        except ProbeTimeoutError:
+            raise
+        except yubihsm.exceptions.YubiHsmError as e:
+            logging.error('Failed to collect the inventory of %s: %s, %s',
+                          self.__config.url, type(e).__name__, str(e))
+            self.__metrics.test_errors.labels(**(self.__labels | {'error': 'inventory'})).inc()
+            return False
+        return self.__succeeded('inventory')
+
+    def __fetch_inventory(self, session):
+        with self.__timed('inventory'):
+            objects = session.list_objects()
+            algorithms = {}
+            for obj in objects:
+                # Only new or replaced objects need a request for their info.
+                # The sequence changes, when an object gets replaced.
+                key = (obj.object_type, obj.id, obj._seq)
+                if key not in self.__object_algorithms:
+                    self.__object_algorithms[key] = obj.get_info().algorithm
+                algorithms[key] = self.__object_algorithms[key]
+            self.__object_algorithms = algorithms
+            storage = get_storage_info(session)
+        inventory = {}
+        for (object_type, _, _), algorithm in algorithms.items():
+            labels = (enum_label(yubihsm.defs.OBJECT, object_type),
+                      enum_label(yubihsm.defs.ALGORITHM, algorithm))
+            inventory[labels] = inventory.get(labels, 0) + 1
+        for object_type, algorithm in self.__inventory - inventory.keys():
+            self.__metrics.objects.remove(self.__config.url, self.__config.name,
+                                          object_type, algorithm)
+        for (object_type, algorithm), count in inventory.items():
+            self.__metrics.objects.labels(**(self.__labels | {
+                    'type': object_type, 'algorithm': algorithm})).set(count)
+        self.__inventory = set(inventory)
+        self.__metrics.storage_records.labels(**self.__labels).set(
+                storage.total_records)
+        self.__metrics.storage_free_records.labels(**self.__labels).set(
+                storage.free_records)
+        self.__metrics.storage_pages.labels(**self.__labels).set(
+                storage.total_pages)
+        self.__metrics.storage_free_pages.labels(**self.__labels).set(
+                storage.free_pages)
 
     def probe(self):
-        logging.info('Connect to YubiHSM connector %s', self.__config.url)
-        hsm = yubihsm.YubiHsm.connect(self.__config.url)
+        # Only the time of this thread, the time waiting for the YubiHSM
+        # shows up in the total phase duration
+        cpu_start = time.thread_time()
+        try:
+            with self.__timed('total'):
+                self.__probe()
+        finally:
+            self.__metrics.probe_cpu_seconds.labels(**self.__labels).inc(
+                    time.thread_time() - cpu_start)
+            self.__metrics.changed()
+
+    def __probe(self):
+        logging.info('Probe YubiHSM connector %s', self.__config.url)
+        self.__pool.deadline.reset(self.__config.probe_deadline)
         try:
             self.__metrics.test_connections.labels(**self.__labels).inc()
-            info = hsm.get_device_info()
+            with self.__timed('device_info'):
+                info = self.__pool.hsm.get_device_info()
+            self.__consecutive_failures = 0
+            self.__cycles += 1
+            self.__succeeded('connection')
+            self.__serial = info.serial
             self.__metrics.info.labels(**self.__labels).info(
                     {'version': version_to_string(info.version),
                      'serial': str(info.serial)})
             self.__metrics.log_size.labels(**self.__labels).set(info.log_size)
             self.__metrics.used_log_entries.labels(**self.__labels).set(info.log_used)
-            if self.__config.audit_key_id:
-                self.retrieve_logs(hsm)
-            if self.__config.application_key_id:
-                self.encryption_test(hsm)
+            self.__fill_rate.used(time.monotonic(), info.log_used)
+            self.__log_size = info.log_size
+            self.__log_free = info.log_size - info.log_used
+            device, primary = self.__devices.claim(info.serial, self)
+            if not primary:
+                self.__share(device)
+                return
+            self.__primary = True
+            self.__metrics.primary.labels(**self.__labels).set(1)
+            with device.lock:
+                passed = self.__run_tests(info)
+            device.record(dict(self.__last_success), passed)
+            # Measured before draining, how close the log got to running full
+            self.__metrics.audit_log_time_to_full.labels(**self.__labels).set(
+                    self.__fill_rate.time_to_full(info.log_size - info.log_used))
+            self.__metrics.up.labels(**self.__labels).set(passed)
+        except ProbeTimeoutError as e:
+            logging.error('Probing %s timed out: %s', self.__config.url, e)
+            self.__metrics.test_errors.labels(**(self.__labels | {'error': 'timeout'})).inc()
+            self.__consecutive_failures += 1
+            self.__metrics.up.labels(**self.__labels).set(0)
+            self.__pool.reset()
         except yubihsm.exceptions.YubiHsmConnectionError as e:
             logging.error('Failed to connect to %s: %s', self.__config.url, e)
             self.__metrics.test_errors.labels(**(self.__labels | {'error': 'connection'})).inc()
+            self.__consecutive_failures += 1
+            self.__metrics.up.labels(**self.__labels).set(0)
+            self.__pool.reset()
+
+    def close(self):
+        self.__devices.release(self)
+        self.__pool.close()
+
+
+class Profiler:
+
+    def __init__(self, directory, kinds=PROFILE_KINDS):
+        self.__directory = directory
+        self.__cpu = 'cpu' in kinds
+        self.__memory = 'memory' in kinds
+        self.__lock = threading.Lock()
+        self.__stats = None
+        self.__requested = False
+        if self.__memory:
+            tracemalloc.start()
+        signal.signal(signal.SIGUSR1, self.request)
+
+    @staticmethod
+    def from_environment(environ=os.environ):
+        value = environ.get(PROFILE_VARIABLE)
+        if not value:
+            return None
+        kinds = [kind.strip() for kind in value.split(',')]
+        for kind in kinds:
+            if kind not in PROFILE_KINDS:
+                logging.error('Expected %s in %s, got %s',
+                              ' or '.join(PROFILE_KINDS), PROFILE_VARIABLE, kind)
+                exit(1)
+        directory = environ.get(PROFILE_DIR_VARIABLE, tempfile.gettempdir())
+        logging.info('Profile %s, send SIGUSR1 to dump to %s',
+                     ' and '.join(kinds), directory)
+        return Profiler(directory, kinds)
+
+    def run(self, function):
+        if not self.__cpu:
+            return function()
+        # cProfile only sees the thread it was enabled in, so each probe
+        # gets its own profile and the statistics get merged afterwards
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function)
+        finally:
+            with self.__lock:
+                if self.__stats:
+                    self.__stats.add(profile)
+                else:
+                    self.__stats = pstats.Stats(profile)
+
+    def request(self, *args):
+        self.__requested = True
+
+    def poll(self):
+        if self.__requested:
+            self.__requested = False
+            self.dump()
+
+    def dump(self):
+        prefix = os.path.join(self.__directory,
+                              time.strftime('yubihsm-exporter-%Y%m%d-%H%M%S'))
+        paths = []
+        try:
+            if self.__cpu:
+                with self.__lock:
+                    stats, self.__stats = self.__stats, None
+                if stats:
+                    stats.dump_stats(prefix + '.pstats')
+                    paths.append(prefix + '.pstats')
+            if self.__memory:
+                tracemalloc.take_snapshot().dump(prefix + '.tracemalloc')
+                paths.append(prefix + '.tracemalloc')
+        except OSError as e:
+            logging.error('Failed to dump profile to %s: %s',
+                          self.__directory, e)
+        for path in paths:
+            logging.info('Dumped profile to %s', path)
+        return paths
+
+
+class ProbeInstrumentation:
+
+    def __init__(self, metrics=None, profiler=None):
+        self.__metrics = metrics
+        self.__profiler = profiler
+
+    def sweep(self):
+        if self.__metrics:
+            return self.__metrics.sweep_duration.time()
+        return contextlib.nullcontext()
+
+    def run(self, probe, scheduled):
+        if self.__metrics:
+            self.__metrics.probe_start_lag.observe(
+                    max(time.monotonic() - scheduled, 0))
+        in_flight = (self.__metrics.probes_in_flight.track_inprogress()
+                     if self.__metrics else contextlib.nullcontext())
+        with in_flight:
+            if self.__profiler:
+                return self.__profiler.run(probe.probe)
+            return probe.probe()
+
+
+class ProbeScheduler:
+
+    def __init__(self, probes, workers, instrumentation=None):
+        self.__probes = list(probes)
+        self.__instrumentation = instrumentation or ProbeInstrumentation()
+        self.__lock = threading.RLock()
+        self.__running = {}
+        now = time.monotonic()
+        # Spread the first probes, so replicas do not probe in lockstep
+        self.__next_run = {probe: now + self.jitter(probe.config)
+                           for probe in probes}
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='yubihsm-probe')
+
+    @staticmethod
+    def jitter(config):
+        return random.uniform(0, config.probe_interval * config.probe_jitter)
+
+    @staticmethod
+    def delay(config, failures):
+        delay = config.probe_interval * 2 ** min(max(failures - 1, 0), 16)
+        delay = min(delay, max(config.max_backoff, config.probe_interval))
+        return delay * random.uniform(1 - config.probe_jitter,
+                                      1 + config.probe_jitter)
+
+    @staticmethod
+    def next_delay(probe):
+        failures = probe.consecutive_failures
+        delay = ProbeScheduler.delay(probe.config, failures)
+        if failures:
+            logging.info('Probe %s again in %.1f seconds after %d failures',
+                         probe.config.url, delay, failures)
+        elif probe.drain_delay is not None and probe.drain_delay < delay:
+            delay = probe.drain_delay
+            logging.info('Probe %s again in %.1f seconds to drain its audit log',
+                         probe.config.url, delay)
+        return delay
+
+    @property
+    def probes(self):
+        with self.__lock:
+            return list(self.__probes)
+
+    def add(self, probe):
+        with self.__lock:
+            self.__probes.append(probe)
+            self.__next_run[probe] = (time.monotonic() +
+                                      self.jitter(probe.config))
+
+    def remove(self, probe, closed=None):
+        def close(*args):
+            probe.close()
+            if closed:
+                closed()
+        with self.__lock:
+            self.__probes.remove(probe)
+            del self.__next_run[probe]
+            future = self.__running.pop(probe, None)
+        if future:
+            # Close the probe once its last run finished
+            future.add_done_callback(close)
+        else:
+            close()
+
+    def __submit(self, probe, scheduled):
+        self.__running[probe] = self.__executor.submit(
+                self.__instrumentation.run, probe, scheduled)
+
+    def __collect_finished(self):
+        with self.__lock:
+            for probe, future in list(self.__running.items()):
+                if not future.done():
+                    continue
+                del self.__running[probe]
+                try:
+                    future.result()
+                except BaseException as e:
+                    logging.exception('Probe of %s failed unexpectedly: %s',
+                                      probe.config.url, e)
+                self.__next_run[probe] = (time.monotonic() +
+                                          self.next_delay(probe))
+
+    def run_pending(self, timeout):
+        now = time.monotonic()
+        with self.__lock:
+            for probe in self.__probes:
+                if probe not in self.__running and self.__next_run[probe] <= now:
+                    self.__submit(probe, self.__next_run[probe])
+            next_run = min((t for p, t in self.__next_run.items()
+                            if p not in self.__running), default=now + timeout)
+            running = list(self.__running.values())
+        wait_time = min(timeout, max(next_run - now, 0))
+        if running:
+            concurrent.futures.wait(
+                    running, timeout=wait_time,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+        else:
+            time.sleep(wait_time)
+        self.__collect_finished()
+
+    def sweep(self, timeout=None):
+        with self.__instrumentation.sweep():
+            self.__sweep(timeout)
+
+    def __sweep(self, timeout):
+        now = time.monotonic()
+        futures = []
+        with self.__lock:
+            for probe in self.__probes:
+                if probe in self.__running:
+                    logging.warning('Previous probe of %s still runs, skip it',
+                                    probe.config.url)
+                elif probe.consecutive_failures and self.__next_run[probe] > now:
+                    logging.info('Skip probe of %s during backoff',
+                                 probe.config.url)
+                else:
+                    self.__submit(probe, now)
+                    futures.append(self.__running[probe])
+        done, pending = concurrent.futures.wait(futures, timeout)
+        if pending:
+            logging.warning('%d probes did not finish within %s seconds',
+                            len(pending), timeout)
+        self.__collect_finished()
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=True)
+        for probe in self.probes:
+            probe.close()
+
+
+class AsyncProbeScheduler:
+
+    def __init__(self, probes, workers, event_loop, instrumentation=None):
+        self.__event_loop = event_loop
+        self.__instrumentation = instrumentation or ProbeInstrumentation()
+        self.__lock = threading.Lock()
+        self.__tasks = {}
+        self.__closed = {}
+        self.__stopping = False
+        # The yubihsm library is synchronous, so the probes run in a thread
+        # pool, while the event loop schedules them and does all HTTP I/O
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='yubihsm-probe')
+        for probe in probes:
+            self.add(probe)
+
+    @property
+    def probes(self):
+        with self.__lock:
+            return list(self.__tasks)
+
+    def add(self, probe):
+        with self.__lock:
+            self.__tasks[probe] = self.__event_loop.submit(self.__run(probe))
+
+    def remove(self, probe, closed=None):
+        with self.__lock:
+            task = self.__tasks.pop(probe)
+            self.__closed[probe] = closed
+        task.cancel()
+
+    def __close(self, probe):
+        closed = self.__closed.pop(probe, None)
+        probe.close()
+        if closed:
+            closed()
+
+    async def __run(self, probe):
+        future = None
+        try:
+            delay = ProbeScheduler.jitter(probe.config)
+            while True:
+                scheduled = time.monotonic() + delay
+                await asyncio.sleep(delay)
+                future = self.__executor.submit(
+                        self.__instrumentation.run, probe, scheduled)
+                try:
+                    await asyncio.shield(asyncio.wrap_future(future))
+                except asyncio.CancelledError:
+                    raise
+                except BaseException as e:
+                    # Anything else escaping the probe would stop the loop
+                    logging.exception('Probe of %s failed unexpectedly: %s',
+                                      probe.config.url, e)
+                delay = ProbeScheduler.next_delay(probe)
+        finally:
+            if not self.__stopping:
+                # Closing talks to the YubiHSM, which must not block the loop
+                if future and not future.done():
+                    future.add_done_callback(
+                            lambda f: self.__close(probe))
+                else:
+                    self.__executor.submit(self.__close, probe)
+
+    def run_pending(self, timeout):
+        # The event loop runs the probes on its own
+        time.sleep(timeout)
+        if not self.__event_loop.alive:
+            logging.error('The event loop stopped, no probes run anymore')
+            exit(1)
+
+    def shutdown(self):
+        self.__stopping = True
+        with self.__lock:
+            tasks = list(self.__tasks.values())
+        for task in tasks:
+            task.cancel()
+        self.__executor.shutdown(wait=True)
+        for probe in self.probes:
+            probe.close()
+
+
+class ProbeManager:
+
+    def __init__(self, scheduler, metrics, shard, credentials, audit_log=None,
+                 audit_log_cursors=None, transport=None, devices=None):
+        self.__scheduler = scheduler
+        self.__metrics = metrics
+        self.__shard = shard
+        self.__credentials = credentials
+        self.__audit_log = audit_log
+        self.__audit_log_cursors = audit_log_cursors
+        self.__transport = transport
+        self.__devices = devices or DeviceRegistry()
+
+    def __create(self, config):
+        return YubiHSMProbe(config, TestSecret(randomize=config.random_test_secret),
+                            self.__metrics, self.__credentials, self.__audit_log,
+                            self.__audit_log_cursors, transport=self.__transport,
+                            devices=self.__devices)
+
+    def apply(self, connectors):
+        selected = list(dict.fromkeys(self.__shard.select(connectors)))
+        current = {p.config: p for p in self.__scheduler.probes}
+        kept_labels = set((c.url, c.name) for c in selected)
+        for config, probe in current.items():
+            if config in selected:
+                continue
+            logging.info('Stop probing %s', config.url)
+            labels = (config.url, config.name)
+            if labels in kept_labels:
+                self.__scheduler.remove(probe)
+            else:
+                self.__scheduler.remove(
+                        probe, lambda labels=labels: self.__metrics.remove(*labels))
+        for config in selected:
+            if config not in current:
+                logging.info('Start probing %s', config.url)
+                self.__scheduler.add(self.__create(config))
+        logging.info('Shard %d of %d probes %d of %d connectors',
+                     self.__shard.index, self.__shard.count, len(selected),
+                     len(connectors))
+        self.__metrics.shard_connectors.set(len(selected))
+        self.__metrics.changed()
+
+
+class ConfigurationWatcher:
+
+    def __init__(self, path, config, interval=CONFIG_POLL_INTERVAL):
+        self.__path = path
+        self.__config = config
+        self.__interval = interval
+        self.__stamp = self.__stat()
+        self.__next_check = time.monotonic() + interval
+        self.__requested = False
+        signal.signal(signal.SIGHUP, self.request)
+
+    @property
+    def config(self):
+        return self.__config
+
+    def __stat(self):
+        try:
+            # A ConfigMap update replaces the symlinked file
+            stat = os.stat(self.__path)
+            return stat.st_mtime_ns, stat.st_size, stat.st_ino
+        except OSError:
+            return None
+
+    def request(self, *args):
+        self.__requested = True
+
+    def poll(self):
+        now = time.monotonic()
+        if not self.__requested and now < self.__next_check:
+            return None
+        self.__next_check = now + self.__interval
+        stamp = self.__stat()
+        if not self.__requested and stamp == self.__stamp:
+            return None
+        self.__requested = False
+        self.__stamp = stamp
+        logging.info('Reload configuration from %s', self.__path)
+        try:
+            config = load_configuration(self.__path)
+        except (OSError, ValueError, SystemExit) as e:
+            # The validation exits on errors, keep running with the old one
+            logging.error('Keep previous configuration, failed to load %s: %s',
+                          self.__path, e)
+            return None
+        if self.__config.restart_required(config):
+            logging.warning('Only connector changes get applied without a restart')
+        self.__config = config
+        return config
+
+
+def connector_address(url):
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme, parts.netloc.lower()
+
+
+def target_matches(target, pattern):
+    # A connector URL, a CIDR for IP targets or a host name pattern
+    if '://' in pattern:
+        return connector_address(target) == connector_address(pattern)
+    parts = urllib.parse.urlsplit(target)
+    host = parts.hostname
+    if parts.scheme not in ('http', 'https') or host is None:
+        return False
+    try:
+        network = ipaddress.ip_network(pattern, strict=False)
+    except ValueError:
+        return fnmatch.fnmatchcase(host, pattern.lower())
+    try:
+        return ipaddress.ip_address(host) in network
+    except ValueError:
+        return False
+
+
+class ProbeEndpoint:
+
+    def __init__(self, modules, buckets, credentials, audit_log=None,
+                 audit_log_cursors=None, transport=None, devices=None,
+                 connectors=()):
+        self.__modules = modules
+        self.__connectors = connectors
+        self.__buckets = buckets
+        self.__credentials = credentials
+        self.__audit_log = audit_log
+        self.__audit_log_cursors = audit_log_cursors
+        self.__transport = transport
+        self.__devices = devices or DeviceRegistry()
+
+    def apply(self, modules, connectors=()):
+        self.__modules = modules
+        self.__connectors = connectors
+
+    def __allowed(self, module, target):
+        # The keys of a module must not authenticate against arbitrary hosts
+        if 'targets' in module:
+            return any(target_matches(target, p) for p in module['targets'])
+        return connector_address(target) in set(
+                connector_address(c.url) for c in self.__connectors)
+
+    def __module(self, name):
+        if name == DEFAULT_MODULE:
+            return self.__modules.get(name, {})
+        return self.__modules.get(name)
+
+    def __call__(self, environ, start_response):
+        params = urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+        target = params.get('target', [''])[0]
+        module_name = params.get('module', [DEFAULT_MODULE])[0]
+        module = self.__module(module_name)
+        if urllib.parse.urlsplit(target).scheme not in PROBE_TARGET_SCHEMES:
+            return self.__reply(start_response, '400 Bad Request',
+                                'Expected http(s) or yhusb URL as target')
+        if module is None:
+            return self.__reply(start_response, '400 Bad Request',
+                                'Unknown module %s' % module_name)
+        if not self.__allowed(module, target):
+            logging.warning('Refuse to probe %s with module %s', target,
+                            module_name)
+            return self.__reply(start_response, '403 Forbidden',
+                                'Target %s is not allowed for module %s'
+                                % (target, module_name))
+        settings = module_settings(module) | {'url': target}
+        if 'name' in params:
+            settings['name'] = params['name'][0]
+        try:
+            # Finish before Prometheus gives up on the scrape
+            timeout = float(environ['HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS'])
+            settings['probe_deadline'] = min(
+                    settings.get('probe_deadline', DEFAULT_PROBE_DEADLINE),
+                    max(timeout - SCRAPE_TIMEOUT_OFFSET, SCRAPE_TIMEOUT_OFFSET))
+        except (KeyError, ValueError):
+            pass
+        registry = prometheus_client.CollectorRegistry()
+        self.probe(YubiHSMConfiguration(**settings), registry)
+        encoder, content_type = prometheus_client.exposition.choose_encoder(
+                environ.get('HTTP_ACCEPT'))
+        start_response('200 OK', [('Content-Type', content_type)])
+        return [encoder(registry)]
+
+    def probe(self, config, registry):
+        logging.info('Probe %s on request', config.url)
+        probe = YubiHSMProbe(config, TestSecret(randomize=config.random_test_secret),
+                             Metrics(self.__buckets, registry),
+                             self.__credentials, self.__audit_log,
+                             self.__audit_log_cursors, transport=self.__transport,
+                             devices=self.__devices)
+        try:
+            probe.probe()
+        finally:
+            probe.close()
+
+    @staticmethod
+    def __reply(start_response, status, message):
+        start_response(status, [('Content-Type', 'text/plain; charset=utf-8')])
+        return [message.encode('utf8')]
+
+
+def accepts_gzip(accept_encoding):
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, *params = coding.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        qualities[name.strip().lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0)) > 0
+
+
+class RegistryUnion:
+
+    def __init__(self, *registries):
+        self.__registries = registries
+
+    def collect(self):
+        for registry in self.__registries:
+            yield from registry.collect()
+
+    def restricted_registry(self, names):
+        return RegistryUnion(*(r.restricted_registry(names)
+                               for r in self.__registries))
+
+
+class ExpositionCache:
+
+    def __init__(self, metrics, registry=prometheus_client.REGISTRY,
+                 fresh_registry=None):
+        self.__metrics = metrics
+        self.__registry = registry
+        # Rendered on every request, e.g. the process and exporter metrics
+        self.__fresh_registry = fresh_registry
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__uncached = prometheus_client.make_wsgi_app(
+                RegistryUnion(registry, fresh_registry) if fresh_registry
+                else registry)
+
+    def __call__(self, environ, start_response):
+        if environ.get('QUERY_STRING'):
+            # Filtered by name[] parameters, which are rare enough
+            return self.__uncached(environ, start_response)
+        encoder, content_type = prometheus_client.exposition.choose_encoder(
+                environ.get('HTTP_ACCEPT'))
+        compressed = accepts_gzip(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        headers = [('Content-Type', content_type),
+                   ('Vary', 'Accept, Accept-Encoding')]
+        if compressed:
+            headers.append(('Content-Encoding', 'gzip'))
+        output = self.get(encoder, content_type, compressed)
+        start_response('200 OK', headers)
+        return [output]
+
+    def get(self, encoder, content_type, compressed=False):
+        # Concurrent scrapes wait for one rendering and share it
+        with self.__lock:
+            generation = self.__metrics.generation
+            entry = self.__entries.get(content_type)
+            if entry and entry.generation == generation:
+                self.__metrics.exposition_requests.labels(cache='hit').inc()
+            else:
+                self.__metrics.exposition_requests.labels(cache='miss').inc()
+                with self.__metrics.exposition_render_duration.time():
+                    output = encoder(self.__registry)
+                    if self.__fresh_registry:
+                        # Only the end of the whole exposition gets marked
+                        output = output.removesuffix(OPENMETRICS_EOF)
+                    entry = CachedExposition(generation, output, None)
+            if compressed and entry.compressed is None:
+                entry = entry._replace(compressed=gzip.compress(entry.output))
+            self.__entries[content_type] = entry
+        if not self.__fresh_registry:
+            return entry.compressed if compressed else entry.output
+        fresh = encoder(self.__fresh_registry)
+        if compressed:
+            # Clients decompress concatenated gzip members as a whole
+            return entry.compressed + gzip.compress(fresh)
+        return entry.output + fresh
+
+
+class HttpRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def start_http_server(port, metrics_app, routes):
+    def app(environ, start_response):
+        route = routes.get(environ['PATH_INFO'], metrics_app)
+        return route(environ, start_response)
+    server = wsgiref.simple_server.make_server(
+            '', port, app, prometheus_client.exposition.ThreadingWSGIServer,
+            handler_class=HttpRequestHandler)
+    threading.Thread(target=server.serve_forever, name='http-server',
+                     daemon=True).start()
+    return server
+
+
+class ScrapeCollector:
+
+    def __init__(self, scheduler, registry, cache_ttl, deadline):
+        self.__scheduler = scheduler
+        self.__registry = registry
+        self.__cache_ttl = cache_ttl
+        self.__deadline = deadline
+        self.__lock = threading.Lock()
+        self.__last_sweep = None
+
+    def describe(self):
+        # Keeps the registry from sweeping on registration to learn the names
+        return []
+
+    def collect(self):
+        # Concurrent scrapes wait for the running sweep and share its result
+        with self.__lock:
+            if (self.__last_sweep is None or
+                    time.monotonic() - self.__last_sweep >= self.__cache_ttl):
+                self.__scheduler.sweep(self.__deadline)
+                self.__last_sweep = time.monotonic()
+        return self.__registry.collect()
 
 
 class ExitHandler:
@@ -293,16 +2738,73 @@ def main():
                             '/etc/yubihsm-export/config.json')
     logging.info('Load configuration from %s', config_path)
     config = load_configuration(config_path)
-    prometheus_client.start_http_server(config.metrics_port)
-    test_secret = TestSecret()
-    metrics = Metrics()
-    probes = [YubiHSMProbe(c, test_secret, metrics) for c in config.connectors]
+    scrape_driven = config.collection_mode == COLLECTION_MODE_SCRAPE
+    # Only the metrics of the probes are collected by sweeps or cached
+    registry = prometheus_client.CollectorRegistry()
+    metrics = Metrics(config.histogram_buckets, registry,
+                      prometheus_client.REGISTRY)
+    credentials = CredentialCache()
+    audit_log = None
+    if config.audit_log_sink:
+        audit_log = AuditLogWriter.create(config.audit_log_sink, metrics)
+    audit_log_cursors = AuditLogCursors(config.audit_log_cursor_path)
+    shard = Shard.from_environment()
+    metrics.shard.info({'index': str(shard.index), 'count': str(shard.count)})
+    profiler = Profiler.from_environment()
+    instrumentation = ProbeInstrumentation(metrics, profiler)
+    event_loop = transport = None
+    if config.transport == TRANSPORT_ASYNCIO:
+        logging.info('Talk to the connectors from a single event loop')
+        event_loop = EventLoopThread()
+        transport = AsyncConnectorTransport(event_loop)
+    if event_loop and not scrape_driven:
+        scheduler = AsyncProbeScheduler([], config.probe_workers, event_loop,
+                                        instrumentation)
+    else:
+        scheduler = ProbeScheduler([], config.probe_workers, instrumentation)
+    # Probes of the same YubiHSM via different connectors take turns
+    devices = DeviceRegistry()
+    probe_manager = ProbeManager(scheduler, metrics, shard, credentials,
+                                 audit_log, audit_log_cursors, transport,
+                                 devices)
+    probe_manager.apply(config.connectors)
+    probe_endpoint = ProbeEndpoint(config.modules, config.histogram_buckets,
+                                   credentials, audit_log, audit_log_cursors,
+                                   transport, devices, config.connectors)
+    if scrape_driven:
+        # Each scrape has to trigger the probes, nothing to cache
+        metrics_app = prometheus_client.make_wsgi_app()
+    else:
+        metrics_app = ExpositionCache(metrics, registry,
+                                      prometheus_client.REGISTRY)
+    start_http_server(config.metrics_port, metrics_app,
+                      {'/probe': probe_endpoint})
+    watcher = ConfigurationWatcher(config_path, config)
+    if scrape_driven:
+        logging.info('Probe YubiHSMs when metrics get scraped')
+        prometheus_client.REGISTRY.register(ScrapeCollector(
+                scheduler, registry, config.scrape_cache_ttl,
+                config.scrape_deadline))
     exit_handler = ExitHandler()
-    while not exit_handler.stop:
-        for probe in probes:
-            probe.probe()
-        logging.info("Sleep 5 seconds before probing next YubiHSM")
-        time.sleep(SLEEP_TIME_BETWEEN_PROBES)
+    try:
+        while not exit_handler.stop:
+            reloaded = watcher.poll()
+            if reloaded:
+                probe_manager.apply(reloaded.connectors)
+                probe_endpoint.apply(reloaded.modules, reloaded.connectors)
+            if profiler:
+                profiler.poll()
+            if scrape_driven:
+                time.sleep(SCHEDULER_TICK)
+            else:
+                scheduler.run_pending(SCHEDULER_TICK)
+    finally:
+        scheduler.shutdown()
+        if transport:
+            transport.close()
+            event_loop.close()
+        if audit_log:
+            audit_log.close()
 
 
 if __name__ == "__main__":
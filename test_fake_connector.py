@@ -0,0 +1,440 @@
+import argparse
+import os
+from unittest.mock import patch
+
+import pytest
+import prometheus_client
+import requests
+import yubihsm
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import benchmark
+import fake_connector
+import main
+
+AUTH_KEYS = {3: 'application', 6: 'audit'}
+
+
+@pytest.fixture(scope='module')
+def rsa_key():
+    return rsa.generate_private_key(65537, 2048)
+
+
+@pytest.fixture
+def device(rsa_key):
+    return fake_connector.FakeYubiHsm(auth_keys=AUTH_KEYS, rsa_key=rsa_key)
+
+
+@pytest.fixture
+def server(device):
+    server = fake_connector.FakeConnector({0: device}).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def pins(tmp_path):
+    for name, pin in (('application', 'application'), ('audit', 'audit'),
+                      ('wrong', 'wrong')):
+        (tmp_path / name).write_text(pin)
+    return tmp_path
+
+
+def create_probe(url, pins, registry, application_pin='application',
+                 audit_pin='audit', **kwargs):
+    config = main.YubiHSMConfiguration(
+            url, 3, str(pins / application_pin), 6, str(pins / audit_pin),
+            'fake', 'vault-hsm-key', **kwargs)
+    return main.YubiHSMProbe(config, main.TestSecret(), main.Metrics(registry=registry))
+
+
+def errors(registry, url):
+    return {s.labels['error']: s.value
+            for m in registry.collect() for s in m.samples
+            if s.name == 'yubihsm_test_errors_total' and s.labels['url'] == url}
+
+
+def test_probe_against_fake_connector(server, device, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry, benchmark_operations=2,
+                         benchmark_sign=True, inventory_every=1)
+    probe.probe()
+    probe.probe()
+    labels = {'url': server.url(), 'name': 'fake'}
+    assert errors(registry, server.url()) == {}
+    assert registry.get_sample_value('yubihsm_test_connections_total', labels) == 2
+    assert registry.get_sample_value('yubihsm_log_size', labels) == 62
+    assert registry.get_sample_value('yubihsm_audit_log_last_number', labels) > 1
+    assert registry.get_sample_value('yubihsm_sessions_total',
+                                     labels | {'origin': 'reused'}) == 6
+    assert probe.consecutive_failures == 0
+    assert registry.get_sample_value('yubihsm_up', labels) == 1
+    assert registry.get_sample_value('yubihsm_probe_cpu_seconds_total', labels) > 0
+    for test in ('connection', 'get_logs', 'crypto_test', 'crypto_benchmark',
+                 'inventory'):
+        assert registry.get_sample_value(
+                'yubihsm_last_success_timestamp_seconds',
+                labels | {'test': test}) > 0
+    assert device.sessions == 2
+    probe.close()
+    assert device.sessions == 0
+
+
+def test_probe_against_fake_connector_with_wrong_pins(server, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry, application_pin='wrong',
+                         audit_pin='wrong', inventory_every=1)
+    probe.probe()
+    assert errors(registry, server.url()) == {'get_logs': 1, 'crypto_test': 1,
+                                              'inventory': 1}
+    labels = {'url': server.url(), 'name': 'fake'}
+    assert registry.get_sample_value('yubihsm_up', labels) == 0
+    last_success = {s.labels['test']: s.value for m in registry.collect()
+                    for s in m.samples
+                    if s.name == 'yubihsm_last_success_timestamp_seconds'}
+    assert last_success['connection'] > 0
+    assert last_success['get_logs'] == last_success['crypto_test'] == 0
+
+
+def test_probe_runs_expensive_tests_every_n_cycles(server, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry, get_logs_every=3,
+                         crypto_test_every=2)
+    # Back to back probes would fill the log fast enough to drain it early
+    with patch.object(main.AuditLogFillRate, 'time_to_full',
+                      return_value=float('inf')):
+        for i in range(4):
+            probe.probe()
+    labels = {'url': server.url(), 'name': 'fake'}
+    assert registry.get_sample_value('yubihsm_test_connections_total', labels) == 4
+    assert registry.get_sample_value(
+            'yubihsm_probe_phase_duration_seconds_count',
+            labels | {'phase': 'get_log_entries'}) == 2
+    assert sum(registry.get_sample_value(
+            'yubihsm_key_cache_lookups_total', labels | {'result': result})
+            for result in ('hit', 'miss')) == 2
+    assert registry.get_sample_value('yubihsm_up', labels) == 1
+
+
+def test_probe_with_missing_pin_file(server, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry, application_pin='missing')
+    probe.probe()
+    assert errors(registry, server.url()) == {'crypto_test': 1}
+    assert probe.consecutive_failures == 0
+
+
+def test_probe_drains_filling_audit_log(server, device, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry, get_logs_every=100)
+    assert probe.drain_delay is None
+    for i in range(4):
+        probe.probe()
+    labels = {'url': server.url(), 'name': 'fake'}
+    # The log fills within seconds, so once the fill rate is known after the
+    # second probe, every probe drains it
+    assert registry.get_sample_value(
+            'yubihsm_probe_phase_duration_seconds_count',
+            labels | {'phase': 'get_log_entries'}) == 3
+    time_to_full = registry.get_sample_value(
+            'yubihsm_audit_log_time_to_full_seconds', labels)
+    assert 0 < time_to_full < 100
+    assert main.MIN_DRAIN_DELAY <= probe.drain_delay < 100
+    assert errors(registry, server.url()) == {}
+
+
+def test_probe_collects_inventory(server, device, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry, crypto_test_every=2,
+                         inventory_every=1)
+    probe.probe()
+    labels = {'url': server.url(), 'name': 'fake'}
+    objects = {(s.labels['type'], s.labels['algorithm']): s.value
+               for m in registry.collect() for s in m.samples
+               if s.name == 'yubihsm_objects'}
+    assert objects == {
+            ('authentication_key', 'aes128_yubico_authentication'): 2,
+            ('asymmetric_key', 'rsa_2048'): 1}
+    assert registry.get_sample_value('yubihsm_storage_records', labels) == 256
+    assert registry.get_sample_value('yubihsm_storage_free_records', labels) == 253
+    assert registry.get_sample_value('yubihsm_storage_pages', labels) == 1024
+    assert registry.get_sample_value('yubihsm_storage_free_pages', labels) == 1018
+    device.remove_object(0x100, yubihsm.defs.OBJECT.ASYMMETRIC_KEY)
+    with patch.object(yubihsm.objects.YhsmObject, 'get_info') as get_info:
+        probe.probe()
+    # The info of known objects is not requested again
+    assert not get_info.called
+    assert registry.get_sample_value(
+            'yubihsm_objects', labels | {'type': 'asymmetric_key',
+                                         'algorithm': 'rsa_2048'}) is None
+    assert registry.get_sample_value('yubihsm_storage_free_records', labels) == 254
+    assert errors(registry, server.url()) == {}
+
+
+def test_probe_inventory_failure_keeps_up(server, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry, inventory_every=1)
+    with patch('main.get_storage_info',
+               side_effect=yubihsm.exceptions.YubiHsmInvalidResponseError()):
+        probe.probe()
+    assert errors(registry, server.url()) == {'inventory': 1}
+    labels = {'url': server.url(), 'name': 'fake'}
+    assert registry.get_sample_value('yubihsm_up', labels) == 1
+
+
+def test_probe_recovers_from_dropped_sessions(server, device, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry)
+    probe.probe()
+    device.drop_sessions()
+    probe.probe()
+    assert errors(registry, server.url()) == {}
+    assert device.sessions == 2
+
+
+def test_probe_against_slow_fake_connector(server, device, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry, read_timeout=0.1)
+    device.latency = 0.5
+    probe.probe()
+    assert errors(registry, server.url()) == {'timeout': 1}
+    assert probe.consecutive_failures == 1
+
+
+def test_probe_against_hanging_fake_connector(server, device, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry, probe_deadline=0.5)
+    device.hang = True
+    probe.probe()
+    assert errors(registry, server.url()) == {'timeout': 1}
+
+
+def test_probe_against_failing_fake_connector(server, device, pins):
+    registry = prometheus_client.CollectorRegistry()
+    probe = create_probe(server.url(), pins, registry)
+    device.error_rate = 1
+    probe.probe()
+    assert errors(registry, server.url()) == {'connection': 1}
+    labels = {'url': server.url(), 'name': 'fake'}
+    assert registry.get_sample_value('yubihsm_up', labels) == 0
+    assert registry.get_sample_value('yubihsm_last_success_timestamp_seconds',
+                                     labels | {'test': 'connection'}) == 0
+
+
+def test_fake_connector_serves_multiple_devices(rsa_key, pins):
+    devices = {i: fake_connector.FakeYubiHsm(serial=i + 1, auth_keys=AUTH_KEYS,
+                                             rsa_key=rsa_key)
+               for i in range(3)}
+    server = fake_connector.FakeConnector(devices).start()
+    try:
+        registry = prometheus_client.CollectorRegistry()
+        metrics = main.Metrics(registry=registry)
+        for i in range(3):
+            config = main.YubiHSMConfiguration(server.url(i), name='hsm-%d' % i)
+            main.YubiHSMProbe(config, main.TestSecret(), metrics).probe()
+        serials = {s.labels['serial'] for m in registry.collect()
+                   for s in m.samples if s.name == 'yubihsm_device_info'}
+        assert serials == {'1', '2', '3'}
+    finally:
+        server.stop()
+
+
+def test_probe_shares_tests_between_aliases(device, pins):
+    server = fake_connector.FakeConnector({0: device, 1: device}).start()
+    try:
+        registry = prometheus_client.CollectorRegistry()
+        metrics = main.Metrics(registry=registry)
+        devices = main.DeviceRegistry()
+        probes = []
+        for i in range(2):
+            config = main.YubiHSMConfiguration(
+                    server.url(i), 3, str(pins / 'application'), 6,
+                    str(pins / 'audit'), 'hsm-%d' % i, 'vault-hsm-key')
+            probes.append(main.YubiHSMProbe(config, main.TestSecret(), metrics,
+                                            devices=devices))
+        for _ in range(2):
+            for probe in probes:
+                probe.probe()
+        assert device.sessions == 2
+        labels = [{'url': server.url(i), 'name': 'hsm-%d' % i} for i in range(2)]
+        assert [registry.get_sample_value('yubihsm_device_primary', l)
+                for l in labels] == [1, 0]
+        assert registry.get_sample_value('yubihsm_up', labels[1]) == 1
+        assert (registry.get_sample_value(
+                    'yubihsm_last_success_timestamp_seconds',
+                    labels[1] | {'test': 'crypto_test'}) ==
+                registry.get_sample_value(
+                    'yubihsm_last_success_timestamp_seconds',
+                    labels[0] | {'test': 'crypto_test'}) > 0)
+        assert errors(registry, server.url(1)) == {}
+        # The alias takes over once the connector is removed
+        probes[0].close()
+        probes[1].probe()
+        assert device.sessions == 2
+        assert registry.get_sample_value('yubihsm_device_primary', labels[1]) == 1
+    finally:
+        server.stop()
+
+
+@pytest.mark.skipif(not os.getenv('TEST_BENCHMARK'),
+                    reason='Timing dependent, set TEST_BENCHMARK to run it')
+def test_benchmark_run():
+    args = argparse.Namespace(duration=1.5, warmup=0.5, interval=0.2, workers=2,
+                              collection_mode='background',
+                              transport='asyncio', latency=0,
+                              error_rate=0, hanging=0)
+    result = benchmark.run(2, args)
+    assert result['connectors'] == 2
+    assert result['probes'] > 0
+    assert result['errors'] == 0
+    assert result['cycle_seconds'] > 0
+    assert result['peak_rss_kib'] >= result['rss_kib'] > 0
+
+
+@pytest.fixture
+def transport():
+    event_loop = main.EventLoopThread()
+    transport = main.AsyncConnectorTransport(event_loop)
+    yield transport
+    transport.close()
+    event_loop.close()
+
+
+def test_probe_over_async_transport(server, device, pins, transport):
+    registry = prometheus_client.CollectorRegistry()
+    config = main.YubiHSMConfiguration(
+            server.url(), 3, str(pins / 'application'), 6, str(pins / 'audit'),
+            'fake', 'vault-hsm-key')
+    probe = main.YubiHSMProbe(config, main.TestSecret(),
+                              main.Metrics(registry=registry),
+                              transport=transport)
+    for i in range(3):
+        probe.probe()
+    assert errors(registry, server.url()) == {}
+    assert probe.consecutive_failures == 0
+    # All requests of the probes share one kept alive connection
+    assert transport.opened_connections == 1
+    assert transport.idle_connections == 1
+    probe.close()
+    assert device.sessions == 0
+
+
+def test_async_transport_errors(server, device, transport):
+    url = server.url() + '/connector/api'
+    echo = b'\x01\x00\x04ping'
+    assert transport.post(url, echo, 1, 1) == b'\x81\x00\x04ping'
+    device.latency = 0.5
+    with pytest.raises(main.ProbeTimeoutError):
+        transport.post(url, echo, 1, 0.1)
+    device.latency = 0
+    device.error_rate = 1
+    with pytest.raises(yubihsm.exceptions.YubiHsmConnectionError):
+        transport.post(url, echo, 1, 1)
+    with pytest.raises(yubihsm.exceptions.YubiHsmConnectionError):
+        transport.post('http://127.0.0.1:1/connector/api', echo, 1, 1)
+
+
+def test_async_transport_reconnects_closed_connections(server, transport):
+    url = server.url() + '/connector/api'
+    echo = b'\x01\x00\x04ping'
+    server.keep_alive = False
+    assert transport.post(url, echo, 1, 1) == b'\x81\x00\x04ping'
+    assert transport.post(url, echo, 1, 1) == b'\x81\x00\x04ping'
+    assert transport.opened_connections == 2
+
+
+@pytest.fixture
+def probe_endpoint(server, pins):
+    modules = {'full': dict(application_key_id=3,
+                            application_key_pin_path=str(pins / 'application'),
+                            audit_key_id=6,
+                            audit_key_pin_path=str(pins / 'audit'),
+                            encryption_key_label='vault-hsm-key'),
+               'elsewhere': dict(audit_key_id=6,
+                                 audit_key_pin_path=str(pins / 'audit'),
+                                 targets=['http://127.0.0.1:1', 'hsm-*']),
+               'discovered': dict(application_key_id=3,
+                                  application_key_pin_path=str(pins / 'application'),
+                                  encryption_key_label='vault-hsm-key',
+                                  targets=['127.0.0.0/8'])}
+    endpoint = main.ProbeEndpoint(modules,
+                                  prometheus_client.Histogram.DEFAULT_BUCKETS,
+                                  main.CredentialCache(),
+                                  connectors=[main.YubiHSMConfiguration(server.url())])
+    port = benchmark.free_port()
+    server = main.start_http_server(port, prometheus_client.make_wsgi_app(),
+                                    {'/probe': endpoint})
+    yield 'http://127.0.0.1:%d' % port
+    server.shutdown()
+    server.server_close()
+
+
+def scrape_probe(endpoint, headers=None, **params):
+    response = requests.get(endpoint + '/probe', params=params,
+                            headers=headers, timeout=10)
+    samples = {(s.name, s.labels.get('test') or s.labels.get('error')): s.value
+               for family in prometheus_client.parser.text_string_to_metric_families(
+                       response.text)
+               for s in family.samples} if response.ok else {}
+    return response, samples
+
+
+def test_probe_endpoint(server, device, probe_endpoint):
+    response, samples = scrape_probe(probe_endpoint, target=server.url(),
+                                     module='full', name='fake')
+    assert response.status_code == 200
+    assert samples[('yubihsm_up', None)] == 1
+    assert samples[('yubihsm_last_success_timestamp_seconds', 'crypto_test')] > 0
+    assert device.sessions == 0
+    response, samples = scrape_probe(probe_endpoint, target=server.url())
+    assert samples[('yubihsm_up', None)] == 1
+    assert ('yubihsm_last_success_timestamp_seconds', 'get_logs') not in samples
+    response, _ = scrape_probe(probe_endpoint, target=server.url(),
+                               module='unknown')
+    assert response.status_code == 400
+    response, _ = scrape_probe(probe_endpoint, target='file:///etc/passwd')
+    assert response.status_code == 400
+    response, _ = scrape_probe(probe_endpoint, target='http://attacker:12345',
+                               module='full')
+    assert response.status_code == 403
+    response, _ = scrape_probe(probe_endpoint, target=server.url(),
+                               module='elsewhere')
+    assert response.status_code == 403
+    response, samples = scrape_probe(probe_endpoint, target=server.url(),
+                                     module='discovered')
+    assert response.status_code == 200
+    assert samples[('yubihsm_last_success_timestamp_seconds', 'crypto_test')] > 0
+    assert device.sessions == 0
+    response = requests.get(probe_endpoint + '/metrics', timeout=10)
+    assert 'python_info' in response.text
+
+
+def test_probe_endpoint_shares_device_with_connectors(server, device, pins):
+    devices = main.DeviceRegistry()
+    config = main.YubiHSMConfiguration(
+            server.url(), 3, str(pins / 'application'), 6, str(pins / 'audit'),
+            'fake', 'vault-hsm-key')
+    probe = main.YubiHSMProbe(
+            config, main.TestSecret(),
+            main.Metrics(registry=prometheus_client.CollectorRegistry()),
+            devices=devices)
+    probe.probe()
+    endpoint = main.ProbeEndpoint({}, prometheus_client.Histogram.DEFAULT_BUCKETS,
+                                  main.CredentialCache(), devices=devices)
+    registry = prometheus_client.CollectorRegistry()
+    endpoint.probe(config, registry)
+    labels = {'url': server.url(), 'name': 'fake'}
+    assert registry.get_sample_value('yubihsm_device_primary', labels) == 0
+    assert registry.get_sample_value('yubihsm_up', labels) == 1
+    assert device.sessions == 2
+    probe.close()
+
+
+def test_probe_endpoint_follows_scrape_timeout(server, device, probe_endpoint):
+    device.hang = True
+    response, samples = scrape_probe(
+            probe_endpoint, {'X-Prometheus-Scrape-Timeout-Seconds': '1.5'},
+            target=server.url(), module='full')
+    assert response.elapsed.total_seconds() < 3
+    assert samples[('yubihsm_test_errors_total', 'timeout')] == 1
+    assert samples[('yubihsm_up', None)] == 0
@@ -1,7 +1,16 @@
-from unittest.mock import patch, mock_open, MagicMock, ANY, PropertyMock
+from unittest.mock import patch, mock_open, MagicMock, ANY, PropertyMock, call
 from collections import namedtuple
+import gzip
+import hashlib
+import pstats
+import struct
+import threading
+import tracemalloc
 
 import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+import requests
 import prometheus_client
 import yubihsm
 
@@ -23,10 +32,26 @@ def test_parsing_minimal_configuration():
             dict(url='http://6.6.6.6:777'),
             dict(url='https://no.name:port')]))
     assert config.metrics_port == 8080
+    assert config.probe_workers == main.DEFAULT_PROBE_WORKERS
+    assert config.histogram_buckets == prometheus_client.Histogram.DEFAULT_BUCKETS
+    assert config.collection_mode == main.COLLECTION_MODE_BACKGROUND
+    assert config.transport == main.TRANSPORT_REQUESTS
+    assert config.scrape_cache_ttl == main.DEFAULT_SCRAPE_CACHE_TTL
+    assert config.scrape_deadline == main.DEFAULT_SCRAPE_DEADLINE
+    assert config.audit_log_sink is None
     assert config.connectors[0].url == 'http://6.6.6.6:777'
     assert config.connectors[0].application_key_id is None
     assert config.connectors[0].audit_key_id is None
     assert config.connectors[0].name == ''
+    assert config.connectors[0].connect_timeout == main.DEFAULT_CONNECT_TIMEOUT
+    assert config.connectors[0].read_timeout == main.DEFAULT_READ_TIMEOUT
+    assert config.connectors[0].probe_deadline == main.DEFAULT_PROBE_DEADLINE
+    assert config.connectors[0].probe_interval == main.SLEEP_TIME_BETWEEN_PROBES
+    assert config.connectors[0].probe_jitter == main.DEFAULT_PROBE_JITTER
+    assert config.connectors[0].max_backoff == main.DEFAULT_MAX_BACKOFF
+    assert config.connectors[0].benchmark_operations == 0
+    assert not config.connectors[0].benchmark_sign
+    assert not config.connectors[0].random_test_secret
     assert config.connectors[1].url == 'https://no.name:port'
     assert len(config.connectors) == 2
 
@@ -34,6 +59,18 @@ def test_parsing_minimal_configuration():
 def test_loading_full_configuration():
     config = main.Configuration.load_config(dict(
         metrics_port=7777,
+        probe_workers=3,
+        histogram_buckets=[0.01, 0.1, 1],
+        collection_mode='scrape',
+        transport='asyncio',
+        scrape_cache_ttl=0,
+        scrape_deadline=4.5,
+        modules=dict(audit=dict(audit_key_id=8,
+                                audit_key_pin_path='foo/bar/audit',
+                                targets=['http://hsm:12345'])),
+        audit_log_sink=dict(type='file', path='/var/log/audit.jsonl',
+                            max_bytes=4096, backup_count=0, batch_size=10,
+                            flush_interval=0.5, queue_size=20),
         connectors=[
             dict(
                 application_key_id=7,
@@ -42,10 +79,40 @@ def test_loading_full_configuration():
                 audit_key_id=8,
                 audit_key_pin_path='foo/bar/audit',
                 name='frog',
+                connect_timeout=1,
+                read_timeout=2.5,
+                probe_deadline=4,
+                probe_interval=60,
+                probe_jitter=0,
+                max_backoff=600,
+                benchmark_operations=20,
+                benchmark_sign=True,
+                random_test_secret=True,
+                get_logs_every=10,
+                crypto_test_every=3,
+                crypto_benchmark_every=60,
+                inventory_every=12,
                 url='http://6.6.6.6:777'),
             dict(
                 url='https://no.name:port')]))
     assert config.metrics_port == 7777
+    assert config.probe_workers == 3
+    assert config.histogram_buckets == [0.01, 0.1, 1]
+    assert config.collection_mode == main.COLLECTION_MODE_SCRAPE
+    assert config.transport == main.TRANSPORT_ASYNCIO
+    assert config.scrape_cache_ttl == 0
+    assert config.scrape_deadline == 4.5
+    assert config.modules == {'audit': dict(audit_key_id=8,
+                                            audit_key_pin_path='foo/bar/audit',
+                                            targets=['http://hsm:12345'])}
+    assert config.audit_log_sink.type == 'file'
+    assert config.audit_log_sink.path == '/var/log/audit.jsonl'
+    assert config.audit_log_sink.max_bytes == 4096
+    assert config.audit_log_sink.backup_count == 0
+    assert config.audit_log_sink.address == 'localhost:514'
+    assert config.audit_log_sink.batch_size == 10
+    assert config.audit_log_sink.flush_interval == 0.5
+    assert config.audit_log_sink.queue_size == 20
     assert config.connectors[0].url == 'http://6.6.6.6:777'
     assert config.connectors[0].application_key_id == 7
     assert config.connectors[0].application_key_pin_path == 'foo/bar/app'
@@ -53,7 +120,22 @@ def test_loading_full_configuration():
     assert config.connectors[0].audit_key_id == 8
     assert config.connectors[0].audit_key_pin_path == 'foo/bar/audit'
     assert config.connectors[0].name == 'frog'   
+    assert config.connectors[0].connect_timeout == 1
+    assert config.connectors[0].read_timeout == 2.5
+    assert config.connectors[0].probe_deadline == 4
+    assert config.connectors[0].probe_interval == 60
+    assert config.connectors[0].probe_jitter == 0
+    assert config.connectors[0].max_backoff == 600
+    assert config.connectors[0].benchmark_operations == 20
+    assert config.connectors[0].random_test_secret
+    assert config.connectors[0].benchmark_sign
+    assert config.connectors[0].get_logs_every == 10
+    assert config.connectors[0].crypto_test_every == 3
+    assert config.connectors[0].crypto_benchmark_every == 60
+    assert config.connectors[0].inventory_every == 12
     assert config.connectors[1].url == 'https://no.name:port'
+    assert config.connectors[1].get_logs_every == 1
+    assert config.connectors[1].inventory_every == 0
     assert len(config.connectors) == 2
 
 
@@ -65,6 +147,41 @@ invalid_configs=[
         url='sds', audit_key_id='7', audit_key_pin_path='foo/bar')]),
     dict(connectors=[dict(url='sds', audit_key_id=7)]),
     dict(connectors=[dict(url='sds', application_key_id=7)]),
+    dict(connectors=[dict(url='sds', read_timeout='7')]),
+    dict(connectors=[dict(url='sds', probe_deadline=0)]),
+    dict(connectors=[dict(url='sds', probe_interval=-5)]),
+    dict(connectors=[dict(url='sds', probe_jitter=1)]),
+    dict(connectors=[dict(url='sds', benchmark_operations=5)]),
+    dict(connectors=[dict(url='sds', benchmark_sign='yes')]),
+    dict(connectors=[dict(url='sds', get_logs_every=0)]),
+    dict(connectors=[dict(url='sds', crypto_test_every=1.5)]),
+    dict(connectors=[dict(url='sds', inventory_every=-1)]),
+    dict(connectors=[], probe_workers=0),
+    dict(connectors=[], probe_workers='4'),
+    dict(connectors=[], histogram_buckets=[1, 0.1]),
+    dict(connectors=[], histogram_buckets=['1']),
+    dict(connectors=[], collection_mode='sometimes'),
+    dict(connectors=[], scrape_cache_ttl=-1),
+    dict(connectors=[], transport='curl'),
+    dict(connectors=[], modules=['default']),
+    dict(connectors=[], modules=dict(default=dict(url='http://hsm'))),
+    dict(connectors=[], modules=dict(default=dict(audit_key_id=7))),
+    dict(connectors=[], modules=dict(default=dict(targets='http://hsm'))),
+    dict(connectors=[], modules=dict(default=dict(targets=[1]))),
+    dict(connectors=[], scrape_deadline=0),
+    dict(connectors=[], audit_log_sink='stdout'),
+    dict(connectors=[], audit_log_sink=dict(type='kafka')),
+    dict(connectors=[], audit_log_sink=dict(type='file')),
+    dict(connectors=[], audit_log_sink=dict(type='stdout', queue_size=0)),
+    dict(connectors=[dict(url='sds', probe_intervall=5)]),
+    dict(connectors=[], modules=dict(default=dict(probe_intervall=5))),
+    dict(connectors=[], audit_log_sink=dict(type='stdout', batch=10)),
+    dict(connectors=[], audit_log_sink=dict(type='syslog', address='localhost')),
+    dict(connectors=[], audit_log_sink=dict(type='syslog', address=':514')),
+    dict(connectors=[], audit_log_sink=dict(type='syslog',
+                                            address='localhost:syslog')),
+    dict(connectors=[], audit_log_sink=dict(type='syslog',
+                                            address='localhost:65536')),
 ]
 
 
@@ -88,25 +205,184 @@ def test_version_to_string():
     assert main.version_to_string((5, 6, 7)) == '5.6.7'
 
 
+def test_enum_label():
+    assert main.enum_label(yubihsm.defs.OBJECT, 3) == 'asymmetric_key'
+    assert main.enum_label(yubihsm.defs.ALGORITHM, 0xfe) == 'unknown_0xfe'
+
+
+def test_get_storage_info():
+    session = MagicMock()
+    session.send_secure_cmd.return_value = bytes.fromhex('0100 00fe 0400 03f0 007e')
+    assert main.get_storage_info(session) == main.StorageInfo(256, 254, 1024,
+                                                               1008, 126)
+    session.send_secure_cmd.assert_called_once_with(
+            yubihsm.defs.COMMAND.GET_STORAGE_INFO)
+    session.send_secure_cmd.return_value = b'\x01'
+    with pytest.raises(yubihsm.exceptions.YubiHsmInvalidResponseError):
+        main.get_storage_info(session)
+
+
 def test_load_pin():
     with patch('builtins.open', mock_open(read_data='prince')) as open_mock:
         assert main.load_pin('frog') == 'prince'
         open_mock.assert_called_with('frog')
-    with pytest.raises(SystemExit):
+    with pytest.raises(main.PinFileError):
         main.load_pin('does/not/exist')
 
 
+def test_http_connector_backend():
+    backend = main.HttpConnectorBackend('http://hsm:12345', 2, 5,
+                                        deadline=main.Deadline(60))
+    with patch('requests.Session.post') as post_mock:
+        post_mock.return_value.content = b'response'
+        assert backend.transceive(b'request') == b'response'
+        post_mock.assert_called_with(url='http://hsm:12345/connector/api',
+                                     data=b'request', timeout=(2, 5))
+        post_mock.side_effect = requests.exceptions.ReadTimeout()
+        with pytest.raises(main.ProbeTimeoutError):
+            backend.transceive(b'request')
+        post_mock.side_effect = requests.exceptions.ConnectionError()
+        with pytest.raises(yubihsm.exceptions.YubiHsmConnectionError) as e:
+            backend.transceive(b'request')
+        assert not isinstance(e.value, main.ProbeTimeoutError)
+    backend.close()
+
+
+def test_http_connector_backend_deadline():
+    backend = main.HttpConnectorBackend('http://hsm:12345', 2, 5,
+                                        deadline=main.Deadline(-1))
+    with patch('requests.Session.post') as post_mock:
+        with pytest.raises(main.ProbeTimeoutError):
+            backend.transceive(b'request')
+        assert not post_mock.called
+
+
+def test_deadline():
+    assert main.Deadline().remaining() is None
+    deadline = main.Deadline(10)
+    assert 9 < deadline.remaining() <= 10
+    deadline.reset(-1)
+    assert deadline.remaining() < 0
+
+
+def test_connect_hsm():
+    config = main.YubiHSMConfiguration(url='yhusb://serial=123')
+    with patch('yubihsm.YubiHsm.connect') as connect_mock:
+        main.connect_hsm(config, 0)
+        connect_mock.assert_called_once_with('yhusb://serial=123')
+    config = main.YubiHSMConfiguration(url='http://hsm:12345', read_timeout=1)
+    hsm = main.connect_hsm(config, 0)
+    assert isinstance(hsm._backend, main.HttpConnectorBackend)
+    hsm.close()
+
+
+def test_credential_cache(tmp_path):
+    pin_path = tmp_path / 'pin'
+    pin_path.write_text('password\n')
+    credentials = main.CredentialCache()
+    expected_keys = yubihsm.utils.password_to_key('password')
+    rotated_keys = yubihsm.utils.password_to_key('rotated')
+    with patch('yubihsm.utils.password_to_key',
+               wraps=yubihsm.utils.password_to_key) as derive_mock:
+        assert credentials.get(7, str(pin_path)) == expected_keys
+        assert credentials.get(7, str(pin_path)) == expected_keys
+        assert derive_mock.call_count == 1
+        pin_path.write_text('rotated')
+        main.os.utime(pin_path, ns=(0, 12345))
+        assert credentials.get(7, str(pin_path)) == rotated_keys
+        assert derive_mock.call_count == 2
+    with pytest.raises(main.PinFileError):
+        credentials.get(7, str(tmp_path / 'missing'))
+
+
+def test_command_name():
+    assert main.command_name(0x03) == 'CREATE_SESSION'
+    assert main.command_name(0xee) == 'UNKNOWN_0xee'
+
+
+def test_json_lines_file_sink(tmp_path):
+    path = str(tmp_path / 'audit.jsonl')
+    sink = main.JsonLinesFileSink(path, 10, 2)
+    sink.write([b'12345\n', b'678\n'])
+    sink.write([b'abc\n'])
+    sink.write([b'def\n'])
+    sink.write([b'ghi\n'])
+    sink.close()
+    assert open(path, 'rb').read() == b'ghi\n'
+    assert open(path + '.1', 'rb').read() == b'abc\ndef\n'
+    assert open(path + '.2', 'rb').read() == b'12345\n678\n'
+    assert not main.os.path.exists(path + '.3')
+
+
+def test_syslog_sink():
+    receiver = main.socket.socket(main.socket.AF_INET, main.socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(5)
+    sink = main.SyslogSink('127.0.0.1:%d' % receiver.getsockname()[1])
+    sink.write([b'{"number": 1}\n', b'{"number": 2}\n'])
+    assert receiver.recv(1024) == b'<134>yubihsm-exporter: {"number": 1}\n'
+    assert receiver.recv(1024) == b'<134>yubihsm-exporter: {"number": 2}\n'
+    sink.close()
+    receiver.close()
+
+
+def test_audit_log_writer():
+    sink, metrics = MagicMock(), MagicMock()
+    writer = main.AuditLogWriter(sink, metrics, batch_size=2,
+                                 flush_interval=60, queue_size=10)
+    writer.submit([dict(number=1), dict(number=2), dict(number=3)])
+    writer.close()
+    assert sink.write.call_args_list[0].args[0] == [
+            b'{"number": 1}\n', b'{"number": 2}\n']
+    assert sink.write.call_args_list[1].args[0] == [b'{"number": 3}\n']
+    metrics.audit_log_exported_entries.inc.assert_any_call(2)
+    metrics.audit_log_exported_entries.inc.assert_any_call(1)
+    metrics.audit_log_written_bytes.inc.assert_any_call(28)
+    assert sink.close.called
+
+
+def test_audit_log_writer_drops_entries():
+    release = threading.Event()
+    sink, metrics = MagicMock(), MagicMock()
+    sink.write.side_effect = lambda lines: release.wait(5)
+    writer = main.AuditLogWriter(sink, metrics, batch_size=1,
+                                 flush_interval=60, queue_size=1)
+    writer.submit([dict(number=n) for n in range(10)])
+    release.set()
+    writer.close()
+    assert metrics.audit_log_dropped_entries.inc.called
+
+
 def test_test_secret():
     test_secret = main.TestSecret('🤴')
     assert test_secret.secret == '🤴'
     assert test_secret.get() == ('🤴', False)
     curse = lambda x: '🐸'.encode('utf8') if x == '🤴'.encode('utf8') else None
     kiss = lambda x: '🤴'.encode('utf8') if x == '🐸'.encode('utf8') else '💓'
-    test_secret.process(encrypt=curse, decrypt=kiss)
+    assert test_secret.process(encrypt=curse, decrypt=kiss)
     assert test_secret.get() == ('f09f90b8', True)
-    test_secret.process(encrypt=curse, decrypt=kiss)
+    assert test_secret.process(encrypt=curse, decrypt=kiss)
     assert test_secret.secret == '🤴'
     assert test_secret.get() == ('🤴', False)
+    assert test_secret.process(encrypt=curse, decrypt=kiss)
+    assert not test_secret.process(encrypt=curse, decrypt=lambda x: b'frog')
+    assert test_secret.expected == '🤴'
+    # A failed decryption does not spoil the next cycle
+    assert test_secret.process(encrypt=curse, decrypt=kiss)
+    assert test_secret.process(encrypt=curse, decrypt=kiss)
+
+
+def test_random_test_secret():
+    test_secret = main.TestSecret(randomize=True)
+    identity = lambda x: x
+    secrets = set()
+    for i in range(3):
+        assert test_secret.process(encrypt=identity, decrypt=identity)
+        secrets.add(test_secret.expected)
+        assert test_secret.process(encrypt=identity, decrypt=identity)
+        assert test_secret.secret == test_secret.expected
+    assert len(secrets) == 3
+    assert main.TestSecret.DEFAULT_SECRET not in secrets
 
 
 def test_default_secret():
@@ -126,6 +402,30 @@ def test_metrics_helper():
     assert isinstance(
             metrics.test_errors.labels(url='mu', name='ma', error='mi'),
             prometheus_client.Counter)
+    assert isinstance(
+            metrics.phase_duration.labels(url='mu', name='ma', phase='mo'),
+            prometheus_client.Histogram)
+    assert isinstance(
+            metrics.sessions.labels(url='mu', name='ma', origin='reused'),
+            prometheus_client.Counter)
+    assert isinstance(metrics.open_sessions.labels(url='mu', name='ma'),
+            prometheus_client.Gauge)
+    assert isinstance(metrics.audit_log_exported_entries,
+            prometheus_client.Counter)
+    assert isinstance(metrics.audit_log_dropped_entries,
+            prometheus_client.Counter)
+    assert isinstance(metrics.audit_log_written_bytes,
+            prometheus_client.Counter)
+    assert isinstance(metrics.audit_log_queue_depth, prometheus_client.Gauge)
+    assert isinstance(metrics.audit_log_last_number.labels(url='mu', name='ma'),
+            prometheus_client.Gauge)
+    assert isinstance(
+            metrics.audit_log_chain_errors.labels(url='mu', name='ma', type='gap'),
+            prometheus_client.Counter)
+    assert isinstance(metrics.crypto_operation_duration.labels(
+            url='mu', name='ma', operation='decrypt'), prometheus_client.Histogram)
+    assert isinstance(metrics.crypto_operations_per_second.labels(
+            url='mu', name='ma', operation='sign'), prometheus_client.Gauge)
 
 
 DeviceInfo = namedtuple(
@@ -136,6 +436,19 @@ DeviceInfo = namedtuple(
 LogData = namedtuple('LogData', ['entries'])
 
 
+def make_log_entries(first_number, count, previous_digest=b'\0' * 16):
+    entries = []
+    for number in range(first_number, first_number + count):
+        entry = yubihsm.core.LogEntry(
+                number=number & 0xFFFF, command=0x03, length=10,
+                session_key=0xffff, target_key=7, second_key=0xffff,
+                result=0x83, tick=number, digest=b'')
+        previous_digest = hashlib.sha256(
+                entry.data + previous_digest).digest()[:16]
+        entries.append(entry._replace(digest=previous_digest))
+    return entries
+
+
 def prepare_probe_under_test(metrics_mock, with_audit=True, with_encryption=True):
     test_secret = main.TestSecret('mySecret')
     connector = main.YubiHSMConfiguration(
@@ -145,32 +458,35 @@ def prepare_probe_under_test(metrics_mock, with_audit=True, with_encryption=True
             application_key_id=8 if with_encryption else None, 
             application_key_pin_path='application/',
             encryption_key_label='foo')
-    probe = main.YubiHSMProbe(connector, test_secret, metrics_mock)
-    return probe, test_secret, connector
+    credentials = MagicMock(spec=main.CredentialCache)
+    credentials.get.return_value = (b'key_enc', b'key_mac')
+    probe = main.YubiHSMProbe(connector, test_secret, metrics_mock, credentials)
+    return probe, test_secret, connector, credentials
 
 
 @patch('main.Metrics')
 @patch('yubihsm.core.YubiHsm')
 def test_yubihsm_full_successful_probe(yubihsm_mock, metrics_mock):
-    probe, test_secret, _ = prepare_probe_under_test(metrics_mock)
+    probe, test_secret, _, credentials = prepare_probe_under_test(metrics_mock)
     yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
         version=(3, 4, 5), serial='6789', log_size=63, log_used=7))
     public_key = MagicMock()
     public_key.encrypt = MagicMock(return_value=b'encrypted')
     key_mock = MagicMock(spec=yubihsm.objects.AsymmetricKey)
     key_mock.get_public_key = MagicMock(return_value=public_key)
-    key_mock.decrypt_pkcs1v1_5 = MagicMock(
-            return_value=main.TestSecret.DEFAULT_SECRET.encode('utf8'))
+    key_mock.with_session.return_value = key_mock
+    key_mock.decrypt_pkcs1v1_5 = MagicMock(return_value=b'mySecret')
     session_mock = MagicMock(spec=yubihsm.core.AuthSession)
     session_mock.list_objects = MagicMock(return_value=[key_mock])
-    log_entries_mock = [MagicMock() for _ in range(2)]
+    log_entries_mock = make_log_entries(1, 2)
     session_mock.get_log_entries = MagicMock(return_value=LogData(
         entries=log_entries_mock))
-    yubihsm_mock.create_session_derived = MagicMock(return_value=session_mock)
-    with patch('yubihsm.YubiHsm.connect', return_value=yubihsm_mock) as (
-            connect_mock), patch('main.load_pin') as load_pin_mock:
+    yubihsm_mock.create_session = MagicMock(return_value=session_mock)
+    with patch('main.connect_hsm', return_value=yubihsm_mock) as (
+            connect_mock):
         probe.probe()
-        connect_mock.assert_called_once_with('http://first-node.de')
+        assert probe.consecutive_failures == 0
+        connect_mock.assert_called_once_with(probe.config, ANY, None)
         assert yubihsm_mock.get_device_info.called
         # TODO: check actual values passed to the metric collectors
         expected_labels=dict(url='http://first-node.de', name='')
@@ -179,57 +495,93 @@ def test_yubihsm_full_successful_probe(yubihsm_mock, metrics_mock):
         metrics_mock.used_log_entries.labels.assert_called_with(
                 **expected_labels)
         # Check log retrieval
-        load_pin_mock.assert_any_call('foo/bar/audit')
-        yubihsm_mock.create_session_derived.assert_any_call(7, ANY)
+        credentials.get.assert_any_call(7, 'foo/bar/audit')
+        yubihsm_mock.create_session.assert_any_call(7, ANY, ANY)
         assert session_mock.get_log_entries.called
         session_mock.set_log_index.assert_called_with(log_entries_mock[-1].number)
         # Check encryption test
-        load_pin_mock.assert_any_call('application/')
-        yubihsm_mock.create_session_derived.assert_any_call(8, ANY)
+        credentials.get.assert_any_call(8, 'application/')
+        yubihsm_mock.create_session.assert_any_call(8, ANY, ANY)
         session_mock.list_objects.assert_called_once_with(label='foo')
         assert key_mock.get_public_key.called
         public_key.encrypt.assert_called_once_with(b'mySecret', ANY)
+        phases = set(c.kwargs['phase']
+                     for c in metrics_mock.phase_duration.labels.call_args_list)
+        assert phases == {'total', 'device_info', 'audit_session',
+                          'get_log_entries', 'set_log_index',
+                          'application_session', 'list_objects',
+                          'get_public_key', 'encrypt'}
         assert test_secret.get() == (b'encrypted'.hex(), True)
         assert not key_mock.decrypt_pkcs1v1_5.called
         key_mock.reset_mock()
         probe.probe()
         assert not key_mock.get_public_key.called
+        assert yubihsm_mock.create_session.call_count == 2
+        metrics_mock.sessions.labels.assert_any_call(
+                url='http://first-node.de', name='', origin='reused')
         key_mock.decrypt_pkcs1v1_5.assert_called_with(b'encrypted')
-        assert test_secret.get() == (main.TestSecret.DEFAULT_SECRET, False)
+        assert test_secret.get() == ('mySecret', False)
+        assert not metrics_mock.test_errors.labels.called
+        session_mock.list_objects.assert_called_once()
+        metrics_mock.key_cache_lookups.labels.assert_any_call(
+                url='http://first-node.de', name='', result='miss')
+        metrics_mock.key_cache_lookups.labels.assert_called_with(
+                url='http://first-node.de', name='', result='hit')
+        metrics_mock.phase_duration.labels.assert_any_call(
+                url='http://first-node.de', name='', phase='decrypt')
         
 
 
 @patch('main.Metrics')
 @patch('yubihsm.core.YubiHsm')
 def test_probe_connection_error(yubihsm_mock, metrics_mock):
-    probe, test_secret, _ = prepare_probe_under_test(metrics_mock)
+    probe, test_secret, _, credentials = prepare_probe_under_test(metrics_mock)
     yubihsm_mock.get_device_info.side_effect = yubihsm.exceptions.YubiHsmConnectionError()
-    with patch('yubihsm.YubiHsm.connect', return_value=yubihsm_mock):
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
          probe.probe()
          metrics_mock.test_errors.labels.assert_called_with(
                  url='http://first-node.de', name='', error='connection')
+         metrics_mock.up.labels.return_value.set.assert_called_once_with(0)
+         assert call(url='http://first-node.de', name='', test='connection') \
+                 in metrics_mock.last_success.labels.call_args_list
+         assert not metrics_mock.last_success.labels.return_value.set.called
+
+
+@patch('main.Metrics')
+@patch('yubihsm.core.YubiHsm')
+def test_probe_timeout(yubihsm_mock, metrics_mock):
+    probe, test_secret, _, credentials = prepare_probe_under_test(metrics_mock)
+    yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
+        version=(3, 4, 5), serial='6789', log_size=63, log_used=7))
+    yubihsm_mock.create_session.side_effect = main.ProbeTimeoutError()
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
+         probe.probe()
+         metrics_mock.test_errors.labels.assert_called_once_with(
+                 url='http://first-node.de', name='', error='timeout')
+         assert yubihsm_mock.close.called
 
 
-@patch('main.load_pin')
 @patch('main.Metrics')
 @patch('yubihsm.core.YubiHsm')
-def test_probe_log_retrieval_error(yubihsm_mock, metrics_mock, load_pin):
-    probe, test_secret, _ = prepare_probe_under_test(metrics_mock, with_encryption=False)
+def test_probe_log_retrieval_error(yubihsm_mock, metrics_mock):
+    probe, test_secret, _, credentials = prepare_probe_under_test(metrics_mock, with_encryption=False)
     yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
         version=(3, 4, 5), serial='6789', log_size=63, log_used=7))
-    yubihsm_mock.create_session_derived.side_effect = yubihsm.exceptions.YubiHsmConnectionError()
-    with patch('yubihsm.YubiHsm.connect', return_value=yubihsm_mock):
+    yubihsm_mock.create_session.side_effect = yubihsm.exceptions.YubiHsmConnectionError()
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
          probe.probe()
-         assert load_pin.called
+         assert credentials.get.called
          metrics_mock.test_errors.labels.assert_called_with(
                  url='http://first-node.de', name='', error='get_logs')
+         metrics_mock.last_success.labels.assert_called_with(
+                 url='http://first-node.de', name='', test='connection')
+         metrics_mock.up.labels.return_value.set.assert_called_once_with(False)
 
 
-@patch('main.load_pin')
 @patch('main.Metrics')
 @patch('yubihsm.core.YubiHsm')
-def test_probe_failed_decryption(yubihsm_mock, metrics_mock, load_pin):
-    probe, test_secret, _ = prepare_probe_under_test(metrics_mock, with_audit=False)
+def test_probe_failed_decryption(yubihsm_mock, metrics_mock):
+    probe, test_secret, _, credentials = prepare_probe_under_test(metrics_mock, with_audit=False)
     yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
         version=(3, 4, 5), serial='6789', log_size=63, log_used=7))
     key_mock = MagicMock(spec=yubihsm.objects.AsymmetricKey)
@@ -237,55 +589,870 @@ def test_probe_failed_decryption(yubihsm_mock, metrics_mock, load_pin):
             return_value='something'.encode('utf8'))
     session_mock = MagicMock(spec=yubihsm.core.AuthSession)
     session_mock.list_objects = MagicMock(return_value=[key_mock])
-    yubihsm_mock.create_session_derived = MagicMock(return_value=session_mock)
-    with patch('yubihsm.YubiHsm.connect', return_value=yubihsm_mock):
+    yubihsm_mock.create_session = MagicMock(return_value=session_mock)
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
          test_secret.process(encrypt=lambda x: x, decrypt=lambda x: x)
          probe.probe()
-         assert load_pin.called
+         assert credentials.get.called
          key_mock.decrypt_pkcs1v1_5.assert_called_with(b'mySecret')
          metrics_mock.test_errors.labels.assert_called_with(
                  url='http://first-node.de', name='', error='crypto_test')
 
 
-@patch('main.load_pin')
 @patch('main.Metrics')
 @patch('yubihsm.core.YubiHsm')
-def test_probe_failed_over_missing_key(yubihsm_mock, metrics_mock, load_pin):
-    probe, test_secret, _ = prepare_probe_under_test(metrics_mock, with_audit=False)
+def test_probe_failed_over_missing_key(yubihsm_mock, metrics_mock):
+    probe, test_secret, _, credentials = prepare_probe_under_test(metrics_mock, with_audit=False)
     yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
         version=(3, 4, 5), serial='6789', log_size=63, log_used=7))
     session_mock = MagicMock(spec=yubihsm.core.AuthSession)
     session_mock.list_objects = MagicMock(return_value=[])
-    yubihsm_mock.create_session_derived = MagicMock(return_value=session_mock)
-    with patch('yubihsm.YubiHsm.connect', return_value=yubihsm_mock):
+    yubihsm_mock.create_session = MagicMock(return_value=session_mock)
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
          test_secret.process(encrypt=lambda x: x, decrypt=lambda x: x)
          probe.probe()
-         assert load_pin.called
+         assert credentials.get.called
          session_mock.list_objects.assert_called_with(label='foo')
          metrics_mock.test_errors.labels.assert_called_with(
                  url='http://first-node.de', name='', error='crypto_test')
 
+@patch('main.Metrics')
+@patch('yubihsm.core.YubiHsm')
+def test_probe_invalidates_cached_key(yubihsm_mock, metrics_mock):
+    probe, test_secret, _, credentials = prepare_probe_under_test(metrics_mock, with_audit=False)
+    yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
+        version=(3, 4, 5), serial='6789', log_size=63, log_used=7))
+    public_key = MagicMock()
+    public_key.encrypt = MagicMock(return_value=b'encrypted')
+    key_mock = MagicMock(spec=yubihsm.objects.AsymmetricKey)
+    key_mock.get_public_key = MagicMock(return_value=public_key)
+    key_mock.with_session.return_value = key_mock
+    key_mock.decrypt_pkcs1v1_5.side_effect = yubihsm.exceptions.YubiHsmDeviceError(
+            yubihsm.defs.ERROR.OBJECT_NOT_FOUND)
+    session_mock = MagicMock(spec=yubihsm.core.AuthSession)
+    session_mock.list_objects = MagicMock(return_value=[key_mock])
+    yubihsm_mock.create_session = MagicMock(return_value=session_mock)
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
+        probe.probe()
+        probe.probe()
+        # The reused session gets re-created and the key looked up again
+        assert session_mock.list_objects.call_count == 2
+        assert key_mock.get_public_key.call_count == 2
+        metrics_mock.test_errors.labels.assert_called_with(
+                url='http://first-node.de', name='', error='crypto_test')
+        key_mock.decrypt_pkcs1v1_5.side_effect = None
+        key_mock.decrypt_pkcs1v1_5.return_value = b'mySecret'
+        probe.probe()
+        probe.probe()
+        assert session_mock.list_objects.call_count == 3
+        yubihsm_mock.get_device_info.return_value = DeviceInfo(
+            version=(3, 4, 5), serial='9876', log_size=63, log_used=7)
+        probe.probe()
+        assert session_mock.list_objects.call_count == 4
+
+
+@patch('main.Metrics')
+@patch('yubihsm.core.YubiHsm')
+def test_probe_reauthenticates_expired_session(yubihsm_mock, metrics_mock):
+    probe, test_secret, _, credentials = prepare_probe_under_test(
+            metrics_mock, with_encryption=False)
+    yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
+        version=(3, 4, 5), serial='6789', log_size=63, log_used=7))
+    expired_session, new_session = MagicMock(), MagicMock()
+    expired_session.get_log_entries.side_effect = [
+            LogData(entries=[]),
+            yubihsm.exceptions.YubiHsmDeviceError(
+                yubihsm.defs.ERROR.INVALID_SESSION)]
+    new_session.get_log_entries.return_value = LogData(entries=[])
+    yubihsm_mock.create_session.side_effect = [
+            expired_session, new_session]
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
+        probe.probe()
+        probe.probe()
+        assert new_session.get_log_entries.called
+        assert yubihsm_mock.create_session.call_count == 2
+        assert not metrics_mock.test_errors.labels.called
+        probe.close()
+        assert new_session.close.called
+        assert not expired_session.close.called
+        assert yubihsm_mock.close.called
+
+
+@patch('main.Metrics')
+@patch('yubihsm.core.YubiHsm')
+def test_probe_exports_logs_to_audit_log(yubihsm_mock, metrics_mock):
+    audit_log = MagicMock()
+    connector = main.YubiHSMConfiguration(
+            url='http://first-node.de', name='frog', audit_key_id=7,
+            audit_key_pin_path='foo/bar/audit')
+    probe = main.YubiHSMProbe(connector, None, metrics_mock, MagicMock(),
+                              audit_log)
+    yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
+        version=(3, 4, 5), serial='6789', log_size=63, log_used=7))
+    entry = yubihsm.core.LogEntry(
+            number=5, command=0x03, length=10, session_key=0xffff,
+            target_key=7, second_key=0xffff, result=0x83, tick=123,
+            digest=b'\x01' * 16)
+    yubihsm_mock.create_session.return_value.get_log_entries.return_value = (
+            LogData(entries=[entry]))
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
+        probe.probe()
+    [record] = audit_log.submit.call_args.args[0]
+    assert record['url'] == 'http://first-node.de'
+    assert record['name'] == 'frog'
+    assert record['number'] == 5
+    assert record['command_name'] == 'CREATE_SESSION'
+    assert record['digest'] == '01' * 16
+
+
+@patch('main.Metrics')
+@patch('yubihsm.core.YubiHsm')
+def test_probe_crypto_benchmark(yubihsm_mock, metrics_mock):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    connector = main.YubiHSMConfiguration(
+            url='http://first-node.de', application_key_id=8,
+            application_key_pin_path='application/',
+            encryption_key_label='foo', benchmark_operations=5,
+            benchmark_sign=True)
+    test_secret = main.TestSecret()
+    probe = main.YubiHSMProbe(connector, test_secret, metrics_mock, MagicMock())
+    yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
+        version=(3, 4, 5), serial=6789, log_size=63, log_used=7))
+    key_mock = MagicMock(spec=yubihsm.objects.AsymmetricKey)
+    key_mock.get_public_key.return_value = private_key.public_key()
+    key_mock.with_session.return_value = key_mock
+    key_mock.decrypt_pkcs1v1_5.side_effect = lambda c: private_key.decrypt(
+            c, padding.PKCS1v15())
+    key_mock.sign_pkcs1v1_5.side_effect = lambda d: private_key.sign(
+            d, padding.PKCS1v15(), hashes.SHA256())
+    yubihsm_mock.create_session.return_value.list_objects.return_value = [
+            key_mock]
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
+        probe.probe()
+    assert key_mock.decrypt_pkcs1v1_5.call_count == 5
+    assert key_mock.sign_pkcs1v1_5.call_count == 5
+    assert yubihsm_mock.create_session.call_count == 1
+    assert not metrics_mock.test_errors.labels.called
+    metrics_mock.crypto_operations_per_second.labels.assert_any_call(
+            url='http://first-node.de', name='', operation='decrypt')
+    metrics_mock.crypto_operations_per_second.labels.assert_any_call(
+            url='http://first-node.de', name='', operation='sign')
+    key_mock.sign_pkcs1v1_5.side_effect = lambda d: b'forged'
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
+        probe.probe()
+    metrics_mock.test_errors.labels.assert_called_once_with(
+            url='http://first-node.de', name='', error='crypto_benchmark')
+
+
+def test_audit_log_cursors(tmp_path):
+    path = str(tmp_path / 'cursors.json')
+    entry = make_log_entries(42, 1)[0]
+    cursors = main.AuditLogCursors(path)
+    assert cursors.get(1234) is None
+    cursors.update(1234, entry)
+    assert cursors.get(1234).number == 42
+    cursors = main.AuditLogCursors(path)
+    assert cursors.get(1234).number == 42
+    assert cursors.get(1234).digest == entry.digest
+    with open(path, 'w') as cursor_file:
+        cursor_file.write('garbage')
+    assert main.AuditLogCursors(path).get(1234) is None
+
+
+@patch('main.Metrics')
+@patch('yubihsm.core.YubiHsm')
+def test_probe_tracks_audit_log_incrementally(yubihsm_mock, metrics_mock):
+    audit_log = MagicMock()
+    connector = main.YubiHSMConfiguration(
+            url='http://first-node.de', audit_key_id=7,
+            audit_key_pin_path='foo/bar/audit')
+    cursors = main.AuditLogCursors()
+    probe = main.YubiHSMProbe(connector, None, metrics_mock, MagicMock(),
+                              audit_log, cursors)
+    yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
+        version=(3, 4, 5), serial=6789, log_size=63, log_used=7))
+    entries = make_log_entries(0xfffe, 6)
+    get_log_entries = yubihsm_mock.create_session.return_value.get_log_entries
+    errors = metrics_mock.audit_log_chain_errors.labels
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
+        get_log_entries.return_value = LogData(entries=entries[:3])
+        probe.probe()
+        assert len(audit_log.submit.call_args.args[0]) == 3
+        # Entries not cleared by set_log_index are not exported again
+        get_log_entries.return_value = LogData(entries=entries[1:4])
+        probe.probe()
+        [record] = audit_log.submit.call_args.args[0]
+        assert record['number'] == 1
+        assert cursors.get(6789).number == 1
+        metrics_mock.audit_log_last_number.labels.return_value.set.assert_called_with(1)
+        assert not errors.called
+        get_log_entries.return_value = LogData(entries=entries[5:])
+        probe.probe()
+        errors.assert_called_with(url='http://first-node.de', name='',
+                                  type='gap')
+        forged = entries[5]._replace(number=4)
+        get_log_entries.return_value = LogData(entries=[forged])
+        probe.probe()
+        errors.assert_called_with(url='http://first-node.de', name='',
+                                  type='break')
+
+
+@patch('main.Metrics')
+@patch('yubihsm.core.YubiHsm')
+def test_probe_drains_audit_log_with_broken_chain(yubihsm_mock, metrics_mock):
+    audit_log = MagicMock()
+    connector = main.YubiHSMConfiguration(
+            url='http://first-node.de', audit_key_id=7,
+            audit_key_pin_path='foo/bar/audit')
+    probe = main.YubiHSMProbe(connector, None, metrics_mock, MagicMock(),
+                              audit_log)
+    yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
+        version=(3, 4, 5), serial=6789, log_size=63, log_used=4))
+    entries = make_log_entries(1, 4)
+    entries[2] = entries[2]._replace(result=0x01)
+    session = yubihsm_mock.create_session.return_value
+    session.get_log_entries.side_effect = \
+            yubihsm.exceptions.YubiHsmInvalidResponseError('Incorrect log digest')
+    session.send_secure_cmd.return_value = struct.pack('!HHB', 0, 0, 4) + b''.join(
+            struct.pack(yubihsm.core.LogEntry.FORMAT, *e) for e in entries)
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
+        probe.probe()
+    session.send_secure_cmd.assert_called_once_with(
+            yubihsm.defs.COMMAND.GET_LOG_ENTRIES)
+    metrics_mock.audit_log_chain_errors.labels.assert_called_once_with(
+            url='http://first-node.de', name='', type='break')
+    assert len(audit_log.submit.call_args.args[0]) == 4
+    session.set_log_index.assert_called_once_with(4)
+
+
+def test_get_log_entries():
+    session = MagicMock()
+    session.send_secure_cmd.return_value = b'\0\0\0\0\1'
+    with pytest.raises(yubihsm.exceptions.YubiHsmInvalidResponseError):
+        main.get_log_entries(session)
+
+
+@patch('main.Metrics')
+@patch('yubihsm.core.YubiHsm')
+def test_probe_drains_full_audit_log_repeatedly(yubihsm_mock, metrics_mock):
+    probe, _, _, _ = prepare_probe_under_test(metrics_mock,
+                                              with_encryption=False)
+    yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
+        version=(3, 4, 5), serial=6789, log_size=63, log_used=60))
+    session = yubihsm_mock.create_session.return_value
+    session.get_log_entries.side_effect = [
+            LogData(entries=make_log_entries(1, 60)),
+            LogData(entries=make_log_entries(61, 40)),
+            LogData(entries=make_log_entries(101, 5))]
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
+        probe.probe()
+    assert session.get_log_entries.call_count == 3
+    session.set_log_index.assert_called_with(105)
+    metrics_mock.audit_log_time_to_full.labels.return_value.set.assert_called_with(
+            float('inf'))
+
+
+@patch('main.AUDIT_KEY_LABELS', 2)
+@patch('yubihsm.core.YubiHsm')
+def test_probe_counts_audit_log_commands(yubihsm_mock):
+    registry = prometheus_client.CollectorRegistry()
+    connector = main.YubiHSMConfiguration(
+            url='http://first-node.de', audit_key_id=7,
+            audit_key_pin_path='foo/bar/audit')
+    probe = main.YubiHSMProbe(connector, None, main.Metrics(registry=registry),
+                              MagicMock())
+    yubihsm_mock.get_device_info = MagicMock(return_value=DeviceInfo(
+        version=(3, 4, 5), serial=6789, log_size=63, log_used=7))
+    entries = make_log_entries(1, 7)
+    entries[1] = entries[1]._replace(result=0x7f)
+    for i, target_key in ((2, 0x100), (3, 0x100), (4, 0x200), (5, 0)):
+        entries[i] = entries[i]._replace(target_key=target_key)
+    get_log_entries = yubihsm_mock.create_session.return_value.get_log_entries
+    get_log_entries.return_value = LogData(entries=entries)
+    with patch('main.connect_hsm', return_value=yubihsm_mock):
+        probe.probe()
+    labels = dict(url='http://first-node.de', name='')
+    commands = labels | {'command': 'CREATE_SESSION'}
+    assert registry.get_sample_value('yubihsm_audit_commands_total',
+                                     commands | {'result': 'success'}) == 6
+    assert registry.get_sample_value('yubihsm_audit_commands_total',
+                                     commands | {'result': 'error'}) == 1
+    usage = {(s.labels['role'], s.labels['key']): s.value
+             for m in registry.collect() for s in m.samples
+             if s.name == 'yubihsm_audit_key_usage_total'}
+    assert usage == {('session', '0xffff'): 7, ('target', '0x0007'): 3,
+                     ('target', '0x0100'): 2, ('target', 'other'): 1}
+
+
+@patch('main.Metrics')
+@patch('yubihsm.core.YubiHsm')
+def test_probe_reconnects_after_connection_error(yubihsm_mock, metrics_mock):
+    probe, test_secret, _, credentials = prepare_probe_under_test(metrics_mock)
+    yubihsm_mock.get_device_info.side_effect = (
+            yubihsm.exceptions.YubiHsmConnectionError())
+    with patch('main.connect_hsm', return_value=yubihsm_mock) as connect_mock:
+        probe.probe()
+        probe.probe()
+        assert probe.consecutive_failures == 2
+        assert connect_mock.call_count == 2
+        assert yubihsm_mock.close.call_count == 2
+
+
 @patch('main.YubiHSMProbe')
 @patch('main.Metrics')
-@patch('prometheus_client.start_http_server')
+@patch('main.start_http_server')
 @patch('main.load_configuration')
 def test_main(load_config_mock, start_server_mock, metrics_mock, probe_mock):
-    hsm_config = main.YubiHSMConfiguration(url='www.somewhere.de')
+    hsm_config = main.YubiHSMConfiguration(url='www.somewhere.de',
+                                           probe_jitter=0)
+    other_config = main.YubiHSMConfiguration(url='www.elsewhere.de',
+                                             probe_jitter=0)
     load_config_mock.return_value = main.Configuration(
-            metrics_port=8787, connectors=[hsm_config])
-    main.SLEEP_TIME_BETWEEN_PROBES = 0
-    prober_mock = probe_mock()
+            metrics_port=8787, connectors=[other_config, hsm_config])
+    prober_mock = mock_probe(hsm_config)
     probe_mock.return_value = prober_mock
     with patch('main.ExitHandler.stop', new_callable=PropertyMock) as stop_mock:
         stop_mock.side_effect = [False, True]
         handler = main.ExitHandler()
         main.main()
         assert prober_mock.probe.called
-        probe_mock.assert_called_with(hsm_config, ANY, ANY)
-        start_server_mock.assert_called_with(8787)
+        probe_mock.assert_called_with(hsm_config, ANY, ANY, ANY, None, ANY,
+                                      transport=None, devices=ANY)
+        test_secrets = [c.args[1] for c in probe_mock.call_args_list]
+        assert test_secrets[0] is not test_secrets[1]
+        devices = [c.kwargs['devices'] for c in probe_mock.call_args_list]
+        assert devices[0] is devices[1]
+        start_server_mock.assert_called_with(8787, ANY, {'/probe': ANY})
+        assert isinstance(start_server_mock.call_args.args[1],
+                          main.ExpositionCache)
         load_config_mock.assert_called_with('/etc/yubihsm-export/config.json')
 
 
+def test_shard_from_environment():
+    shard = main.Shard.from_environment({})
+    assert (shard.index, shard.count) == (0, 1)
+    shard = main.Shard.from_environment({'YUBIHSM_EXPORTER_SHARD_COUNT': '3',
+                                         'YUBIHSM_EXPORTER_SHARD_INDEX': '2'})
+    assert (shard.index, shard.count) == (2, 3)
+    shard = main.Shard.from_environment({'YUBIHSM_EXPORTER_SHARD_COUNT': '3',
+                                         'HOSTNAME': 'yubihsm-exporter-1'})
+    assert (shard.index, shard.count) == (1, 3)
+    for environ in ({'YUBIHSM_EXPORTER_SHARD_COUNT': '3',
+                     'YUBIHSM_EXPORTER_SHARD_INDEX': '3'},
+                    {'YUBIHSM_EXPORTER_SHARD_COUNT': 'three'},
+                    {'YUBIHSM_EXPORTER_SHARD_COUNT': '3',
+                     'HOSTNAME': 'yubihsm-exporter'}):
+        with patch('main.exit', side_effect=SystemExit) as exit_mock:
+            with pytest.raises(SystemExit):
+                main.Shard.from_environment(environ)
+            exit_mock.assert_called_with(1)
+
+
+def test_shard_selects_consistent_subsets():
+    connectors = [main.YubiHSMConfiguration(url='http://hsm-%d' % i)
+                  for i in range(200)]
+    assert main.Shard().select(connectors) == connectors
+    shards = [main.Shard(i, 4).select(connectors) for i in range(4)]
+    assert sorted(sum(shards, []), key=connectors.index) == connectors
+    assert all(30 < len(s) < 70 for s in shards)
+    assert shards == [main.Shard(i, 4).select(connectors) for i in range(4)]
+    # Growing to five shards only moves connectors to the new shard
+    grown = [main.Shard(i, 5).select(connectors) for i in range(5)]
+    for before, after in zip(shards, grown):
+        assert set(after) <= set(before)
+    assert len(grown[4]) < 70
+
+
+@patch('main.YubiHSMProbe')
+@patch('main.Metrics')
+@patch('main.start_http_server')
+@patch('main.load_configuration')
+def test_main_probes_own_shard(load_config_mock, start_server_mock,
+                               metrics_mock, probe_mock):
+    connectors = [main.YubiHSMConfiguration(url='http://hsm-%d' % i,
+                                            probe_jitter=0)
+                  for i in range(10)]
+    load_config_mock.return_value = main.Configuration(
+            metrics_port=8787, connectors=connectors)
+    probe_mock.side_effect = lambda config, *args, **kwargs: mock_probe(config)
+    environ = {'YUBIHSM_EXPORTER_SHARD_COUNT': '2',
+               'YUBIHSM_EXPORTER_SHARD_INDEX': '1'}
+    with patch.dict('os.environ', environ), patch(
+            'main.ExitHandler.stop', new_callable=PropertyMock) as stop_mock:
+        stop_mock.return_value = True
+        main.main()
+    probed = [c.args[0] for c in probe_mock.call_args_list]
+    assert probed == main.Shard(1, 2).select(connectors)
+    metrics_mock.return_value.shard.info.assert_called_with(
+            {'index': '1', 'count': '2'})
+    metrics_mock.return_value.shard_connectors.set.assert_called_with(
+            len(probed))
+
+
+def test_connector_configuration_equality():
+    config = main.YubiHSMConfiguration(url='http://hsm', name='a')
+    assert config == main.YubiHSMConfiguration(url='http://hsm', name='a')
+    assert hash(config) == hash(main.YubiHSMConfiguration(url='http://hsm',
+                                                          name='a'))
+    assert config != main.YubiHSMConfiguration(url='http://hsm', name='a',
+                                               probe_interval=1)
+    assert config != main.YubiHSMConfiguration(url='http://hsm', name='b')
+    full = main.Configuration([config], 8080)
+    assert not full.restart_required(main.Configuration([], 8080))
+    assert full.restart_required(main.Configuration([config], 8081))
+
+
+def test_metrics_remove_connector():
+    registry = prometheus_client.CollectorRegistry()
+    metrics = main.Metrics(registry=registry)
+    for name in ('a', 'b'):
+        metrics.test_connections.labels(url='http://hsm', name=name).inc()
+        metrics.test_errors.labels(url='http://hsm', name=name,
+                                   error='timeout').inc()
+    metrics.audit_log_exported_entries.inc()
+    metrics.remove('http://hsm', 'a')
+    assert registry.get_sample_value('yubihsm_test_connections_total',
+                                     {'url': 'http://hsm', 'name': 'a'}) is None
+    assert registry.get_sample_value(
+            'yubihsm_test_errors_total',
+            {'url': 'http://hsm', 'name': 'a', 'error': 'timeout'}) is None
+    assert registry.get_sample_value('yubihsm_test_connections_total',
+                                     {'url': 'http://hsm', 'name': 'b'}) == 1
+    assert registry.get_sample_value(
+            'yubihsm_audit_log_exported_entries_total') == 1
+
+
+@patch('main.YubiHSMProbe')
+def test_probe_manager_applies_connector_changes(probe_mock):
+    probe_mock.side_effect = lambda config, *args, **kwargs: mock_probe(config)
+    scheduler = MagicMock()
+    probes = []
+    scheduler.probes = probes
+    scheduler.add.side_effect = probes.append
+    scheduler.remove.side_effect = lambda probe, closed=None: (
+            probes.remove(probe), closed and closed())
+    metrics = MagicMock()
+    manager = main.ProbeManager(scheduler, metrics, main.Shard(), MagicMock())
+    first = main.YubiHSMConfiguration(url='http://first')
+    second = main.YubiHSMConfiguration(url='http://second')
+    manager.apply([first, second])
+    assert [p.config for p in probes] == [first, second]
+    kept = probes[0]
+    changed = main.YubiHSMConfiguration(url='http://second', probe_interval=1)
+    third = main.YubiHSMConfiguration(url='http://third')
+    manager.apply([first, changed, third])
+    assert [p.config for p in probes] == [first, changed, third]
+    assert probes[0] is kept
+    assert not metrics.remove.called
+    manager.apply([changed])
+    assert [p.config for p in probes] == [changed]
+    assert sorted(c.args for c in metrics.remove.call_args_list) == [
+            ('http://first', ''), ('http://third', '')]
+    metrics.shard_connectors.set.assert_called_with(1)
+
+
+def test_configuration_watcher(tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_text('{"connectors": [{"url": "http://first"}]}')
+    config = main.load_configuration(str(path))
+    watcher = main.ConfigurationWatcher(str(path), config, interval=0)
+    assert watcher.poll() is None
+    path.write_text('{"connectors": [{"url": "http://second"}]}')
+    reloaded = watcher.poll()
+    assert [c.url for c in reloaded.connectors] == ['http://second']
+    assert watcher.config is reloaded
+    assert watcher.poll() is None
+    path.write_text('{"connectors": [{"name": "no url"}]}')
+    assert watcher.poll() is None
+    assert watcher.config is reloaded
+    path.write_text('{"connectors": [{"url": "http://third", '
+                    '"probe_intervall": 5}]}')
+    assert watcher.poll() is None
+    assert watcher.config is reloaded
+    path.write_text('{"connectors": [{"url": "http://second"}]}')
+    watcher = main.ConfigurationWatcher(str(path), config, interval=60)
+    assert watcher.poll() is None
+    main.os.kill(main.os.getpid(), main.signal.SIGHUP)
+    assert [c.url for c in watcher.poll().connectors] == ['http://second']
+
+
+def mock_probe(config=None):
+    probe = MagicMock()
+    probe.config = config or main.YubiHSMConfiguration(
+            url='http://hsm', probe_interval=0.1, probe_jitter=0)
+    probe.consecutive_failures = 0
+    probe.drain_delay = None
+    return probe
+
+
+def test_probe_scheduler_runs_probes_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+    probes = [mock_probe() for _ in range(3)]
+    for probe in probes:
+        probe.probe.side_effect = barrier.wait
+    scheduler = main.ProbeScheduler(probes, 3)
+    scheduler.sweep()
+    scheduler.shutdown()
+    assert all(probe.probe.called for probe in probes)
+    assert not barrier.broken
+
+
+def test_probe_scheduler_survives_failing_probe():
+    failing_probe, probe = mock_probe(), mock_probe()
+    failing_probe.probe.side_effect = RuntimeError('boom')
+    exiting_probe = mock_probe()
+    exiting_probe.probe.side_effect = SystemExit(1)
+    scheduler = main.ProbeScheduler([failing_probe, exiting_probe, probe], 1)
+    scheduler.sweep()
+    scheduler.sweep()
+    scheduler.shutdown()
+    assert probe.probe.call_count == 2
+
+
+def test_probe_scheduler_sweep_timeout():
+    release = threading.Event()
+    slow_probe, probe = mock_probe(), mock_probe()
+    slow_probe.probe.side_effect = lambda: release.wait(5)
+    scheduler = main.ProbeScheduler([slow_probe, probe], 2)
+    scheduler.sweep(timeout=0.1)
+    assert probe.probe.call_count == 1
+    scheduler.sweep(timeout=0.1)
+    assert slow_probe.probe.call_count == 1
+    assert probe.probe.call_count == 2
+    release.set()
+    scheduler.shutdown()
+
+
+def test_probe_scheduler_run_pending():
+    fast_probe = mock_probe()
+    slow_probe = mock_probe(main.YubiHSMConfiguration(
+            url='http://slow', probe_interval=60, probe_jitter=0))
+    scheduler = main.ProbeScheduler([fast_probe, slow_probe], 2)
+    deadline = main.time.monotonic() + 1
+    while main.time.monotonic() < deadline:
+        scheduler.run_pending(0.05)
+    scheduler.shutdown()
+    assert slow_probe.probe.call_count == 1
+    assert fast_probe.probe.call_count > 3
+
+
+def test_probe_scheduler_add_and_remove():
+    probe = mock_probe()
+    release = threading.Event()
+    running_probe = mock_probe()
+    running_probe.probe.side_effect = lambda: release.wait(5)
+    closed = MagicMock()
+    scheduler = main.ProbeScheduler([], 2)
+    scheduler.add(probe)
+    scheduler.add(running_probe)
+    scheduler.run_pending(0.05)
+    assert scheduler.probes == [probe, running_probe]
+    scheduler.remove(probe)
+    probe.close.assert_called_once()
+    scheduler.remove(running_probe, closed)
+    assert not running_probe.close.called
+    release.set()
+    scheduler.run_pending(0.05)
+    scheduler.shutdown()
+    running_probe.close.assert_called_once()
+    closed.assert_called_once()
+    assert scheduler.probes == []
+    assert probe.probe.call_count == 1
+
+
+def test_async_probe_scheduler():
+    event_loop = main.EventLoopThread()
+    fast_probe = mock_probe()
+    slow_probe = mock_probe(main.YubiHSMConfiguration(
+            url='http://slow', probe_interval=60, probe_jitter=0))
+    failing_probe = mock_probe()
+    failing_probe.probe.side_effect = RuntimeError('boom')
+    exiting_probe = mock_probe()
+    exiting_probe.probe.side_effect = SystemExit(1)
+    closed = threading.Event()
+    scheduler = main.AsyncProbeScheduler([fast_probe, slow_probe], 2, event_loop)
+    scheduler.add(failing_probe)
+    scheduler.add(exiting_probe)
+    scheduler.run_pending(0.5)
+    assert fast_probe.probe.call_count > 2
+    assert slow_probe.probe.call_count == 1
+    assert failing_probe.probe.call_count > 2
+    assert exiting_probe.probe.call_count > 2
+    scheduler.remove(exiting_probe)
+    scheduler.remove(fast_probe, closed.set)
+    assert closed.wait(1)
+    fast_probe.close.assert_called_once()
+    calls = fast_probe.probe.call_count
+    scheduler.run_pending(0.3)
+    assert fast_probe.probe.call_count == calls
+    assert scheduler.probes == [slow_probe, failing_probe]
+    scheduler.shutdown()
+    slow_probe.close.assert_called_once()
+    event_loop.close()
+
+
+def test_async_probe_scheduler_exits_with_event_loop():
+    event_loop = main.EventLoopThread()
+    scheduler = main.AsyncProbeScheduler([], 1, event_loop)
+    event_loop.close()
+    assert not event_loop.alive
+    with pytest.raises(SystemExit):
+        scheduler.run_pending(0)
+    scheduler.shutdown()
+
+
+def test_probe_scheduler_backoff():
+    config = main.YubiHSMConfiguration(url='http://hsm', probe_interval=5,
+                                       probe_jitter=0, max_backoff=60)
+    assert main.ProbeScheduler.delay(config, 0) == 5
+    assert main.ProbeScheduler.delay(config, 1) == 5
+    assert main.ProbeScheduler.delay(config, 2) == 10
+    assert main.ProbeScheduler.delay(config, 4) == 40
+    assert main.ProbeScheduler.delay(config, 5) == 60
+    assert main.ProbeScheduler.delay(config, 1000) == 60
+    config = main.YubiHSMConfiguration(url='http://hsm', probe_interval=10,
+                                       probe_jitter=0.5)
+    delays = [main.ProbeScheduler.delay(config, 0) for _ in range(100)]
+    assert all(5 <= d <= 15 for d in delays)
+    assert len(set(delays)) > 1
+
+
+def test_probe_scheduler_next_delay():
+    probe = mock_probe(main.YubiHSMConfiguration(
+            url='http://hsm', probe_interval=5, probe_jitter=0))
+    assert main.ProbeScheduler.next_delay(probe) == 5
+    probe.drain_delay = 2
+    assert main.ProbeScheduler.next_delay(probe) == 2
+    probe.drain_delay = 7
+    assert main.ProbeScheduler.next_delay(probe) == 5
+    probe.drain_delay = 2
+    probe.consecutive_failures = 2
+    assert main.ProbeScheduler.next_delay(probe) == 10
+
+
+def test_audit_log_fill_rate():
+    fill_rate = main.AuditLogFillRate(smoothing=0.5)
+    assert fill_rate.time_to_full(10) == float('inf')
+    fill_rate.used(100, 10)
+    fill_rate.used(110, 30)
+    assert fill_rate.rate == 2
+    assert fill_rate.time_to_full(40) == 20
+    fill_rate.retrieved(110, 0xFFF0)
+    # Draining lowers the used entries, which is no sample
+    fill_rate.used(115, 5)
+    assert fill_rate.rate == 2
+    fill_rate.retrieved(120, 0x002C)
+    assert fill_rate.rate == 4
+    fill_rate.used(130, 0)
+    fill_rate.used(140, 0)
+    assert fill_rate.rate == 2
+
+
+def test_device_state():
+    device = main.DeviceState()
+    probe, alias = mock_probe(), mock_probe()
+    assert device.claim(probe)
+    assert not device.claim(alias)
+    assert device.claim(probe)
+    # An alias takes over from a probe, which fails to reach the device
+    probe.consecutive_failures = 1
+    assert device.claim(alias)
+    probe.consecutive_failures = 0
+    assert not device.claim(probe)
+    device.release(alias)
+    assert device.claim(probe)
+    device.record({'crypto_test': 120}, True)
+    assert device.last_success == {'crypto_test': 120}
+    assert device.passed
+
+
+def test_probe_scheduler_skips_backoff_in_sweep():
+    failing_probe = mock_probe(main.YubiHSMConfiguration(
+            url='http://hsm', probe_interval=60, probe_jitter=0))
+    failing_probe.consecutive_failures = 3
+    scheduler = main.ProbeScheduler([failing_probe], 1)
+    scheduler.sweep()
+    scheduler.sweep()
+    scheduler.shutdown()
+    assert failing_probe.probe.call_count == 1
+
+
+def test_probe_instrumentation():
+    registry = prometheus_client.CollectorRegistry()
+    metrics = main.Metrics(registry=registry)
+    in_flight = []
+    probes = [mock_probe() for _ in range(2)]
+    for probe in probes:
+        probe.probe.side_effect = lambda: in_flight.append(
+                registry.get_sample_value('yubihsm_exporter_probes_in_flight'))
+    scheduler = main.ProbeScheduler(
+            probes, 1, main.ProbeInstrumentation(metrics))
+    scheduler.sweep()
+    scheduler.shutdown()
+    assert sorted(in_flight) == [1, 1]
+    assert registry.get_sample_value('yubihsm_exporter_probes_in_flight') == 0
+    assert registry.get_sample_value(
+            'yubihsm_exporter_sweep_duration_seconds_count') == 1
+    assert registry.get_sample_value(
+            'yubihsm_exporter_probe_start_lag_seconds_count') == 2
+    assert registry.get_sample_value(
+            'yubihsm_exporter_probe_start_lag_seconds_sum') >= 0
+
+
+def test_profiler(tmp_path):
+    assert main.Profiler.from_environment({}) is None
+    with pytest.raises(SystemExit):
+        main.Profiler.from_environment({'YUBIHSM_EXPORTER_PROFILE': 'disk'})
+    profiler = main.Profiler.from_environment({
+            'YUBIHSM_EXPORTER_PROFILE': 'cpu, memory',
+            'YUBIHSM_EXPORTER_PROFILE_DIR': str(tmp_path)})
+    try:
+        probe = mock_probe()
+        probe.probe.side_effect = lambda: sorted(range(1000))
+        instrumentation = main.ProbeInstrumentation(profiler=profiler)
+        instrumentation.run(probe, 0)
+        instrumentation.run(probe, 0)
+        profiler.poll()
+        assert list(tmp_path.iterdir()) == []
+        profiler.request()
+        profiler.poll()
+        paths = sorted(tmp_path.iterdir())
+        assert [p.suffix for p in paths] == ['.pstats', '.tracemalloc']
+        stats = pstats.Stats(str(paths[0]))
+        assert any('sorted' in function for _, _, function in stats.stats)
+        tracemalloc.Snapshot.load(str(paths[1]))
+    finally:
+        tracemalloc.stop()
+
+
+def test_exposition_cache():
+    registry = prometheus_client.CollectorRegistry()
+    metrics = main.Metrics(registry=registry)
+    cache = main.ExpositionCache(metrics, registry)
+    encoder = MagicMock(side_effect=prometheus_client.generate_latest)
+    first = cache.get(encoder, 'text/plain')
+    assert cache.get(encoder, 'text/plain') is first
+    assert gzip.decompress(cache.get(encoder, 'text/plain', True)) == first
+    assert encoder.call_count == 1
+    metrics.test_connections.labels(url='http://hsm', name='').inc()
+    metrics.changed()
+    second = cache.get(encoder, 'text/plain', True)
+    assert b'http://hsm' in gzip.decompress(second)
+    assert encoder.call_count == 2
+    assert registry.get_sample_value(
+            'yubihsm_exporter_exposition_requests_total', {'cache': 'hit'}) == 2
+    assert registry.get_sample_value(
+            'yubihsm_exporter_exposition_requests_total', {'cache': 'miss'}) == 2
+    assert registry.get_sample_value(
+            'yubihsm_exporter_exposition_render_duration_seconds_count') == 2
+
+
+def test_exposition_cache_request():
+    registry = prometheus_client.CollectorRegistry()
+    cache = main.ExpositionCache(main.Metrics(registry=registry), registry)
+    start_response = MagicMock()
+    body = cache({'HTTP_ACCEPT_ENCODING': 'gzip, deflate'}, start_response)
+    start_response.assert_called_once_with('200 OK', [
+            ('Content-Type', prometheus_client.CONTENT_TYPE_LATEST),
+            ('Vary', 'Accept, Accept-Encoding'),
+            ('Content-Encoding', 'gzip')])
+    assert b'yubihsm_up' in gzip.decompress(body[0])
+    start_response = MagicMock()
+    body = cache({'HTTP_ACCEPT_ENCODING': 'gzip;q=0, identity'}, start_response)
+    assert b'yubihsm_up' in body[0]
+    assert ('Content-Encoding', 'gzip') not in start_response.call_args.args[1]
+    start_response = MagicMock()
+    body = cache({'HTTP_ACCEPT': 'application/openmetrics-text'},
+                 start_response)
+    assert body[0].endswith(b'# EOF\n')
+    start_response = MagicMock()
+    body = cache({'QUERY_STRING': 'name[]=yubihsm_up',
+                  'PATH_INFO': '/metrics'}, start_response)
+    assert b'yubihsm_log_size' not in body[0]
+
+
+def test_exposition_cache_renders_exporter_metrics_fresh():
+    registry = prometheus_client.CollectorRegistry()
+    exporter_registry = prometheus_client.CollectorRegistry()
+    metrics = main.Metrics(registry=registry, exporter_registry=exporter_registry)
+    cache = main.ExpositionCache(metrics, registry, exporter_registry)
+    encoder = MagicMock(side_effect=prometheus_client.generate_latest)
+    cache.get(encoder, 'text/plain')
+    output = cache.get(encoder, 'text/plain')
+    assert b'yubihsm_exporter_exposition_requests_total{cache="hit"} 1.0' in output
+    assert b'yubihsm_up' in output
+    output = gzip.decompress(cache.get(encoder, 'text/plain', True))
+    assert b'yubihsm_exporter_exposition_requests_total{cache="hit"} 2.0' in output
+    output = cache.get(prometheus_client.openmetrics.exposition.generate_latest,
+                       'application/openmetrics-text')
+    assert output.count(b'# EOF') == 1
+    assert output.endswith(b'# EOF\n')
+    start_response = MagicMock()
+    body = cache({'QUERY_STRING': 'name[]=yubihsm_exporter_probes_in_flight',
+                  'PATH_INFO': '/metrics'}, start_response)
+    assert b'yubihsm_exporter_probes_in_flight 0.0' in body[0]
+
+
+def test_target_matches():
+    assert main.target_matches('http://HSM:12345', 'http://hsm:12345')
+    assert not main.target_matches('http://hsm:12345', 'https://hsm:12345')
+    assert main.target_matches('http://10.1.2.3:12345', '10.0.0.0/8')
+    assert main.target_matches('http://[fd00::1]:12345', 'fd00::/8')
+    assert not main.target_matches('http://11.1.2.3:12345', '10.0.0.0/8')
+    assert not main.target_matches('http://hsm:12345', '10.0.0.0/8')
+    assert main.target_matches('http://hsm-1.hsm.svc:12345', '*.hsm.svc')
+    assert not main.target_matches('http://hsm.example.com', '*.hsm.svc')
+    assert not main.target_matches('yhusb://serial=123', '*')
+
+
+def test_accepts_gzip():
+    assert main.accepts_gzip('gzip, deflate')
+    assert main.accepts_gzip('deflate, gzip;q=0.5')
+    assert main.accepts_gzip('*')
+    assert not main.accepts_gzip('gzip;q=0')
+    assert not main.accepts_gzip('gzip;q=0.0, *')
+    assert not main.accepts_gzip('')
+
+
+def test_scrape_collector():
+    scheduler = MagicMock()
+    registry = prometheus_client.CollectorRegistry()
+    gauge = prometheus_client.Gauge('frog', 'Frogs', registry=registry)
+    collector = main.ScrapeCollector(scheduler, registry, 60, 3)
+    scheduler.sweep.side_effect = lambda timeout: gauge.inc()
+    assert [m.name for m in collector.collect()] == ['frog']
+    assert [m.samples[0].value for m in collector.collect()] == [1]
+    scheduler.sweep.assert_called_once_with(3)
+    collector = main.ScrapeCollector(scheduler, registry, 0, 3)
+    assert [m.samples[0].value for m in collector.collect()] == [2]
+    assert [m.samples[0].value for m in collector.collect()] == [3]
+    scheduler.reset_mock()
+    prometheus_client.CollectorRegistry(auto_describe=True).register(
+            main.ScrapeCollector(scheduler, registry, 0, 3))
+    assert not scheduler.sweep.called
+
+
+@patch('main.ProbeScheduler')
+@patch('main.YubiHSMProbe')
+@patch('main.Metrics')
+@patch('prometheus_client.REGISTRY')
+@patch('main.start_http_server')
+@patch('main.load_configuration')
+def test_main_scrape_mode(load_config_mock, start_server_mock, registry_mock,
+                          metrics_mock, probe_mock, scheduler_mock):
+    load_config_mock.return_value = main.Configuration(
+            metrics_port=8787, collection_mode='scrape',
+            connectors=[main.YubiHSMConfiguration(url='www.somewhere.de')])
+    with patch('main.ExitHandler.stop', new_callable=PropertyMock) as stop_mock, \
+            patch('main.SCHEDULER_TICK', 0):
+        stop_mock.side_effect = [False, True]
+        main.main()
+        collector = registry_mock.register.call_args.args[0]
+        assert isinstance(collector, main.ScrapeCollector)
+        assert not scheduler_mock.return_value.sweep.called
+        assert scheduler_mock.return_value.shutdown.called
+
+
 def test_exit_handler():
     handler = main.ExitHandler()
     handler.exit()